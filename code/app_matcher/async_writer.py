@@ -0,0 +1,172 @@
+"""
+Background writer for the matching results. The scoring loop hands full batches to a
+writer thread through a bounded queue and only waits if the queue is full, so scoring
+continues while a batch is written. Transient MongoDB errors are retried with
+exponential backoff.
+"""
+import queue
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Optional
+
+from pymongo.errors import AutoReconnect, BulkWriteError, ConnectionFailure
+
+from app_matcher.result_sinks import ResultSink
+
+# Error codes of write errors worth retrying: network errors, elections and shutdowns
+# see https://github.com/mongodb/mongo/blob/master/src/mongo/base/error_codes.yml
+TRANSIENT_ERROR_CODES = {
+    6,  # HostUnreachable
+    7,  # HostNotFound
+    64,  # WriteConcernFailed
+    89,  # NetworkTimeout
+    91,  # ShutdownInProgress
+    189,  # PrimarySteppedDown
+    262,  # ExceededTimeLimit
+    9001,  # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    13436,  # NotPrimaryOrSecondary
+}
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+
+@dataclass(kw_only=True)
+class WriterOptions:
+    # Number of results per write
+    batch_size: int = 10000
+    # Number of batches that may wait for the writer before scoring blocks
+    queue_size: int = 2
+    # Write concern of the MongoDB sink ("majority" or number of nodes), None for the default
+    write_concern: Optional[str] = None
+    max_retries: int = 5
+    # Seconds before the first retry, doubled for each further retry
+    retry_backoff: float = 0.5
+
+
+@dataclass(kw_only=True)
+class WriterStats:
+    batches: int = 0
+    documents: int = 0
+    # Documents whose write succeeded
+    written: int = 0
+    retries: int = 0
+    # Time the scoring loop waited for a free slot in the queue
+    blocked: float = 0
+    # Time the writer thread spent writing
+    writing: float = 0
+    failed: bool = False
+
+
+def _retry_documents(
+    err: BulkWriteError, batch: list[dict], is_retry: bool
+) -> Optional[list[dict]]:
+    """
+    Documents of "batch" that have to be written again after "err", None if the
+    error is not transient. On a retry, duplicate key errors mean that the document
+    was already inserted by the failed attempt.
+    """
+    details = err.details or {}
+    retry = []
+    for write_error in details.get("writeErrors", []):
+        code = write_error.get("code")
+        if is_retry and code == DUPLICATE_KEY_ERROR_CODE:
+            continue
+        if code not in TRANSIENT_ERROR_CODES:
+            return None
+        retry.append(batch[write_error["index"]])
+    if len(details.get("writeConcernErrors", [])) > 0:
+        # The documents may or may not be written, duplicates are skipped on retry
+        return batch
+    return retry
+
+
+class AsyncResultWriter:
+    def __init__(self, sink: ResultSink, options: WriterOptions):
+        self.sink = sink
+        self.batch_size = options.batch_size
+        self.max_retries = options.max_retries
+        self.retry_backoff = options.retry_backoff
+        self.stats = WriterStats()
+        self._batch: list[dict] = []
+        self._queue: queue.Queue[Optional[list[dict]]] = queue.Queue(
+            maxsize=max(options.queue_size, 1)
+        )
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, result: dict) -> None:
+        self._batch.append(result)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def extend(self, results: list[dict]) -> None:
+        for result in results:
+            self.add(result)
+
+    def flush(self) -> None:
+        if len(self._batch) == 0:
+            return
+        self._put(self._batch)
+        self._batch = []
+
+    def close(self) -> WriterStats:
+        """
+        Write the remaining results and wait until all batches are written.
+        """
+        self.flush()
+        self._put(None)
+        self._thread.join()
+        return self.stats
+
+    def _put(self, item: Optional[list[dict]]) -> None:
+        started_at = time.time()
+        self._queue.put(item)
+        self.stats.blocked += time.time() - started_at
+
+    def _run(self) -> None:
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self.stats.failed:
+                # The unit is repeated anyway, see _match_executor
+                continue
+            started_at = time.time()
+            try:
+                self._write(batch)
+            except Exception as err:
+                # TODO: pack error so that it can be properly logged/stored
+                print(err)
+                print(traceback.format_exc())
+                self.stats.failed = True
+            self.stats.writing += time.time() - started_at
+
+    def _write(self, batch: list[dict]) -> None:
+        self.stats.batches += 1
+        self.stats.documents += len(batch)
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sink.write(pending)
+                self.stats.written += len(batch)
+                return
+            except BulkWriteError as err:
+                retry = _retry_documents(err, pending, is_retry=attempt > 0)
+                if retry is None or attempt == self.max_retries:
+                    raise
+                if len(retry) == 0:
+                    self.stats.written += len(batch)
+                    return
+                pending = retry
+            except (AutoReconnect, ConnectionFailure):
+                if attempt == self.max_retries:
+                    raise
+            self.stats.retries += 1
+            delay = self.retry_backoff * 2**attempt
+            print(f"[Writer] Transient write error, retrying {len(pending)} results in {delay:.1f}s")
+            time.sleep(delay)
@@ -0,0 +1,185 @@
+"""
+Batch versions of the string similarity, icon hash and Hu et al. matchers. Instead of comparing
+one pair at a time, they compare a block of iOS apps against a block of Android apps
+(with rapidfuzz's cdist or on bit-packed hashes) and return one score matrix
+(iOS x Android) per score key.
+
+The scores are numerically identical to the ones of the pairwise matchers in
+matchers.py.
+"""
+from typing import Callable
+
+import numpy
+from rapidfuzz.distance import Indel, Levenshtein, Prefix
+from rapidfuzz.process import cdist
+
+from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
+    AndroidPreprocessingResult,
+)
+from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios_preprocessing_result import (
+    iOSPreprocessingResult,
+)
+from .icon_hash_matrix import ICON_HASH_TYPES, get_packed_icon_hashes, hamming_similarities
+from .comparators import SCORE_CUTOFF_TOLERANCE
+from .matchers import match_app_id, match_app_name, match_developer, match_icon_hash
+from .related_work_matchers import (
+    HU_DEVELOPER_WEIGHT,
+    HU_MIN_SIMILARITY,
+    HU_TITLE_WEIGHT,
+    hu_score,
+    hu_similarity_match,
+)
+
+
+def _max_string_similarity(
+    ios_strings: list[str], android_strings: list[str], workers: int
+) -> numpy.ndarray:
+    """
+    Vectorized max(1 - shared prefix distance, 1 - levenshtein distance) on
+    already lowercased strings.
+    """
+    shared_prefix = cdist(
+        ios_strings,
+        android_strings,
+        scorer=Prefix.normalized_distance,
+        dtype=numpy.float64,
+        workers=workers,
+    )
+    numpy.subtract(1, shared_prefix, out=shared_prefix)
+    levenshtein_dist = cdist(
+        ios_strings,
+        android_strings,
+        scorer=Levenshtein.normalized_distance,
+        dtype=numpy.float64,
+        workers=workers,
+    )
+    numpy.subtract(1, levenshtein_dist, out=levenshtein_dist)
+    return numpy.maximum(shared_prefix, levenshtein_dist, out=shared_prefix)
+
+
+def batch_match_developer(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    workers: int = 1,
+) -> dict[str, numpy.ndarray]:
+    devs1 = [ios_app.metadata.get("developer_name", "").lower() for ios_app in ios_apps]
+    devs2 = [
+        android_app.metadata.get("developer_name", "").lower()
+        for android_app in android_apps
+    ]
+    return {"developer_max": _max_string_similarity(devs1, devs2, workers)}
+
+
+def batch_match_app_id(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    workers: int = 1,
+) -> dict[str, numpy.ndarray]:
+    app_ids1 = [ios_app.app_id.removeprefix(".").lower() for ios_app in ios_apps]
+    app_ids2 = [
+        android_app.app_id.removeprefix(".").lower() for android_app in android_apps
+    ]
+    return {"app_id_max": _max_string_similarity(app_ids1, app_ids2, workers)}
+
+
+def batch_match_app_name(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    workers: int = 1,
+) -> dict[str, numpy.ndarray]:
+    names1 = [ios_app.metadata.get("name", "").lower() for ios_app in ios_apps]
+    names2 = [
+        android_app.metadata.get("app_name", "").lower() for android_app in android_apps
+    ]
+    return {"app_name_max": _max_string_similarity(names1, names2, workers)}
+
+
+def batch_match_icon_hash(
+    ios_indexes: list[int], android_indexes: list[int]
+) -> dict[str, numpy.ndarray]:
+    """
+    Uses the hashes packed by prepare_image_hashes. Like match_icon_hash, hash types
+    missing for one of the apps are left out, pairs without any common hash score 0.
+    """
+    packed = get_packed_icon_hashes()
+    if packed is None:
+        raise RuntimeError("Icon hashes have not been packed by prepare_image_hashes")
+    packed_ios = packed["ios"]
+    packed_android = packed["android"]
+
+    max_score = numpy.zeros((len(ios_indexes), len(android_indexes)))
+    for which in ICON_HASH_TYPES:
+        similarities = hamming_similarities(
+            packed_ios[which][ios_indexes],
+            packed_android[which][android_indexes],
+            packed_ios[which + "_bits"],
+        )
+        # Similarities are >= 0, so missing hashes can't exceed the other types
+        similarities[
+            packed_ios[which + "_missing"][ios_indexes][:, None]
+            | packed_android[which + "_missing"][android_indexes][None, :]
+        ] = 0
+        numpy.maximum(max_score, similarities, out=max_score)
+    return {"icon_hash_max": max_score}
+
+
+def batch_hu_similarity_match(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    workers: int = 1,
+) -> dict[str, numpy.ndarray]:
+    """
+    Uses the strings prepared by prepare_hu_strings. Pairs with equal titles and
+    developer names are found by a hash join, the upper bounds of all other pairs (see
+    hu_upper_bound) are calculated with cdist, and the exact difflib similarity only
+    for the pairs whose bound exceeds the threshold.
+    """
+    ios_titles = [ios_app.metadata.get("name_hu", "") for ios_app in ios_apps]
+    ios_developers = [ios_app.metadata.get("developer_name_hu", "") for ios_app in ios_apps]
+    android_titles = [android_app.metadata.get("app_name_hu", "") for android_app in android_apps]
+    android_developers = [
+        android_app.metadata.get("developer_name_hu", "") for android_app in android_apps
+    ]
+
+    upper_bounds = cdist(
+        ios_titles,
+        android_titles,
+        scorer=Indel.normalized_similarity,
+        dtype=numpy.float64,
+        workers=workers,
+    )
+    upper_bounds *= HU_TITLE_WEIGHT
+    upper_bounds += HU_DEVELOPER_WEIGHT * cdist(
+        ios_developers,
+        android_developers,
+        scorer=Indel.normalized_similarity,
+        dtype=numpy.float64,
+        workers=workers,
+    )
+    scored = upper_bounds >= HU_MIN_SIMILARITY - SCORE_CUTOFF_TOLERANCE
+
+    max_score = numpy.zeros((len(ios_apps), len(android_apps)))
+    android_columns: dict[tuple[str, str], list[int]] = {}
+    for column, key in enumerate(zip(android_titles, android_developers)):
+        android_columns.setdefault(key, []).append(column)
+    for row, key in enumerate(zip(ios_titles, ios_developers)):
+        columns = android_columns.get(key)
+        if columns is not None:
+            max_score[row, columns] = 1.0
+            scored[row, columns] = False
+
+    for row, column in zip(*numpy.nonzero(scored)):
+        max_score[row, column] = hu_score(
+            ios_titles[row], android_titles[column], ios_developers[row], android_developers[column]
+        )
+    return {"hu_similarity_match": max_score}
+
+
+# Maps the pairwise matchers to their batch versions
+BATCH_MATCHERS: dict[Callable, Callable[..., dict[str, numpy.ndarray]]] = {
+    match_developer: batch_match_developer,
+    match_app_id: batch_match_app_id,
+    match_app_name: batch_match_app_name,
+    match_icon_hash: batch_match_icon_hash,
+    hu_similarity_match: batch_hu_similarity_match,
+}
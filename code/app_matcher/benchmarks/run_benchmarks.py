@@ -0,0 +1,295 @@
+"""
+Scaling benchmark of the matching pipeline on synthetic corpora (see
+synthetic_corpus.py). It runs without MongoDB: the apps are generated in memory and
+the matches are written to a file sink in a temporary directory.
+
+For each corpus size (apps per store), the same stages as match_all_documents run in
+a separate process, so the peak memory of each size is measured on its own. The
+report is JSON with, per size:
+- "stages": wall time in seconds of corpus generation, each preparation, blocking,
+  compaction, matching and the cleanups,
+- "pairs" / "pairs_per_second": scored pairs and throughput of the matching stage,
+- "matchers": pairs per second of each pairwise matcher, measured in the benchmark
+  process on a random sample of pairs,
+- "peak_rss_mb": peak resident memory of the benchmark process and of the largest
+  worker process,
+- "matcher_profile": with --profile-matchers, the calls and time of each matcher
+  during the matching stage (see profiling.py).
+
+> Usage:
+> ```sh
+> python -m app_matcher.benchmarks.run_benchmarks --sizes 1000 10000 50000 --blocking --description-top-k 100 --output benchmark.json
+> ```
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional
+
+from app_matcher.async_writer import WriterOptions
+from app_matcher.benchmarks.synthetic_corpus import CorpusOptions, generate_corpus
+from app_matcher.blocking import build_candidates
+from app_matcher.corpus import compact_apps
+from app_matcher.matcher_registry import compile_call_plan
+from app_matcher.matchers import (
+    ALL_CLEANUPS,
+    ALL_INDEXED_MATCHERS,
+    ALL_MATCHERS,
+    ALL_PREPARES,
+)
+from app_matcher.profiling import merge_profiles, profile_summary
+from app_matcher.result_sinks import RESULT_SINKS
+from app_matcher.threaded_matcher import _safe_call, match_all
+from app_matcher.tf_idf.tf_idf_shared_memory import DTYPES
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+
+
+@dataclass(kw_only=True)
+class BenchmarkOptions:
+    threads: int = max((os.cpu_count() or 1) - 2, 1)
+    blocking: bool = False
+    vectorized: bool = False
+    cascade: bool = False
+    top_k: Optional[int] = None
+    min_score: Optional[float] = None
+    description_top_k: Optional[int] = None
+    description_dtype: str = "float64"
+    sink: str = "jsonl"
+    pair_ratio: float = 0.3
+    seed: int = 0
+    # Pairs per matcher of the matcher throughput measurement
+    matcher_sample_pairs: int = 2000
+    profile_matchers: bool = False
+
+
+def _peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+@contextmanager
+def _stage(stages: dict[str, float], name: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = round(time.perf_counter() - started_at, 3)
+        print(f"[Benchmark] {name}: {stages[name]:.1f}s")
+
+
+def _matcher_throughput(
+    ios_apps: list,
+    android_apps: list,
+    matchers: list[Callable],
+    index_matchers: list[Callable],
+    sample_pairs: int,
+    seed: int,
+) -> dict[str, float]:
+    """
+    Pairs per second of each matcher on the same random sample of pairs.
+    """
+    rng = random.Random(seed)
+    pairs = [
+        (rng.randrange(len(ios_apps)), rng.randrange(len(android_apps)))
+        for _ in range(sample_pairs)
+    ]
+    pairs = [
+        (ios_apps[ios_index], android_apps[android_index], ios_index, android_index)
+        for ios_index, android_index in pairs
+    ]
+    throughput = {}
+    for step in compile_call_plan(matchers, index_matchers).steps:
+        started_at = time.perf_counter()
+        for pair in pairs:
+            step.matcher(*step.arguments(pair))
+        elapsed = max(time.perf_counter() - started_at, 1e-9)
+        throughput[step.matcher.__name__] = round(len(pairs) / elapsed, 1)
+    return throughput
+
+
+def run_benchmark(size: int, options: BenchmarkOptions) -> dict:
+    """
+    Run all stages of the pipeline on a synthetic corpus of "size" apps per store.
+    """
+    stages: dict[str, float] = {}
+    with _stage(stages, "generate"):
+        ios_apps, android_apps = generate_corpus(
+            CorpusOptions(
+                ios_apps=size,
+                android_apps=size,
+                pair_ratio=options.pair_ratio,
+                seed=options.seed,
+            )
+        )
+
+    prepare_args = {
+        "ios_apps": ios_apps,
+        "android_apps": android_apps,
+        "description_top_k": options.description_top_k,
+        "description_dtype": options.description_dtype,
+        "threads": options.threads,
+    }
+    try:
+        for prepare in ALL_PREPARES:
+            with _stage(stages, f"prepare:{prepare.__name__}"):
+                _safe_call(prepare, prepare_args)
+
+        candidates = None
+        if options.blocking:
+            with _stage(stages, "blocking"):
+                candidates = build_candidates(ios_apps, android_apps)
+
+        with _stage(stages, "compact"):
+            ios_apps = compact_apps(ios_apps)
+            android_apps = compact_apps(android_apps)
+        prepare_args = None
+
+        matchers = _matcher_throughput(
+            ios_apps,
+            android_apps,
+            ALL_MATCHERS,
+            ALL_INDEXED_MATCHERS,
+            options.matcher_sample_pairs,
+            options.seed,
+        )
+
+        with tempfile.TemporaryDirectory(prefix="xpa-benchmark-") as output_dir:
+            with _stage(stages, "match"):
+                unit_stats = match_all(
+                    ios_apps=ios_apps,
+                    android_apps=android_apps,
+                    matches_coll_name="matches",
+                    threads=options.threads,
+                    candidates=candidates,
+                    vectorized=options.vectorized,
+                    top_k=options.top_k,
+                    min_score=options.min_score,
+                    result_sink=options.sink,
+                    output_dir=output_dir,
+                    writer_options=WriterOptions(),
+                    cascade=options.cascade,
+                    profile_matchers=options.profile_matchers,
+                )
+    finally:
+        with _stage(stages, "cleanup"):
+            for cleanup in ALL_CLEANUPS:
+                cleanup()
+
+    pairs = sum(stats.pairs for stats in unit_stats)
+    result = {
+        "size": size,
+        "pairs": pairs,
+        "pairs_per_second": round(pairs / max(stages["match"], 1e-9), 1),
+        "stages": stages,
+        "matchers": matchers,
+        "peak_rss_mb": {
+            "main": round(_peak_rss_mb(resource.RUSAGE_SELF), 1),
+            "largest_worker": round(_peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+        },
+    }
+    if options.profile_matchers:
+        result["matcher_profile"] = profile_summary(
+            merge_profiles([stats.profile for stats in unit_stats])
+        )
+    return result
+
+
+def _run_benchmark_process(size: int, options: BenchmarkOptions, connection) -> None:
+    try:
+        connection.send(run_benchmark(size, options))
+    except Exception as err:
+        connection.send({"size": size, "error": repr(err)})
+        raise
+    finally:
+        connection.close()
+
+
+def run_benchmarks(sizes: list[int], options: BenchmarkOptions) -> dict:
+    """
+    Run the benchmark of each size in its own process.
+    """
+    results = []
+    for size in sizes:
+        print(f"[Benchmark] Running with {size} apps per store")
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_run_benchmark_process, args=(size, options, sender)
+        )
+        process.start()
+        sender.close()
+        try:
+            results.append(receiver.recv())
+        except EOFError:
+            results.append({"size": size, "error": f"exit code {process.exitcode}"})
+        process.join()
+    return {
+        "options": asdict(options),
+        "machine": {
+            "cpus": os.cpu_count(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    args_parser = ArgumentParser(description="Benchmark the matching pipeline on synthetic corpora")
+    args_parser.add_argument(
+        "--sizes",
+        help=f"Numbers of apps per store to benchmark. Defaults to {DEFAULT_SIZES}. The full cross product of larger sizes needs --blocking and --description-top-k.",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+    )
+    args_parser.add_argument("--threads", type=int, default=BenchmarkOptions.threads)
+    args_parser.add_argument("--blocking", action="store_true")
+    args_parser.add_argument("--vectorized", action="store_true")
+    args_parser.add_argument("--cascade", action="store_true")
+    args_parser.add_argument("--top-k", type=int, default=None)
+    args_parser.add_argument("--min-score", type=float, default=None)
+    args_parser.add_argument("--description-top-k", type=int, default=None)
+    args_parser.add_argument("--description-dtype", choices=list(DTYPES), default="float64")
+    args_parser.add_argument("--sink", choices=[sink for sink in RESULT_SINKS if sink != "mongo"], default="jsonl")
+    args_parser.add_argument("--pair-ratio", type=float, default=0.3, help="Share of the iOS apps with an Android counterpart.")
+    args_parser.add_argument("--seed", type=int, default=0)
+    args_parser.add_argument("--matcher-sample-pairs", type=int, default=2000)
+    args_parser.add_argument("--profile-matchers", action="store_true", help="Profile the matchers during the matching stage.")
+    args_parser.add_argument("--output", help="File to write the JSON report to, printed if not given.", default=None)
+    args = args_parser.parse_args()
+
+    report = run_benchmarks(
+        args.sizes,
+        BenchmarkOptions(
+            threads=args.threads,
+            blocking=args.blocking,
+            vectorized=args.vectorized,
+            cascade=args.cascade,
+            top_k=args.top_k,
+            min_score=args.min_score,
+            description_top_k=args.description_top_k,
+            description_dtype=args.description_dtype,
+            sink=args.sink,
+            pair_ratio=args.pair_ratio,
+            seed=args.seed,
+            matcher_sample_pairs=args.matcher_sample_pairs,
+            profile_matchers=args.profile_matchers,
+        ),
+    )
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+        print(f"[Benchmark] Report written to {args.output}")
@@ -0,0 +1,362 @@
+"""
+Synthetic app corpora of any size, generated from the sample apps in data/ (see
+run_benchmarks.py).
+
+Each synthetic app copies the bookkeeping fields of a sample app of its store and
+gets a new identity: name, developer, app id, URLs, deep links, icon hashes and a
+description mixed from the sentences of the sample descriptions. A share of the iOS
+apps has a counterpart in the Android corpus, which is derived from the same product
+with the variations seen between the stores (store specific name suffixes, developer
+legal forms, a few flipped icon hash bits, partly rewritten descriptions). Some apps
+share boilerplate descriptions. The corpus only depends on the options, so runs with
+the same seed are comparable.
+
+> Usage:
+> ```sh
+> python -m app_matcher.benchmarks.synthetic_corpus --ios-apps 10000 --android-apps 10000 --output-dir ./corpus
+> ```
+> writes ios.json and android.json, which can be imported with `mongoimport --jsonArray`.
+"""
+import copy
+import os
+import random
+import re
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import Optional
+
+from bson import ObjectId, json_util
+
+from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
+    AndroidPreprocessingResult,
+)
+from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios_preprocessing_result import (
+    iOSPreprocessingResult,
+)
+
+SAMPLE_DIR = "../data"  # relative to xpa
+IOS_SAMPLES = "test-apps-ios.json"
+ANDROID_SAMPLES = "test-apps-android.json"
+
+# Fields of the sample apps that are copied to all synthetic apps
+BOOKKEEPING_FIELDS = ["run_id", "path", "tool", "created_at", "analysis_type", "os"]
+
+_SYLLABLES = [
+    "ka", "lo", "mi", "ra", "ton", "zen", "vi", "po", "fy", "lux", "ne", "dor", "sa",
+    "qui", "bel", "tri", "mo", "ga", "rix", "pel", "su", "van", "ko", "ly", "ter",
+]
+_LEGAL_FORMS = ["", " AB", " GmbH", " Inc.", " Ltd", " LLC", " SE", " Limited"]
+_TOP_LEVEL_DOMAINS = ["com", "de", "io", "app", "net", "co.uk"]
+_SCHEME_SUFFIXES = ["", "-auth", "app", "-action", "external"]
+_LINK_SUBDOMAINS = ["www", "open", "link", "app", "share", "m"]
+_LANGUAGES = ["de", "en", "fr", "es"]
+
+
+@dataclass(kw_only=True)
+class CorpusOptions:
+    ios_apps: int
+    android_apps: int
+    # Share of the iOS apps that have a counterpart in the Android corpus
+    pair_ratio: float = 0.3
+    # Share of the apps with one of a few boilerplate descriptions
+    boilerplate_ratio: float = 0.05
+    seed: int = 0
+    # Copy all fields of the sample apps (certificates, frameworks, raw plist data,
+    # ...), not only the ones the matchers read
+    full_documents: bool = False
+
+
+@dataclass(kw_only=True)
+class _Product:
+    brand: str
+    tagline: str
+    developer: str
+    domain: str
+    schemes: list[str]
+    link_hosts: list[str]
+    icon: Optional[dict]
+    sentences: list[str]
+    language: str
+
+
+def load_samples(path: str) -> list[dict]:
+    with open(path, "r") as fp:
+        return json_util.loads(fp.read())
+
+
+def _sample_texts(samples: list[dict]) -> list[str]:
+    texts = []
+    for sample in samples:
+        description = (sample.get("metadata") or {}).get("description") or ""
+        if isinstance(description, list):
+            texts.extend(description)
+        else:
+            texts.append(description)
+    return texts
+
+
+def _sentences(texts: list[str]) -> list[str]:
+    sentences = []
+    for text in texts:
+        for sentence in re.split(r"<br>|\n|(?<=[.!?])\s+", text):
+            sentence = sentence.strip(" •\t")
+            if len(sentence) >= 20:
+                sentences.append(sentence)
+    return sentences
+
+
+def _words(texts: list[str]) -> list[str]:
+    return sorted({word for text in texts for word in re.findall(r"[^\W\d_]{4,}", text)})
+
+
+def _hex_hash(rng: random.Random, bits: int = 64) -> str:
+    return f"{rng.getrandbits(bits):0{bits // 4}x}"
+
+
+def _flip_bits(rng: random.Random, hex_hash: str, flips: int) -> str:
+    bits = len(hex_hash) * 4
+    value = int(hex_hash, 16)
+    for bit in rng.sample(range(bits), flips):
+        value ^= 1 << bit
+    return f"{value:0{len(hex_hash)}x}"
+
+
+def _icon(rng: random.Random) -> dict:
+    return {
+        "path": "synthetic",
+        "ahash": _hex_hash(rng),
+        "phash": _hex_hash(rng),
+        "whash": _hex_hash(rng),
+        "crhash": ",".join(_hex_hash(rng) for _ in range(rng.randint(1, 5))),
+    }
+
+
+def _similar_icon(rng: random.Random, icon: Optional[dict]) -> Optional[dict]:
+    if icon is None:
+        return None
+    similar = {"path": "synthetic"}
+    for which in ("ahash", "phash", "whash"):
+        similar[which] = _flip_bits(rng, icon[which], rng.randint(0, 8))
+    similar["crhash"] = ",".join(
+        _flip_bits(rng, segment, rng.randint(0, 4)) for segment in icon["crhash"].split(",")
+    )
+    return similar
+
+
+def _brand(rng: random.Random, used_brands: set[str]) -> str:
+    while True:
+        brand = "".join(rng.choices(_SYLLABLES, k=rng.randint(2, 4))).title()
+        if rng.random() < 0.2:
+            brand += " " + "".join(rng.choices(_SYLLABLES, k=2)).title()
+        if brand not in used_brands:
+            used_brands.add(brand)
+            return brand
+
+
+def _product(
+    rng: random.Random, used_brands: set[str], words: list[str], sentences: list[str]
+) -> _Product:
+    brand = _brand(rng, used_brands)
+    slug = re.sub(r"\W", "", brand.lower())
+    domain = f"{slug}.{rng.choice(_TOP_LEVEL_DOMAINS)}"
+    return _Product(
+        brand=brand,
+        tagline=" ".join(word.title() for word in rng.sample(words, rng.randint(0, 3))),
+        developer=(brand if rng.random() < 0.6 else _brand(rng, used_brands))
+        + rng.choice(_LEGAL_FORMS),
+        domain=domain,
+        schemes=[slug + suffix for suffix in rng.sample(_SCHEME_SUFFIXES, rng.randint(0, 3))]
+        + [f"fb{rng.randrange(10**11, 10**12)}" for _ in range(rng.randint(0, 1))],
+        link_hosts=[f"{subdomain}.{domain}" for subdomain in rng.sample(_LINK_SUBDOMAINS, rng.randint(0, 4))],
+        icon=None if rng.random() < 0.05 else _icon(rng),
+        sentences=rng.sample(sentences, min(len(sentences), rng.randint(3, 15))),
+        language=rng.choice(_LANGUAGES),
+    )
+
+
+def _counterpart(
+    rng: random.Random, product: _Product, words: list[str], sentences: list[str]
+) -> _Product:
+    """
+    The same product as published in the other store.
+    """
+    kept_sentences = [sentence for sentence in product.sentences if rng.random() < 0.7]
+    developer = product.developer
+    if rng.random() < 0.3:
+        developer = developer.rsplit(" ", 1)[0] if " " in developer else developer + rng.choice(_LEGAL_FORMS)
+    return _Product(
+        brand=product.brand,
+        tagline=product.tagline
+        if rng.random() < 0.6
+        else " ".join(word.title() for word in rng.sample(words, rng.randint(0, 3))),
+        developer=developer,
+        domain=product.domain,
+        schemes=[scheme for scheme in product.schemes if rng.random() < 0.7],
+        link_hosts=[host for host in product.link_hosts if rng.random() < 0.7],
+        icon=_similar_icon(rng, product.icon),
+        sentences=kept_sentences + rng.sample(sentences, min(len(sentences), rng.randint(0, 4))),
+        language=product.language,
+    )
+
+
+def _name(product: _Product) -> str:
+    return f"{product.brand}: {product.tagline}" if product.tagline else product.brand
+
+
+def _document(rng: random.Random, template: dict, full_documents: bool) -> dict:
+    if full_documents:
+        document = copy.deepcopy(template)
+    else:
+        document = {field: copy.deepcopy(template[field]) for field in BOOKKEEPING_FIELDS if field in template}
+    document["_id"] = ObjectId(rng.randbytes(12))
+    document["app_hash"] = _hex_hash(rng, 256)
+    return document
+
+
+def _ios_document(
+    rng: random.Random, template: dict, product: _Product, description: list[str], full_documents: bool
+) -> dict:
+    document = _document(rng, template, full_documents)
+    slug = re.sub(r"\W", "", product.brand.lower())
+    document["app_id"] = f"com.{product.domain.split('.')[0]}.{rng.choice([slug, 'client', 'app', 'ios'])}"
+    document["metadata"] = (copy.deepcopy(template.get("metadata")) if full_documents else None) or {}
+    document["metadata"].update(
+        {
+            "name": _name(product),
+            "developer_name": product.developer,
+            "description": description,
+            "description_language": product.language,
+            "urls": [
+                {"link": f"https://www.{product.domain}/", "link_name": "Website des Entwicklers"},
+                {"link": f"https://support.{product.domain}/", "link_name": "App-Support"},
+                {"link": f"https://www.{product.domain}/legal/privacy-policy/", "link_name": "Datenschutzrichtlinie"},
+            ],
+        }
+    )
+    document["plist"] = (copy.deepcopy(template.get("plist")) if full_documents else None) or {}
+    document["plist"]["custom_url_schemes"] = [
+        [
+            {"CFBundleURLName": f"com.{product.domain.split('.')[0]}.{index}", "CFBundleURLSchemes": [scheme]}
+            for index, scheme in enumerate(product.schemes)
+        ]
+    ]
+    document["entitlements"] = (copy.deepcopy(template.get("entitlements")) if full_documents else None) or {}
+    document["entitlements"]["universal_links"] = [f"applinks:{host}" for host in product.link_hosts]
+    document["icon"] = copy.deepcopy(product.icon)
+    return document
+
+
+def _android_document(
+    rng: random.Random, template: dict, product: _Product, description: str, full_documents: bool
+) -> dict:
+    document = _document(rng, template, full_documents)
+    slug = re.sub(r"\W", "", product.brand.lower())
+    document["app_id"] = f"com.{product.domain.split('.')[0]}.{rng.choice([slug, 'android', 'app', 'music', 'mobile'])}"
+    document["metadata"] = (copy.deepcopy(template.get("metadata")) if full_documents else None) or {}
+    document["metadata"].update(
+        {
+            "app_name": _name(product),
+            "developer_name": product.developer,
+            "description": description,
+            "description_language": product.language,
+            "urls": {
+                "developer_website": f"https://www.{product.domain}",
+                "privacy_policies": None if rng.random() < 0.1 else f"https://www.{product.domain}/legal/privacy-policy/",
+                "developer_email": f"support@{product.domain}",
+                "developer_email_domain": product.domain,
+            },
+        }
+    )
+    document["apk_info"] = (copy.deepcopy(template.get("apk_info")) if full_documents else None) or {}
+    document["apk_info"]["intent_filters"] = {
+        "custom_schemes": list(product.schemes),
+        "app_links": list(product.link_hosts),
+    }
+    document["icon"] = copy.deepcopy(product.icon)
+    return document
+
+
+def generate_documents(
+    options: CorpusOptions, sample_dir: str = SAMPLE_DIR
+) -> tuple[list[dict], list[dict]]:
+    """
+    The iOS and Android app documents of the corpus, as stored in the collections.
+    """
+    ios_samples = load_samples(os.path.join(sample_dir, IOS_SAMPLES))
+    android_samples = load_samples(os.path.join(sample_dir, ANDROID_SAMPLES))
+    texts = _sample_texts(ios_samples) + _sample_texts(android_samples)
+    sentences = _sentences(texts)
+    words = _words(texts)
+    rng = random.Random(options.seed)
+    boilerplates = [" ".join(rng.sample(sentences, min(len(sentences), 5))) for _ in range(5)]
+    used_brands: set[str] = set()
+
+    def description(product: _Product) -> list[str]:
+        if rng.random() < options.boilerplate_ratio:
+            return [rng.choice(boilerplates)]
+        return [_name(product), *product.sentences]
+
+    ios_products = [_product(rng, used_brands, words, sentences) for _ in range(options.ios_apps)]
+    android_products = [
+        _counterpart(rng, product, words, sentences)
+        for product in ios_products[: min(int(options.ios_apps * options.pair_ratio), options.android_apps)]
+    ]
+    android_products += [
+        _product(rng, used_brands, words, sentences)
+        for _ in range(options.android_apps - len(android_products))
+    ]
+    # Counterparts are spread over the Android corpus, as in the stores
+    rng.shuffle(android_products)
+
+    ios_documents = [
+        _ios_document(
+            rng, ios_samples[index % len(ios_samples)], product, description(product), options.full_documents
+        )
+        for index, product in enumerate(ios_products)
+    ]
+    android_documents = [
+        _android_document(
+            rng,
+            android_samples[index % len(android_samples)],
+            product,
+            "<br>".join(description(product)),
+            options.full_documents,
+        )
+        for index, product in enumerate(android_products)
+    ]
+    return ios_documents, android_documents
+
+
+def generate_corpus(
+    options: CorpusOptions, sample_dir: str = SAMPLE_DIR
+) -> tuple[list[iOSPreprocessingResult], list[AndroidPreprocessingResult]]:
+    ios_documents, android_documents = generate_documents(options, sample_dir)
+    return (
+        [iOSPreprocessingResult(**document) for document in ios_documents],
+        [AndroidPreprocessingResult(**document) for document in android_documents],
+    )
+
+
+if __name__ == "__main__":
+    args_parser = ArgumentParser(description="Generate a synthetic app corpus from the sample apps")
+    args_parser.add_argument("--ios-apps", type=int, required=True)
+    args_parser.add_argument("--android-apps", type=int, required=True)
+    args_parser.add_argument("--pair-ratio", type=float, default=0.3, help="Share of the iOS apps with an Android counterpart.")
+    args_parser.add_argument("--seed", type=int, default=0)
+    args_parser.add_argument("--output-dir", required=True, help="Directory to write ios.json and android.json to.")
+    args = args_parser.parse_args()
+
+    ios_documents, android_documents = generate_documents(
+        CorpusOptions(
+            ios_apps=args.ios_apps,
+            android_apps=args.android_apps,
+            pair_ratio=args.pair_ratio,
+            seed=args.seed,
+            full_documents=True,
+        )
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    for file_name, documents in (("ios.json", ios_documents), ("android.json", android_documents)):
+        with open(os.path.join(args.output_dir, file_name), "w") as fp:
+            fp.write(json_util.dumps(documents))
+        print(f"Wrote {len(documents)} apps to {os.path.join(args.output_dir, file_name)}")
@@ -0,0 +1,294 @@
+"""
+Candidate blocking for the matcher.
+
+Instead of scoring every iOS app against every Android app, all apps are indexed
+by a few cheap keys (app id tokens, URL hostnames, developer name tokens and icon
+hash prefixes). Only pairs sharing at least one key are passed on to the matchers.
+"""
+import csv
+import glob
+import io
+import json
+import os
+import re
+import zipfile
+from dataclasses import dataclass
+from typing import Iterable, Optional
+from urllib.parse import urlparse
+
+from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
+    AndroidPreprocessingResult,
+)
+from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios_preprocessing_result import (
+    iOSPreprocessingResult,
+)
+
+WORD_LIST_DIR = "./app_matcher/stop_word_lists"  # relative to xpa
+
+# Tokens that occur in almost every app id and therefore do not help to find candidates
+APP_ID_STOP_TOKENS = {
+    "com", "de", "net", "org", "at", "ch", "co", "io", "www",
+    "app", "apps", "ios", "iphone", "ipad", "android", "mobile",
+}
+# Legal forms that are part of many developer names
+DEVELOPER_STOP_TOKENS = {
+    "gmbh", "mbh", "ag", "kg", "ug", "ohg", "inc", "ltd", "llc", "llp", "corp",
+    "corporation", "company", "limited", "co", "ab", "as", "sa", "sas", "srl",
+    "spa", "bv", "nv", "oy", "pty", "plc", "gbr", "ev",
+}
+ICON_HASHES = ("ahash", "phash", "whash")
+
+_TOKEN_SPLIT = re.compile(r"[^\w]+")
+
+BlockingKey = tuple[str, str]
+
+
+def _load_stop_words() -> set[str]:
+    stop_words = set()
+    for file in glob.glob(os.path.join(WORD_LIST_DIR, "*")):
+        if file.endswith("README"):
+            continue
+        with open(file, "r") as fp:
+            for word in fp.readlines():
+                stop_words.add(word.strip())
+    return stop_words
+
+
+def app_id_tokens(app_id: str) -> set[str]:
+    tokens = _TOKEN_SPLIT.split(app_id.lower())
+    return {
+        token
+        for token in tokens
+        if len(token) > 2 and token not in APP_ID_STOP_TOKENS
+    }
+
+
+def url_hostname(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
+    try:
+        hostname = urlparse(url).hostname
+    except ValueError:
+        # Malformed URL, e.g. "http://[abc/privacy"
+        return None
+    if hostname is None:
+        return None
+    return hostname.removeprefix("www.")
+
+
+def developer_tokens(developer_name: Optional[str], stop_words: set[str]) -> set[str]:
+    if not developer_name:
+        return set()
+    tokens = _TOKEN_SPLIT.split(developer_name.lower())
+    return {
+        token
+        for token in tokens
+        if len(token) > 1
+        and token not in DEVELOPER_STOP_TOKENS
+        and token not in stop_words
+    }
+
+
+def icon_hash_prefixes(icon: Optional[dict], prefix_length: int) -> set[BlockingKey]:
+    if icon is None:
+        return set()
+    prefixes = set()
+    for which in ICON_HASHES:
+        value = icon.get(which)
+        if value is None:
+            continue
+        # Works for both the hex strings and the parsed ImageHash objects
+        prefixes.add((which, str(value)[:prefix_length]))
+    return prefixes
+
+
+def _ios_url(ios_app: iOSPreprocessingResult, link_names: Iterable[str]) -> str:
+    url1 = ""
+    for url in ios_app.metadata.get("urls") or []:
+        link_name = (url.get("link_name") or "").lower()
+        if any(name in link_name for name in link_names):
+            url1 = url.get("link", "") or ""
+    return url1
+
+
+def ios_blocking_keys(
+    ios_app: iOSPreprocessingResult, stop_words: set[str], icon_prefix_length: int
+) -> set[BlockingKey]:
+    keys = {("app_id", token) for token in app_id_tokens(ios_app.app_id)}
+    for url in (
+        _ios_url(ios_app, ("datenschutzrichtlinie", "privacy policy")),
+        _ios_url(ios_app, ("website des entwicklers", "developer website")),
+    ):
+        hostname = url_hostname(url)
+        if hostname is not None:
+            keys.add(("host", hostname))
+    keys |= {
+        ("developer", token)
+        for token in developer_tokens(
+            ios_app.metadata.get("developer_name"), stop_words
+        )
+    }
+    keys |= {
+        ("icon_" + which, prefix)
+        for which, prefix in icon_hash_prefixes(ios_app.icon, icon_prefix_length)
+    }
+    return keys
+
+
+def android_blocking_keys(
+    android_app: AndroidPreprocessingResult,
+    stop_words: set[str],
+    icon_prefix_length: int,
+) -> set[BlockingKey]:
+    keys = {("app_id", token) for token in app_id_tokens(android_app.app_id)}
+    urls = android_app.metadata.get("urls", {}) or {}
+    for url in (urls.get("privacy_policies"), urls.get("developer_website")):
+        hostname = url_hostname(url)
+        if hostname is not None:
+            keys.add(("host", hostname))
+    keys |= {
+        ("developer", token)
+        for token in developer_tokens(
+            android_app.metadata.get("developer_name"), stop_words
+        )
+    }
+    keys |= {
+        ("icon_" + which, prefix)
+        for which, prefix in icon_hash_prefixes(android_app.icon, icon_prefix_length)
+    }
+    return keys
+
+
+def build_candidates(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    max_key_frequency: Optional[int] = 1000,
+    icon_prefix_length: int = 4,
+) -> list[list[int]]:
+    """
+    Build an inverted index over the blocking keys of all Android apps and return,
+    for each iOS app (in order), the sorted indexes of all Android apps sharing at
+    least one key with it. Keys shared by more than "max_key_frequency" Android apps
+    are ignored, as they would match almost everything.
+    """
+    stop_words = _load_stop_words()
+
+    index: dict[BlockingKey, list[int]] = {}
+    for android_index, android_app in enumerate(android_apps):
+        for key in android_blocking_keys(android_app, stop_words, icon_prefix_length):
+            index.setdefault(key, []).append(android_index)
+
+    if max_key_frequency is not None:
+        index = {
+            key: postings
+            for key, postings in index.items()
+            if len(postings) <= max_key_frequency
+        }
+
+    candidates: list[list[int]] = []
+    for ios_app in ios_apps:
+        android_indexes = set()
+        for key in ios_blocking_keys(ios_app, stop_words, icon_prefix_length):
+            android_indexes.update(index.get(key, ()))
+        candidates.append(sorted(android_indexes))
+    return candidates
+
+
+def load_reference_pairs(path: str) -> set[tuple[str, str]]:
+    """
+    Load reference pairs of (ios_id, android_id). Supported are CSV files with a
+    header (optionally zipped), where the "ios_id" and "android_id" columns are used
+    (or the first two columns if they do not exist), and JSON files in the format of
+    "computed_matches_verified.json".
+    """
+    if path.endswith(".json"):
+        with open(path, "r") as fp:
+            return {
+                (entry.get("_id"), entry.get("reference_app"))
+                for entry in json.load(fp)
+            }
+
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            csv_name = next(
+                name for name in archive.namelist() if name.endswith(".csv")
+            )
+            content = archive.read(csv_name).decode("utf-8")
+    else:
+        with open(path, "r") as fp:
+            content = fp.read()
+
+    reader = csv.reader(io.StringIO(content))
+    header = next(reader)
+    if "ios_id" in header and "android_id" in header:
+        ios_column, android_column = header.index("ios_id"), header.index("android_id")
+    else:
+        ios_column, android_column = 0, 1
+    return {(row[ios_column], row[android_column]) for row in reader if row}
+
+
+@dataclass(kw_only=True)
+class BlockingReport:
+    total_pairs: int
+    candidate_pairs: int
+    pruned_pairs: int
+    reference_pairs: Optional[int] = None
+    reference_pairs_found: Optional[int] = None
+    recall: Optional[float] = None
+
+    def print(self) -> None:
+        pruned_ratio = self.pruned_pairs / max(self.total_pairs, 1)
+        print(
+            f"[Blocking] {self.candidate_pairs} candidate pairs out of {self.total_pairs}"
+            f" ({self.pruned_pairs} pruned, {pruned_ratio:.2%})"
+        )
+        if self.recall is not None:
+            print(
+                f"[Blocking] Recall {self.recall:.4f} ({self.reference_pairs_found} of"
+                f" {self.reference_pairs} reference pairs in the corpus are candidates)"
+            )
+
+
+def evaluate_candidates(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    candidates: list[list[int]],
+    reference_pairs: Optional[set[tuple[str, str]]] = None,
+) -> BlockingReport:
+    """
+    Count the pruned pairs and, if reference pairs are given, measure how many of the
+    reference pairs that are part of the corpus survived blocking.
+    """
+    total_pairs = len(ios_apps) * len(android_apps)
+    candidate_pairs = sum(len(android_indexes) for android_indexes in candidates)
+    report = BlockingReport(
+        total_pairs=total_pairs,
+        candidate_pairs=candidate_pairs,
+        pruned_pairs=total_pairs - candidate_pairs,
+    )
+    if reference_pairs is None:
+        return report
+
+    ios_indexes: dict[str, list[int]] = {}
+    for ios_index, ios_app in enumerate(ios_apps):
+        ios_indexes.setdefault(ios_app.app_id, []).append(ios_index)
+    android_indexes: dict[str, list[int]] = {}
+    for android_index, android_app in enumerate(android_apps):
+        android_indexes.setdefault(android_app.app_id, []).append(android_index)
+
+    in_corpus = 0
+    found = 0
+    for ios_id, android_id in reference_pairs:
+        if ios_id not in ios_indexes or android_id not in android_indexes:
+            continue
+        in_corpus += 1
+        if any(
+            set(candidates[ios_index]).intersection(android_indexes[android_id])
+            for ios_index in ios_indexes[ios_id]
+        ):
+            found += 1
+
+    report.reference_pairs = in_corpus
+    report.reference_pairs_found = found
+    report.recall = found / in_corpus if in_corpus > 0 else None
+    return report
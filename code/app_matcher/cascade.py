@@ -0,0 +1,35 @@
+"""
+Cascade scoring of a pair (see _match_ios_to_android_cascade in threaded_matcher.py).
+The matchers run from the cheapest to the most expensive (by the cost declared in
+matcher_registry.py), and after each matcher the highest average score the pair can
+still reach is known, assuming all remaining scores are 1. Pairs whose bound is below
+the score they need to be stored (the min score or the lowest of the current top k)
+are dropped without running the remaining matchers.
+
+Matchers with a "score_cutoff" parameter are told the score they need to reach, and
+may return any lower score instead of the exact one if they fall short of it (e.g.
+rapidfuzz's score_cutoff), as the pair is dropped anyway.
+"""
+from typing import Callable, Iterable
+
+from app_matcher.comparators import SCORE_CUTOFF_TOLERANCE
+from app_matcher.matcher_registry import PlanStep
+
+
+def cascade_order(steps: Iterable[PlanStep], precomputed: Iterable[Callable] = ()) -> list[PlanStep]:
+    """
+    The steps of a call plan from the cheapest to the most expensive. The scores of
+    "precomputed" matchers (e.g. by the batch matchers) are free.
+    """
+    precomputed = set(precomputed)
+    return sorted(
+        steps,
+        key=lambda step: 0 if step.matcher in precomputed else step.cost,
+    )
+
+
+def required_score_sum(min_average_score: float, score_count: int) -> float:
+    """
+    Lowest sum of "score_count" scores a pair must be able to reach to be kept.
+    """
+    return min_average_score * score_count - SCORE_CUTOFF_TOLERANCE
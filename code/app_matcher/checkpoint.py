@@ -0,0 +1,36 @@
+"""
+Progress tracking for matching runs. Every completed work unit records the ids of its
+iOS apps, so an interrupted run can be resumed without recomputing them.
+"""
+from datetime import datetime
+
+from database.db_connector import get_collection
+
+
+def progress_collection_name(matches_coll_name: str) -> str:
+    return f"{matches_coll_name}_progress"
+
+
+def load_completed_ios_ids(progress_coll_name: str) -> set[str]:
+    completed = set[str]()
+    for progress in get_collection(progress_coll_name).find({}, {"ios_ids": 1}):
+        completed.update(progress.get("ios_ids", []))
+    return completed
+
+
+def mark_completed(progress_coll_name: str, ios_ids: list[str]) -> None:
+    get_collection(progress_coll_name).insert_one(
+        {"ios_ids": ios_ids, "finished_at": datetime.now()}
+    )
+
+
+def clear_progress(progress_coll_name: str) -> None:
+    get_collection(progress_coll_name).delete_many({})
+
+
+def discard_partial_results(matches_coll_name: str, ios_ids: list[str]) -> None:
+    """
+    Remove the results a previous, interrupted run already stored for a work unit
+    that was not completed, so they are not duplicated when it is run again.
+    """
+    get_collection(matches_coll_name).delete_many({"ios_id": {"$in": ios_ids}})
@@ -1,19 +1,36 @@
 
 
+from typing import Optional
 from urllib.parse import urlparse
 from imagehash import ImageHash, ImageMultiHash
 from rapidfuzz.distance import Prefix, Levenshtein
 
+# Margin of the score cutoffs, so that rounding never cuts off a similarity at the cutoff
+SCORE_CUTOFF_TOLERANCE = 1e-9
+
 def is_same_domain(url1: str, url2: str) -> bool:
     parsedUrl1 = urlparse(url1).hostname
     parsedUrl2 = urlparse(url2).hostname
     return parsedUrl1 == parsedUrl2
 
-def normalized_shared_prefix_length(a: str, b: str) -> float:
-    return Prefix.normalized_distance(a.lower(), b.lower())
-
-def normalized_levenshtein_distance(a: str, b: str) -> float:
-    return Levenshtein.normalized_distance(a.lower(), b.lower())
+def normalized_shared_prefix_length(a: str, b: str, lowercase: bool = True) -> float:
+    # Pass lowercase=False if a and b are already lowercased
+    if lowercase:
+        a, b = a.lower(), b.lower()
+    return Prefix.normalized_distance(a, b)
+
+def normalized_levenshtein_distance(
+    a: str, b: str, lowercase: bool = True, min_similarity: Optional[float] = None
+) -> float:
+    # Distances whose similarity (1 - distance) is below "min_similarity" may be
+    # returned as 1, which lets rapidfuzz stop early
+    if lowercase:
+        a, b = a.lower(), b.lower()
+    if min_similarity is None or min_similarity <= SCORE_CUTOFF_TOLERANCE:
+        return Levenshtein.normalized_distance(a, b)
+    return Levenshtein.normalized_distance(
+        a, b, score_cutoff=min(1 - min_similarity + SCORE_CUTOFF_TOLERANCE, 1.0)
+    )
 
 def deep_link_comparison(a: list, b: list) -> int:
     if len(a) == 0 or len(b) == 0:
@@ -24,6 +41,12 @@ def deep_link_comparison(a: list, b: list) -> int:
 
     return len(set.intersection(a, b))
 
+def deep_link_set_comparison(a: frozenset, b: frozenset) -> int:
+    # Same as deep_link_comparison for values that already are sets
+    if len(a) == 0 or len(b) == 0:
+        return 0
+    return len(a & b)
+
 def hash_compare(a: ImageHash, b: ImageHash) -> float:
     return 1.0-abs(a - b)/max(len(a), len(b))
 
@@ -0,0 +1,93 @@
+"""
+Compact representation of the apps for the matching stage. After the preparations,
+the matchers only read a few fields of each app (ids, icon hashes, names and the
+features of features.py), while the loaded documents also carry certificates,
+frameworks, plist data, permissions and descriptions. compact_apps replaces each app by
+a slotted record with only these fields, with repeated strings interned, so the
+documents can be released before the worker processes start.
+"""
+import sys
+from dataclasses import dataclass, fields, replace
+from typing import Optional
+
+from app_matcher.features import AppFeatures, android_features, ios_features
+from app_matcher.scheduling import target_cost_weight
+from database.analysis_results.preprocessing_result.preprocessing_result import (
+    PreprocessingResult,
+)
+
+# Metadata read by the matchers (and related_work_matchers.py) after the preparations
+MATCHING_METADATA_KEYS = (
+    "name",
+    "app_name",
+    "developer_name",
+    "description_language",
+    "features",
+    "name_hu",
+    "app_name_hu",
+    "developer_name_hu",
+)
+ICON_HASH_KEYS = ("ahash", "phash", "whash", "crhash")
+
+
+@dataclass(kw_only=True, slots=True)
+class MatchingApp:
+    os: str
+    app_id: str
+    app_hash: str
+    # Parsed icon hashes, see prepare_image_hashes
+    icon: Optional[dict]
+    # Only the MATCHING_METADATA_KEYS of the original metadata
+    metadata: Optional[dict]
+    # Of iOS apps, see scheduling.py. The fields it is computed from are dropped
+    cost_weight: Optional[float]
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _compact_features(features: AppFeatures) -> AppFeatures:
+    # Hostnames, developers and URL schemes repeat a lot across the corpus
+    changes = {}
+    for field in fields(features):
+        value = getattr(features, field.name)
+        if type(value) is frozenset:
+            changes[field.name] = frozenset(_intern(item) for item in value)
+        else:
+            changes[field.name] = _intern(value)
+    return replace(features, **changes)
+
+
+def compact_app(app: PreprocessingResult) -> MatchingApp:
+    metadata = app.metadata
+    if metadata is not None:
+        features = metadata.get("features")
+        if features is None:
+            # prepare_features was not run, the source fields are dropped below
+            features = ios_features(app) if app.os == "iOS" else android_features(app)
+        metadata = {
+            _intern(key): _intern(metadata[key])
+            for key in MATCHING_METADATA_KEYS
+            if key in metadata
+        }
+        metadata["features"] = _compact_features(features)
+    icon = app.icon
+    if icon is not None:
+        icon = {key: icon[key] for key in ICON_HASH_KEYS if key in icon}
+    return MatchingApp(
+        os=_intern(app.os),
+        app_id=app.app_id,
+        app_hash=app.app_hash,
+        icon=icon,
+        metadata=metadata,
+        cost_weight=target_cost_weight(app) if app.os == "iOS" else None,
+    )
+
+
+def compact_apps(apps: list[PreprocessingResult]) -> list[MatchingApp]:
+    """
+    Compact all prepared apps, keeping their order (and thus the indexes of the
+    indexed matchers).
+    """
+    return [compact_app(app) for app in apps]
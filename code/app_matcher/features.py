@@ -0,0 +1,173 @@
+"""
+Per-app features of the pairwise matchers, extracted once by prepare_features instead
+of for every pair. The features are stored in metadata["features"], the matchers fall
+back to extracting them on the fly for apps that were not prepared.
+
+If the extraction of a feature fails (e.g. a malformed URL), the error is stored in
+its place and raised again by feature(), so the pairs of the app fail in the matcher
+just like they did before the features were extracted up front.
+"""
+from dataclasses import dataclass
+from typing import Iterable, Optional
+from urllib.parse import urlparse
+
+from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
+    AndroidPreprocessingResult,
+)
+from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios_preprocessing_result import (
+    iOSPreprocessingResult,
+)
+
+PRIVACY_POLICY_LINK_NAMES = ("datenschutzrichtlinie", "privacy policy")
+DEVELOPER_WEBSITE_LINK_NAMES = ("website des entwicklers", "developer website")
+
+
+class FeatureError:
+    __slots__ = ("error",)
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+def feature(value):
+    if isinstance(value, FeatureError):
+        raise value.error
+    return value
+
+
+def _extract(fn, *args):
+    try:
+        return fn(*args)
+    except Exception as err:
+        return FeatureError(err)
+
+
+@dataclass(kw_only=True, slots=True)
+class AppFeatures:
+    # All strings are lowercased, as the comparators ignore the case
+    privacy_url: str
+    # Hostname of the original URL, None for empty URLs
+    privacy_hostname: Optional[str]
+    developer_url: str
+    developer_hostname: Optional[str]
+    name: str
+    developer: str
+    # Without a leading "."
+    app_id: str
+    custom_url_schemes: frozenset[str]
+    app_links: frozenset[str]
+
+
+def _hostname(url) -> Optional[str]:
+    return urlparse(feature(url)).hostname
+
+
+def _lower(value) -> str:
+    return feature(value).lower()
+
+
+def _ios_url(ios_app: iOSPreprocessingResult, link_names: Iterable[str]) -> str:
+    # The last link with a matching name wins
+    url1 = ""
+    for url in ios_app.metadata.get("urls"):
+        link_name = url.get("link_name", "").lower()
+        if any(name in link_name for name in link_names):
+            url1 = url.get("link", "") or ""
+    return url1
+
+
+def _ios_custom_url_schemes(ios_app: iOSPreprocessingResult) -> frozenset[str]:
+    custom_url_schemes = set()
+    for list_item in ios_app.plist.get("custom_url_schemes", []):
+        if list_item is None:
+            continue
+        for item in list_item:
+            if item is None or type(item) is str:
+                continue
+            scheme = item.get("CFBundleURLSchemes", None)
+            if (
+                scheme is not None
+                and scheme != "http"
+                and scheme != "https"
+                and type(scheme) is str
+            ):
+                custom_url_schemes |= set(scheme)
+    return frozenset(custom_url_schemes)
+
+
+def _ios_app_links(ios_app: iOSPreprocessingResult) -> frozenset[str]:
+    return frozenset(
+        entitlement.removeprefix("applinks:").removeprefix("*.").removeprefix("www.")
+        for entitlement in ios_app.entitlements.get("universal_links", [])
+    )
+
+
+def _android_url(android_app: AndroidPreprocessingResult, which: str) -> str:
+    return android_app.metadata.get("urls", {}).get(which, "") or ""
+
+
+def _android_custom_url_schemes(android_app: AndroidPreprocessingResult) -> frozenset[str]:
+    return frozenset(
+        android_app.apk_info.get("intent_filters", {}).get("custom_schemes", [])
+    )
+
+
+def _android_app_links(android_app: AndroidPreprocessingResult) -> frozenset[str]:
+    return frozenset(
+        app_link.removeprefix("*.").removeprefix("www.")
+        for app_link in android_app.apk_info.get("intent_filters", {}).get("app_links", [])
+    )
+
+
+def ios_features(ios_app: iOSPreprocessingResult) -> AppFeatures:
+    privacy_url = _extract(_ios_url, ios_app, PRIVACY_POLICY_LINK_NAMES)
+    developer_url = _extract(_ios_url, ios_app, DEVELOPER_WEBSITE_LINK_NAMES)
+    return AppFeatures(
+        privacy_url=_extract(_lower, privacy_url),
+        privacy_hostname=_extract(_hostname, privacy_url),
+        developer_url=_extract(_lower, developer_url),
+        developer_hostname=_extract(_hostname, developer_url),
+        name=_extract(lambda: ios_app.metadata.get("name", "").lower()),
+        developer=_extract(lambda: ios_app.metadata.get("developer_name", "").lower()),
+        app_id=_extract(lambda: ios_app.app_id.removeprefix(".").lower()),
+        custom_url_schemes=_extract(_ios_custom_url_schemes, ios_app),
+        app_links=_extract(_ios_app_links, ios_app),
+    )
+
+
+def android_features(android_app: AndroidPreprocessingResult) -> AppFeatures:
+    privacy_url = _extract(_android_url, android_app, "privacy_policies")
+    developer_url = _extract(_android_url, android_app, "developer_website")
+    return AppFeatures(
+        privacy_url=_extract(_lower, privacy_url),
+        privacy_hostname=_extract(_hostname, privacy_url),
+        developer_url=_extract(_lower, developer_url),
+        developer_hostname=_extract(_hostname, developer_url),
+        name=_extract(lambda: android_app.metadata.get("app_name", "").lower()),
+        developer=_extract(lambda: android_app.metadata.get("developer_name", "").lower()),
+        app_id=_extract(lambda: android_app.app_id.removeprefix(".").lower()),
+        custom_url_schemes=_extract(_android_custom_url_schemes, android_app),
+        app_links=_extract(_android_app_links, android_app),
+    )
+
+
+def get_ios_features(ios_app: iOSPreprocessingResult) -> AppFeatures:
+    features = ios_app.metadata.get("features")
+    return features if features is not None else ios_features(ios_app)
+
+
+def get_android_features(android_app: AndroidPreprocessingResult) -> AppFeatures:
+    features = android_app.metadata.get("features")
+    return features if features is not None else android_features(android_app)
+
+
+def prepare_features(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+) -> None:
+    for ios_app in ios_apps:
+        if ios_app.metadata is not None:
+            ios_app.metadata["features"] = ios_features(ios_app)
+    for android_app in android_apps:
+        if android_app.metadata is not None:
+            android_app.metadata["features"] = android_features(android_app)
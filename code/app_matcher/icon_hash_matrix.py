@@ -0,0 +1,89 @@
+"""
+Bit-packed icon hashes. Each hash type (ahash, phash, whash) of each platform is
+stored as one uint64 matrix with one row per app, so the hamming similarities of a
+whole tile of apps can be computed at once with XOR and popcount.
+"""
+from typing import Optional
+
+import numpy
+
+ICON_HASH_TYPES = ("ahash", "phash", "whash")
+
+# {"ios" | "android": {"ahash": uint64 (apps x words), "ahash_bits": ..., "ahash_missing": bool (apps,), ...}}
+_packed_icon_hashes: Optional[dict[str, dict[str, object]]] = None
+
+_M1 = numpy.uint64(0x5555555555555555)
+_M2 = numpy.uint64(0x3333333333333333)
+_M4 = numpy.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = numpy.uint64(0x0101010101010101)
+
+
+def _popcount(x: numpy.ndarray) -> numpy.ndarray:
+    if hasattr(numpy, "bitwise_count"):  # numpy >= 2.0
+        return numpy.bitwise_count(x)
+    x = x - ((x >> numpy.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> numpy.uint64(2)) & _M2)
+    x = (x + (x >> numpy.uint64(4))) & _M4
+    return (x * _H01) >> numpy.uint64(56)
+
+
+def pack_icon_hashes(icons: list[Optional[dict]]) -> Optional[dict[str, object]]:
+    """
+    Pack the hex hashes of the given icons (in app order). Apps without an icon or
+    without a hash are marked as missing for that hash type. Returns None if the hashes of
+    one type differ in size, as they cannot be compared in that case.
+    """
+    packed: dict[str, object] = {}
+    for which in ICON_HASH_TYPES:
+        missing = numpy.zeros(len(icons), dtype=bool)
+        hexes = []
+        for app_index, icon in enumerate(icons):
+            hexstr = None if icon is None else icon.get(which)
+            if hexstr is None:
+                missing[app_index] = True
+            hexes.append(None if hexstr is None else str(hexstr))
+
+        hex_lengths = {len(hexstr) for hexstr in hexes if hexstr is not None}
+        if len(hex_lengths) > 1:
+            return None
+        hex_length = hex_lengths.pop() if hex_lengths else 16
+        # Same size as imagehash.hex_to_hash uses
+        hash_size = int(numpy.sqrt(hex_length * 4))
+        words = max((hex_length * 4 + 63) // 64, 1)
+
+        matrix = numpy.zeros((len(icons), words), dtype=numpy.uint64)
+        for app_index, hexstr in enumerate(hexes):
+            if hexstr is None:
+                continue
+            value = int(hexstr, 16)
+            for word in range(words):
+                matrix[app_index, word] = (value >> (64 * word)) & 0xFFFFFFFFFFFFFFFF
+        packed[which] = matrix
+        packed[which + "_bits"] = hash_size * hash_size
+        packed[which + "_missing"] = missing
+    return packed
+
+
+def hamming_similarities(
+    ios_hashes: numpy.ndarray, android_hashes: numpy.ndarray, bits: int
+) -> numpy.ndarray:
+    """
+    Computes 1 - hamming distance / bits for all combinations of the given packed
+    hashes, same as comparators.hash_compare.
+    """
+    xor = ios_hashes[:, None, :] ^ android_hashes[None, :, :]
+    distances = _popcount(xor).sum(axis=2, dtype=numpy.int64)
+    return 1.0 - distances / bits
+
+
+def set_packed_icon_hashes(packed: Optional[dict[str, dict[str, object]]]) -> None:
+    global _packed_icon_hashes
+    _packed_icon_hashes = packed
+
+
+def get_packed_icon_hashes() -> Optional[dict[str, dict[str, object]]]:
+    return _packed_icon_hashes
+
+
+def cleanup_packed_icon_hashes() -> None:
+    set_packed_icon_hashes(None)
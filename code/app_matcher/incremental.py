@@ -0,0 +1,242 @@
+"""
+Incremental matching. After every successful run that stored all of its pairs in the
+matches collection, the app hashes of all matched apps are stored next to the matches,
+together with the options of the run and the vocabulary and idf weights of the fitted
+TF-IDF vectorizer. These are stored as plain arrays rather than a pickle, so the
+collection can't inject code into the matching host. An incremental
+run only scores the iOS apps (rows) and Android apps (columns) that were added or
+changed since then, and removes the results of changed or removed apps. All other
+pairs stay untouched.
+"""
+from dataclasses import dataclass
+from typing import Literal, Optional
+
+from pymongo import ReplaceOne
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from app_matcher.tf_idf.tf_idf_build import fitted_vectorizer
+
+from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
+    AndroidPreprocessingResult,
+)
+from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios_preprocessing_result import (
+    iOSPreprocessingResult,
+)
+from database.analysis_results.preprocessing_result.preprocessing_result import (
+    PreprocessingResult,
+)
+from database.db_connector import get_collection
+
+# Documents with app hashes have an "os" field, the run options and the chunks of the
+# vectorizer are stored in documents with these ids
+_OPTIONS_ID = "options"
+_VECTORIZER_CHUNK_PREFIX = "tf_idf_vectorizer:"
+# Estimated BSON size of the terms of a chunk, stays below the document size limit of
+# MongoDB
+_VECTORIZER_CHUNK_SIZE = 8 * 1024 * 1024
+# Estimated BSON size of a term and its idf weight, besides the term itself
+_VECTORIZER_TERM_OVERHEAD = 32
+
+
+def app_state_collection_name(matches_coll_name: str) -> str:
+    return f"{matches_coll_name}_apps"
+
+
+@dataclass(kw_only=True)
+class AppChanges:
+    # Indexes of new or changed apps
+    ios_indexes: list[int]
+    android_indexes: list[int]
+    # Ids of apps whose results are outdated (changed or removed apps)
+    stale_ios_ids: list[str]
+    stale_android_ids: list[str]
+
+
+def _detect_changes(
+    apps: list[PreprocessingResult],
+    os: Literal["iOS", "Android"],
+    state: dict[tuple[str, str], str],
+) -> tuple[list[int], list[str]]:
+    changed_indexes = []
+    stale_ids = set[str]()
+    current_ids = set[str]()
+    for app_index, app in enumerate(apps):
+        current_ids.add(app.app_id)
+        previous_hash = state.get((os, app.app_id))
+        if previous_hash == app.app_hash:
+            continue
+        changed_indexes.append(app_index)
+        if previous_hash is not None:
+            stale_ids.add(app.app_id)
+    stale_ids |= {
+        app_id
+        for (app_os, app_id) in state.keys()
+        if app_os == os and app_id not in current_ids
+    }
+    return changed_indexes, sorted(stale_ids)
+
+
+def detect_changes(
+    app_state_coll_name: str,
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+) -> AppChanges:
+    """
+    Compare the app hashes of the given apps against the ones stored by the last
+    successful run.
+    """
+    state = {
+        (doc.get("os"), doc.get("app_id")): doc.get("app_hash")
+        for doc in get_collection(app_state_coll_name).find({"os": {"$exists": True}})
+    }
+    ios_indexes, stale_ios_ids = _detect_changes(ios_apps, "iOS", state)
+    android_indexes, stale_android_ids = _detect_changes(android_apps, "Android", state)
+    return AppChanges(
+        ios_indexes=ios_indexes,
+        android_indexes=android_indexes,
+        stale_ios_ids=stale_ios_ids,
+        stale_android_ids=stale_android_ids,
+    )
+
+
+def delete_stale_results(
+    matches_coll_name: str,
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    changes: AppChanges,
+) -> None:
+    """
+    Delete all results involving a changed or removed app, including the results an
+    interrupted incremental run already stored for new apps.
+    """
+    matches_coll = get_collection(matches_coll_name)
+    ios_ids = set(changes.stale_ios_ids) | {
+        ios_apps[ios_index].app_id for ios_index in changes.ios_indexes
+    }
+    android_ids = set(changes.stale_android_ids) | {
+        android_apps[android_index].app_id for android_index in changes.android_indexes
+    }
+    if len(ios_ids) > 0:
+        matches_coll.delete_many({"ios_id": {"$in": list(ios_ids)}})
+    if len(android_ids) > 0:
+        matches_coll.delete_many({"android_id": {"$in": list(android_ids)}})
+
+
+def incremental_candidates(
+    ios_count: int,
+    android_count: int,
+    changes: AppChanges,
+    candidates: Optional[list[list[int]]] = None,
+) -> list[list[int]]:
+    """
+    New or changed iOS apps are matched against all (candidate) Android apps, all
+    other iOS apps only against the new or changed Android apps.
+    """
+    changed_ios = set(changes.ios_indexes)
+    changed_android = set(changes.android_indexes)
+    incremental: list[list[int]] = []
+    for ios_index in range(ios_count):
+        row = range(android_count) if candidates is None else candidates[ios_index]
+        if ios_index in changed_ios:
+            incremental.append(list(row))
+        else:
+            incremental.append(
+                [android_index for android_index in row if android_index in changed_android]
+            )
+    return incremental
+
+
+def load_run_options(app_state_coll_name: str) -> Optional[dict]:
+    """
+    Options of the run that stored the app state, None if there is no app state.
+    """
+    for doc in get_collection(app_state_coll_name).find({"_id": _OPTIONS_ID}):
+        return doc.get("options")
+    return None
+
+
+def load_tf_idf_vectorizer(app_state_coll_name: str) -> Optional[TfidfVectorizer]:
+    """
+    The vectorizer stored by save_app_state, rebuilt from its vocabulary, idf weights
+    and stop words. None if no vectorizer is stored.
+    """
+    chunks = sorted(
+        get_collection(app_state_coll_name).find(
+            {"_id": {"$regex": f"^{_VECTORIZER_CHUNK_PREFIX}"}}
+        ),
+        key=lambda doc: doc.get("chunk"),
+    )
+    if len(chunks) == 0:
+        return None
+    if any("terms" not in chunk or "idf" not in chunk for chunk in chunks):
+        # Stored as a pickle by earlier versions, which is never loaded
+        raise ValueError(
+            f"The TF-IDF vectorizer in {app_state_coll_name} has an unsupported format, run a full (non-incremental) matching run"
+        )
+    return fitted_vectorizer(
+        [term for chunk in chunks for term in chunk["terms"]],
+        [weight for chunk in chunks for weight in chunk["idf"]],
+        chunks[0].get("stop_words"),
+    )
+
+
+def _vectorizer_chunks(vectorizer: TfidfVectorizer) -> list[dict]:
+    vocabulary = vectorizer.vocabulary_
+    terms = sorted(vocabulary, key=vocabulary.get)
+    idf = vectorizer.idf_.tolist()
+    stop_words = vectorizer.stop_words
+    chunks = []
+    start = 0
+    while start < len(terms) or len(chunks) == 0:
+        end = start
+        size = 0
+        while end < len(terms) and (end == start or size < _VECTORIZER_CHUNK_SIZE):
+            size += len(terms[end].encode("utf-8", "surrogatepass")) + _VECTORIZER_TERM_OVERHEAD
+            end += 1
+        chunk = len(chunks)
+        chunks.append(
+            {
+                "_id": f"{_VECTORIZER_CHUNK_PREFIX}{chunk}",
+                "chunk": chunk,
+                "terms": terms[start:end],
+                "idf": idf[start:end],
+            }
+        )
+        start = end
+    chunks[0]["stop_words"] = None if stop_words is None else sorted(stop_words)
+    return chunks
+
+
+def clear_app_state(app_state_coll_name: str) -> None:
+    get_collection(app_state_coll_name).delete_many({})
+
+
+def save_app_state(
+    app_state_coll_name: str,
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    run_options: dict,
+    tf_idf_vectorizer: Optional[TfidfVectorizer] = None,
+) -> None:
+    """
+    Store the app hashes of the matched apps as the base of the next incremental run.
+    Incremental runs must use the same "run_options" and reuse the "tf_idf_vectorizer".
+    """
+    state_coll = get_collection(app_state_coll_name)
+    requests = [
+        ReplaceOne(
+            {"_id": f"{app.os}:{app.app_id}"},
+            {"os": app.os, "app_id": app.app_id, "app_hash": app.app_hash},
+            upsert=True,
+        )
+        for app in [*ios_apps, *android_apps]
+    ]
+    for start in range(0, len(requests), 10000):
+        state_coll.bulk_write(requests[start : start + 10000], ordered=False)
+    current = [f"{app.os}:{app.app_id}" for app in [*ios_apps, *android_apps]]
+    state_coll.delete_many({"os": {"$exists": True}, "_id": {"$nin": current}})
+
+    state_coll.delete_many({"_id": {"$regex": f"^{_VECTORIZER_CHUNK_PREFIX}"}})
+    if tf_idf_vectorizer is not None:
+        state_coll.insert_many(_vectorizer_chunks(tf_idf_vectorizer))
+    state_coll.replace_one({"_id": _OPTIONS_ID}, {"options": run_options}, upsert=True)
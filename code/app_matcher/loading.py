@@ -0,0 +1,122 @@
+"""
+Loads the app collections into memory. Both collections are loaded at the same time,
+and each collection is split into "partitions" ranges of _id values that are read by
+parallel cursors. The ranges are concatenated in _id order, so the apps (and thus
+their matrix indexes) are in the same order as with a single cursor sorted by _id.
+"""
+from concurrent import futures
+from typing import Callable, Optional, TypeVar
+
+import bson
+from pymongo.collection import Collection
+
+_T = TypeVar("_T")
+
+
+def fetch_all(
+    coll: Collection[_T],
+    constructor: Callable[[], _T],
+    projection: Optional[dict[str, int]] = None,
+    batch_size: int = 2000,
+    filter: Optional[dict] = None,
+    sort: Optional[list[tuple[str, int]]] = None,
+) -> list[_T]:
+    """
+    Load all documents of "coll" matching "filter" with only the fields of
+    "projection" (all fields if None). The documents are fetched as raw BSON batches,
+    which are decoded at once.
+    """
+    targets: list[_T] = []
+    for batch in coll.find_raw_batches(
+        filter, projection=projection, batch_size=batch_size, sort=sort
+    ):
+        for doc in bson.decode_all(batch, coll.codec_options):
+            targets.append(constructor(**doc))
+    return targets
+
+
+def _partition_bounds(coll: Collection, count: int, partitions: int) -> list[object]:
+    # _id of the first document of each but the first partition
+    bounds = []
+    for partition in range(1, partitions):
+        for doc in coll.find(
+            {}, {"_id": 1}, sort=[("_id", 1)], skip=partition * count // partitions, limit=1
+        ):
+            bounds.append(doc["_id"])
+    return bounds
+
+
+def fetch_all_partitioned(
+    coll: Collection[_T],
+    constructor: Callable[[], _T],
+    projection: Optional[dict[str, int]] = None,
+    batch_size: int = 2000,
+    partitions: int = 4,
+) -> list[_T]:
+    """
+    Load all documents of "coll" in _id order with "partitions" parallel cursors,
+    each reading a range of _id values. With a single partition, the documents are
+    read by one cursor in their natural order.
+    """
+    if partitions <= 1:
+        return fetch_all(coll, constructor, projection, batch_size)
+    count = coll.count_documents({})
+    bounds = _partition_bounds(coll, count, partitions)
+    ranges = []
+    for lower, upper in zip([None, *bounds], [*bounds, None]):
+        id_range = {}
+        if lower is not None:
+            id_range["$gte"] = lower
+        if upper is not None:
+            id_range["$lt"] = upper
+        ranges.append({"_id": id_range} if len(id_range) > 0 else {})
+
+    with futures.ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        parts = pool.map(
+            lambda id_filter: fetch_all(
+                coll, constructor, projection, batch_size, id_filter, [("_id", 1)]
+            ),
+            ranges,
+        )
+        apps = [app for part in parts for app in part]
+    if len(apps) != count:
+        # Range queries only match _ids of the same type as the bounds, or the
+        # collection changed while loading
+        print(
+            f"[Loading] Loaded {len(apps)} of {count} apps of {coll.name} by _id ranges, loading them again with a single cursor"
+        )
+        return fetch_all(coll, constructor, projection, batch_size, sort=[("_id", 1)])
+    return apps
+
+
+def load_apps(
+    ios_coll: Collection,
+    ios_constructor: Callable[[], _T],
+    ios_projection: Optional[dict[str, int]],
+    android_coll: Collection,
+    android_constructor: Callable[[], _T],
+    android_projection: Optional[dict[str, int]],
+    batch_size: int = 2000,
+    partitions: int = 4,
+) -> tuple[list, list]:
+    """
+    Load the iOS and the Android collection at the same time, see fetch_all_partitioned.
+    """
+    with futures.ThreadPoolExecutor(max_workers=2) as pool:
+        ios_future = pool.submit(
+            fetch_all_partitioned,
+            ios_coll,
+            ios_constructor,
+            ios_projection,
+            batch_size,
+            partitions,
+        )
+        android_future = pool.submit(
+            fetch_all_partitioned,
+            android_coll,
+            android_constructor,
+            android_projection,
+            batch_size,
+            partitions,
+        )
+        return ios_future.result(), android_future.result()
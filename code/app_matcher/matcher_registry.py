@@ -0,0 +1,156 @@
+"""
+Declarations of the pairwise matchers: the arguments of a pair each matcher takes,
+the keys of the scores it returns and its relative cost. The matchers of a run are
+compiled into a call plan once (see compile_call_plan), so scoring a pair neither
+inspects the matchers nor merges their score dicts: each matcher is called with its
+arguments taken from the pair and its scores are written into fixed slots of a list.
+
+Matchers that are not declared here must be registered with register_matcher before
+they can be used.
+"""
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import Callable
+
+from app_matcher.matchers import (
+    match_app_id,
+    match_app_name,
+    match_deep_links,
+    match_description,
+    match_developer,
+    match_developer_url,
+    match_icon_hash,
+    match_language,
+    match_privacy_url,
+)
+from app_matcher.related_work_matchers import (
+    ali_exact_match,
+    ali_exact_match_fixed,
+    han_exact_match_similar_description,
+    hu_similarity_match,
+)
+
+# Arguments of a pair a matcher can take, in the order of the pair tuple
+PAIR_INPUTS = ("ios_app", "android_app", "ios_index", "android_index")
+APP_INPUTS = ("ios_app", "android_app")
+# Cost of matchers that do not declare one, they run last in cascade scoring
+DEFAULT_MATCHER_COST = 100
+
+
+@dataclass(kw_only=True)
+class MatcherSpec:
+    # Arguments of the pair the matcher takes, as its first positional parameters
+    inputs: tuple[str, ...]
+    # Keys of the scores the matcher returns
+    outputs: tuple[str, ...]
+    # Relative cost of scoring one pair, measured on typical apps (see cascade.py)
+    cost: float = DEFAULT_MATCHER_COST
+    # Whether the matcher takes a "score_cutoff" (see cascade.py)
+    score_cutoff: bool = False
+
+
+@dataclass(kw_only=True)
+class PlanStep:
+    matcher: Callable
+    # Selects the arguments of the matcher from the pair tuple
+    arguments: Callable[[tuple], tuple]
+    # Slots of the scores of the matcher: (index in the score list, key)
+    slots: list[tuple[int, str]]
+    cost: float
+    score_cutoff: bool
+
+
+@dataclass(kw_only=True)
+class CallPlan:
+    steps: list[PlanStep]
+    # Keys of all scores, in the order of their slots
+    keys: list[str]
+
+
+MATCHER_REGISTRY: dict[Callable, MatcherSpec] = {}
+
+
+def register_matcher(
+    matcher: Callable,
+    outputs: tuple[str, ...],
+    inputs: tuple[str, ...] = APP_INPUTS,
+    cost: float = DEFAULT_MATCHER_COST,
+    score_cutoff: bool = False,
+) -> None:
+    parameters = matcher.__code__.co_varnames[: matcher.__code__.co_argcount]
+    if any(name not in PAIR_INPUTS for name in inputs) or parameters[: len(inputs)] != inputs:
+        raise ValueError(
+            f"Inputs {inputs} of {matcher.__name__} must be its first parameters {parameters} and one of {PAIR_INPUTS}"
+        )
+    if score_cutoff and "score_cutoff" not in parameters:
+        raise ValueError(f"{matcher.__name__} has no score_cutoff parameter")
+    MATCHER_REGISTRY[matcher] = MatcherSpec(
+        inputs=inputs, outputs=outputs, cost=cost, score_cutoff=score_cutoff
+    )
+
+
+def get_matcher_spec(matcher: Callable) -> MatcherSpec:
+    spec = MATCHER_REGISTRY.get(matcher)
+    if spec is None:
+        raise ValueError(f"Matcher {matcher.__name__} is not registered, see matcher_registry.py")
+    return spec
+
+
+def _argument_selector(inputs: tuple[str, ...]) -> Callable[[tuple], tuple]:
+    positions = [PAIR_INPUTS.index(name) for name in inputs]
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda pair: (pair[position],)
+    return itemgetter(*positions)
+
+
+def compile_call_plan(matchers: list[Callable], index_matchers: list[Callable]) -> CallPlan:
+    """
+    Call plan of the matchers followed by the index matchers. The scores are in the
+    same order as the merged score dicts of the matchers.
+    """
+    steps = []
+    keys = []
+    for matcher in [*matchers, *index_matchers]:
+        spec = get_matcher_spec(matcher)
+        slots = []
+        for key in spec.outputs:
+            if key in keys:
+                raise ValueError(f"Score {key} is returned by several matchers")
+            slots.append((len(keys), key))
+            keys.append(key)
+        steps.append(
+            PlanStep(
+                matcher=matcher,
+                arguments=_argument_selector(spec.inputs),
+                slots=slots,
+                cost=spec.cost,
+                score_cutoff=spec.score_cutoff,
+            )
+        )
+    return CallPlan(steps=steps, keys=keys)
+
+
+register_matcher(match_privacy_url, ("privacy_url_max",), cost=3, score_cutoff=True)
+register_matcher(match_developer_url, ("developer_url_max",), cost=3, score_cutoff=True)
+register_matcher(match_developer, ("developer_max",), cost=2, score_cutoff=True)
+register_matcher(match_app_id, ("app_id_max",), cost=2, score_cutoff=True)
+register_matcher(match_app_name, ("app_name_max",), cost=2, score_cutoff=True)
+register_matcher(match_deep_links, ("deep_link_max",), cost=1)
+register_matcher(match_icon_hash, ("icon_hash_max",), cost=4)
+register_matcher(match_language, ("description_language_matches",), cost=1)
+register_matcher(
+    match_description,
+    ("description_cosine_similarity",),
+    inputs=("ios_index", "android_index"),
+    cost=1,
+)
+register_matcher(ali_exact_match, ("ali_exact_match",), cost=3)
+register_matcher(ali_exact_match_fixed, ("ali_exact_match_fixed",), cost=1)
+register_matcher(
+    han_exact_match_similar_description,
+    ("han_exact_match_similar_description",),
+    inputs=PAIR_INPUTS,
+    cost=2,
+)
+register_matcher(hu_similarity_match, ("hu_similarity_match",), cost=3, score_cutoff=True)
@@ -2,16 +2,28 @@ import glob
 from multiprocessing import current_process
 import os
 import time
+from typing import Optional
 import imagehash
 import numpy
 from scipy.sparse import spmatrix
+from .tf_idf.tf_idf_build import dense_similarities, fit_transform, top_similarities
+from .tf_idf.tf_idf_cache import (
+    corpus_key,
+    load_similarities_info,
+    load_vectors,
+    save_similarities,
+    save_vectors,
+    similarities_dir,
+)
 from .tf_idf.tf_idf_shared_memory import (
+    DTYPES,
+    TF_IDF_SM_SIMILARITIES,
     cleanup_similarities_sm,
-    cleanup_height_sm,
-    cleanup_width_sm,
-    get_similarities_sm,
-    get_height_sm,
-    get_width_sm,
+    create_similarities_sm,
+    create_sparse_similarities_sm,
+    get_description_similarity,
+    similarity_file_names,
+    use_similarity_files,
 )
 from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
     AndroidPreprocessingResult,
@@ -20,31 +32,35 @@ from database.analysis_results.preprocessing_result.android_preprocessing_result
 from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios_preprocessing_result import (
     iOSPreprocessingResult,
 )
+from .icon_hash_matrix import (
+    cleanup_packed_icon_hashes,
+    pack_icon_hashes,
+    set_packed_icon_hashes,
+)
 from .comparators import (
-    deep_link_comparison,
+    deep_link_set_comparison,
     hash_compare,
     hash_compare_multi,
-    is_same_domain,
     normalized_levenshtein_distance,
     normalized_shared_prefix_length,
 )
+from .features import (
+    feature,
+    get_android_features,
+    get_ios_features,
+    prepare_features,
+)
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
 WORD_LIST_DIR = "./app_matcher/stop_word_lists" # relative to xpa
 
-def prepare_tf_idf(
-    ios_apps: list[iOSPreprocessingResult],
-    android_apps: list[AndroidPreprocessingResult],
-) -> None:
-    global width_sm
-    global height_sm
-    global android_to_ios_similarities_sm
-    global ios_to_android_similarities_sm
+# Vectorizer of the last prepare_tf_idf call, stored with the app state for incremental runs
+_tf_idf_vectorizer: Optional[TfidfVectorizer] = None
 
-    print("[TF-IDF] Creating TF-IDF index...")
-    
+
+def _load_stop_words() -> set[str]:
     stop_words = set()
     for file in glob.glob(os.path.join(WORD_LIST_DIR, "*")):
         print(file)
@@ -54,54 +70,187 @@ def prepare_tf_idf(
             with open(file, 'r') as fp:
                 for word in fp.readlines():
                     stop_words.add(word.strip())
+    return stop_words
 
 
-    vectorizer = TfidfVectorizer(stop_words=list(stop_words))
+def prepare_tf_idf(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+    changed_ios_indexes: Optional[list[int]] = None,
+    changed_android_indexes: Optional[list[int]] = None,
+    tf_idf_vectorizer: Optional[TfidfVectorizer] = None,
+    description_top_k: Optional[int] = None,
+    description_min_similarity: Optional[float] = None,
+    description_dtype: str = "float64",
+    tf_idf_cache_dir: Optional[str] = None,
+    threads: int = 1,
+) -> None:
+    """
+    If "changed_ios_indexes" or "changed_android_indexes" are given (incremental
+    matching), only the similarities of these rows and columns are calculated, the
+    others are left at 0 as they are not matched. If a fitted "tf_idf_vectorizer" is
+    given, it is not refitted and only the descriptions needed for these rows and
+    columns are transformed, so the similarities stay comparable to the ones of the
+    run that fitted it.
+
+    If "description_top_k" and/or "description_min_similarity" are given (sparse
+    mode), only the top k similarities of each iOS app and/or the ones of at least
+    that value are stored, see get_description_similarity.
+
+    The similarities are stored as "description_dtype" (float64 or float32).
+
+    If "tf_idf_cache_dir" is given, the vectorizer, the document vectors and the
+    similarities of full (not incremental) preparations are cached there (see
+    tf_idf_cache.py), and the cached similarities are memory mapped instead of being
+    copied to shared memory.
+
+    With more than one of "threads", the vectorizer is fitted and the similarities are
+    calculated by that many processes, see tf_idf_build.py.
+    """
+    global _tf_idf_vectorizer
+
     android_descriptions = [
         android_app.metadata.get("description") for android_app in android_apps
     ]
     # This function runs after prepare_ios_descriptions, so we don't need to join the descriptions
     ios_descriptions = [ios_app.metadata.get("description") for ios_app in ios_apps]
-
-    all_descriptions = android_descriptions + ios_descriptions
-
-    descriptions_index = vectorizer.fit_transform(all_descriptions)
-    assert descriptions_index.shape[0] == len(all_descriptions)
-    android_vectors: spmatrix = descriptions_index[0 : len(android_descriptions), :]
-    ios_vectors: spmatrix = descriptions_index[len(android_descriptions) :, :]
-
-    print(f"[TF-IDF] TF-IDF indexes created")
-
-    def assert_size(matrix: numpy.ndarray):
-        assert matrix.dtype == numpy.double
-        assert matrix.itemsize == 8  # Needed for shared memory allocation
-        x, y = matrix.shape
-        assert x == len(ios_apps)
-        assert y == len(android_apps)
-
-    print(f"[TF-IDF] Creating similarity matrix")
-    all_similarities = cosine_similarity(
-        ios_vectors,
-        android_vectors,
-    )
-    assert_size(all_similarities)
-
-    width, height = all_similarities.shape
+    incremental = changed_ios_indexes is not None or changed_android_indexes is not None
+    use_cache = tf_idf_cache_dir is not None and tf_idf_vectorizer is None and not incremental
+
+    if tf_idf_vectorizer is None:
+        stop_words = _load_stop_words()
+        cached = None
+        if use_cache:
+            cache_key = corpus_key(
+                [ios_app.app_hash for ios_app in ios_apps],
+                ios_descriptions,
+                [android_app.app_hash for android_app in android_apps],
+                android_descriptions,
+                stop_words,
+            )
+            cached = load_vectors(tf_idf_cache_dir, cache_key)
+
+        if cached is not None:
+            print(f"[TF-IDF] Loaded TF-IDF index {cache_key} from the cache")
+            vectorizer, ios_vectors, android_vectors = cached
+        else:
+            print("[TF-IDF] Creating TF-IDF index...")
+            all_descriptions = android_descriptions + ios_descriptions
+            if threads > 1:
+                vectorizer, descriptions_index = fit_transform(
+                    all_descriptions, list(stop_words), threads
+                )
+            else:
+                vectorizer = TfidfVectorizer(stop_words=list(stop_words))
+                descriptions_index = vectorizer.fit_transform(all_descriptions)
+            assert descriptions_index.shape[0] == len(all_descriptions)
+            android_vectors: spmatrix = descriptions_index[0 : len(android_descriptions), :]
+            ios_vectors: spmatrix = descriptions_index[len(android_descriptions) :, :]
+            print(f"[TF-IDF] TF-IDF indexes created")
+            if use_cache:
+                save_vectors(tf_idf_cache_dir, cache_key, vectorizer, ios_vectors, android_vectors)
+                print(f"[TF-IDF] Stored TF-IDF index {cache_key} in the cache")
+
+        def ios_rows(indexes: Optional[list[int]]) -> spmatrix:
+            return ios_vectors if indexes is None else ios_vectors[indexes, :]
+
+        def android_rows(indexes: Optional[list[int]]) -> spmatrix:
+            return android_vectors if indexes is None else android_vectors[indexes, :]
+    else:
+        print("[TF-IDF] Reusing the stored TF-IDF index")
+        vectorizer = tf_idf_vectorizer
+
+        def ios_rows(indexes: Optional[list[int]]) -> spmatrix:
+            if indexes is None:
+                return vectorizer.transform(ios_descriptions)
+            return vectorizer.transform([ios_descriptions[index] for index in indexes])
+
+        def android_rows(indexes: Optional[list[int]]) -> spmatrix:
+            if indexes is None:
+                return vectorizer.transform(android_descriptions)
+            return vectorizer.transform([android_descriptions[index] for index in indexes])
+
+    _tf_idf_vectorizer = vectorizer
+    sparse = description_top_k is not None or description_min_similarity is not None
+
+    if incremental and not sparse:
+        print(f"[TF-IDF] Creating similarity matrix for changed apps only")
+        android_to_ios_sm = create_similarities_sm(
+            len(ios_apps), len(android_apps), description_dtype
+        )
+        android_to_ios_sm.fill(0)
+        if changed_ios_indexes:
+            android_to_ios_sm[changed_ios_indexes, :] = cosine_similarity(
+                ios_rows(changed_ios_indexes), android_rows(None)
+            )
+        if changed_android_indexes:
+            android_to_ios_sm[:, changed_android_indexes] = cosine_similarity(
+                ios_rows(None), android_rows(changed_android_indexes)
+            )
+        print(f"[TF-IDF] Shared memory created")
+        return
+
+    # In sparse mode, the top k of unchanged iOS apps may change with the changed
+    # Android apps, so all rows are calculated in incremental runs as well
+    options = {
+        "top_k": description_top_k,
+        "min_similarity": description_min_similarity,
+        "dtype": description_dtype,
+    }
+    info = load_similarities_info(tf_idf_cache_dir, cache_key, options) if use_cache else None
+    if info is not None:
+        print(f"[TF-IDF] Memory mapping the cached similarities")
+        use_similarity_files(
+            similarities_dir(tf_idf_cache_dir, cache_key, options),
+            info["width"],
+            info["height"],
+            info["nnz"],
+            description_dtype,
+        )
+        return
+
+    width, height = len(ios_apps), len(android_apps)
     print(
-        f"[TF-IDF] Similarities calculated - moving them to shared memory with shape {width}x{height}"
+        f"[TF-IDF] Creating {'sparse ' if sparse else ''}similarity matrix with shape {width}x{height}"
     )
-    # Store width to shared memory
-    width_sm = get_width_sm()
-    width_sm[0] = width
-
-    # Store height to shared memory
-    height_sm = get_height_sm()
-    height_sm[0] = height
-
-    # Copy similarities into shared memory
-    android_to_ios_sm = get_similarities_sm()
-    numpy.copyto(android_to_ios_sm, all_similarities)
-
+    if sparse:
+        indptr, indices, data = top_similarities(
+            ios_rows(None), android_rows(None), description_top_k, description_min_similarity, threads
+        )
+        nnz = len(data)
+        print(f"[TF-IDF] Storing {nnz} of {width * height} similarities")
+        arrays = dict(
+            zip(
+                similarity_file_names(sparse),
+                (indptr, indices, data.astype(DTYPES[description_dtype], copy=False)),
+            )
+        )
+    else:
+        nnz = -1
+        # Calculated in blocks directly into the shared memory (or the array to cache)
+        if use_cache:
+            similarities = numpy.empty((width, height), dtype=DTYPES[description_dtype])
+        else:
+            similarities = create_similarities_sm(width, height, description_dtype)
+        dense_similarities(ios_rows(None), android_rows(None), similarities, threads)
+        arrays = {TF_IDF_SM_SIMILARITIES: similarities}
+
+    if use_cache:
+        path = save_similarities(
+            tf_idf_cache_dir,
+            cache_key,
+            options,
+            arrays,
+            {"width": width, "height": height, "nnz": nnz},
+        )
+        print(f"[TF-IDF] Stored the similarities in the cache - memory mapping them")
+        use_similarity_files(path, width, height, nnz, description_dtype)
+        return
+
+    if sparse:
+        shared_arrays = create_sparse_similarities_sm(width, height, nnz, description_dtype)
+        for shared_array, name in zip(shared_arrays, similarity_file_names(sparse)):
+            numpy.copyto(shared_array, arrays[name])
     print(f"[TF-IDF] Shared memory created")
 
 
@@ -125,6 +274,15 @@ def prepare_image_hashes(
         _parse_hex(hexes, "whash")
         _parse_multi(hexes)
 
+    # Bit-packed copies of the hashes for the vectorized icon matcher, see icon_hash_matrix.py
+    packed_ios = pack_icon_hashes([ios_app.icon for ios_app in ios_apps])
+    packed_android = pack_icon_hashes([android_app.icon for android_app in android_apps])
+    if packed_ios is None or packed_android is None:
+        print("[Icon hashes] Hashes differ in size - vectorized icon matching disabled")
+        set_packed_icon_hashes(None)
+    else:
+        set_packed_icon_hashes({"ios": packed_ios, "android": packed_android})
+
     for ios_app in ios_apps:
         _parse_all(ios_app.icon)
 
@@ -140,28 +298,40 @@ def prepare_ios_descriptions(
         ios_app.metadata["description"] = "\n".join(ios_app.metadata.get("description"))
 
 
+def _match_url(
+    p_url1: str,
+    p_url2: str,
+    hostname1: Optional[str],
+    hostname2: Optional[str],
+    score_cutoff: Optional[float] = None,
+) -> float:
+    same_domain = 1 if hostname1 == hostname2 else 0
+    shared_prefix = 1 - normalized_shared_prefix_length(p_url1, p_url2, lowercase=False)
+    # The exact Levenshtein similarity only matters if it can raise the maximum
+    levenshtein_dist = 1 - normalized_levenshtein_distance(
+        p_url1,
+        p_url2,
+        lowercase=False,
+        min_similarity=max(same_domain, shared_prefix, score_cutoff or 0),
+    )
+    return max(same_domain, shared_prefix, levenshtein_dist)
+
+
 def match_privacy_url(
-    ios_app: iOSPreprocessingResult, android_app: AndroidPreprocessingResult
+    ios_app: iOSPreprocessingResult,
+    android_app: AndroidPreprocessingResult,
+    score_cutoff: Optional[float] = None,
 ) -> dict[str, float]:
-    ios_urls = ios_app.metadata.get("urls")
-    p_url1 = ""
-    for url in ios_urls:
-        if (
-            "datenschutzrichtlinie" in url.get("link_name", "").lower()
-            or "privacy policy" in url.get("link_name", "").lower()
-        ):
-            p_url1 = url.get("link", "") or ""
-
-    p_url2 = android_app.metadata.get("urls", {}).get("privacy_policies", "") or ""
-    if p_url2 is None:
-        # print(f'How: {android_app.metadata.get("urls", {})}')
-        p_url2 = ""
-    maxLength = max(len(p_url1), len(p_url2), 1)
-
-    same_domain = 1 if is_same_domain(p_url1, p_url2) else 0
-    shared_prefix = 1 - normalized_shared_prefix_length(p_url1, p_url2)
-    levenshtein_dist = 1 - normalized_levenshtein_distance(p_url1, p_url2)
-    max_score = max(same_domain, shared_prefix, levenshtein_dist)
+    # URLs and hostnames are extracted by prepare_features
+    ios_features = get_ios_features(ios_app)
+    android_features = get_android_features(android_app)
+    max_score = _match_url(
+        feature(ios_features.privacy_url),
+        feature(android_features.privacy_url),
+        feature(ios_features.privacy_hostname),
+        feature(android_features.privacy_hostname),
+        score_cutoff,
+    )
 
     return {
         # "privacy_url_same_domain": same_domain,
@@ -173,43 +343,42 @@ def match_privacy_url(
     }
 
 def match_developer_url(
-    ios_app: iOSPreprocessingResult, android_app: AndroidPreprocessingResult
+    ios_app: iOSPreprocessingResult,
+    android_app: AndroidPreprocessingResult,
+    score_cutoff: Optional[float] = None,
 ) -> dict[str, float]:
-    ios_urls = ios_app.metadata.get("urls")
-    p_url1 = ""
-    for url in ios_urls:
-        if (
-            "website des entwicklers" in url.get("link_name", "").lower()
-            or "developer website" in url.get("link_name", "").lower()
-        ):
-            p_url1 = url.get("link", "") or ""
-
-    p_url2 = android_app.metadata.get("urls", {}).get("developer_website", "") or ""
-    if p_url2 is None:
-        # print(f'How: {android_app.metadata.get("urls", {})}')
-        p_url2 = ""
-    maxLength = max(len(p_url1), len(p_url2), 1)
-
-    same_domain = 1 if is_same_domain(p_url1, p_url2) else 0
-    shared_prefix = 1 - normalized_shared_prefix_length(p_url1, p_url2)
-    levenshtein_dist = 1 - normalized_levenshtein_distance(p_url1, p_url2)
-    max_score = max(same_domain, shared_prefix, levenshtein_dist)
+    ios_features = get_ios_features(ios_app)
+    android_features = get_android_features(android_app)
+    max_score = _match_url(
+        feature(ios_features.developer_url),
+        feature(android_features.developer_url),
+        feature(ios_features.developer_hostname),
+        feature(android_features.developer_hostname),
+        score_cutoff,
+    )
 
     return {
         "developer_url_max": max_score
     }
 
 
+def _match_string(a: str, b: str, score_cutoff: Optional[float] = None) -> float:
+    shared_prefix = 1 - normalized_shared_prefix_length(a, b, lowercase=False)
+    # The exact Levenshtein similarity only matters if it can raise the maximum
+    levenshtein_dist = 1 - normalized_levenshtein_distance(
+        a, b, lowercase=False, min_similarity=max(shared_prefix, score_cutoff or 0)
+    )
+    return max(shared_prefix, levenshtein_dist)
+
+
 def match_developer(
-    ios_app: iOSPreprocessingResult, android_app: AndroidPreprocessingResult
+    ios_app: iOSPreprocessingResult,
+    android_app: AndroidPreprocessingResult,
+    score_cutoff: Optional[float] = None,
 ) -> dict[str, float]:
-    dev1 = ios_app.metadata.get("developer_name", "")
-    dev2 = android_app.metadata.get("developer_name", "")
-    maxLength = max(len(dev1), len(dev2), 1)
-
-    shared_prefix = 1 - normalized_shared_prefix_length(dev1, dev2)
-    levenshtein_dist = 1 - normalized_levenshtein_distance(dev1, dev2)
-    max_score = max(shared_prefix, levenshtein_dist)
+    dev1 = feature(get_ios_features(ios_app).developer)
+    dev2 = feature(get_android_features(android_app).developer)
+    max_score = _match_string(dev1, dev2, score_cutoff)
 
     return {
         #'developer_shared_prefix': shared_prefix,
@@ -221,17 +390,15 @@ def match_developer(
 
 
 def match_app_id(
-    ios_app: iOSPreprocessingResult, android_app: AndroidPreprocessingResult
+    ios_app: iOSPreprocessingResult,
+    android_app: AndroidPreprocessingResult,
+    score_cutoff: Optional[float] = None,
 ) -> dict[str, float]:
     # some use the representation .com.my.id and some others com.my.id
-    # --> we normalize this by removing the dot to give the prefix metric a chance
-    app_id1 = ios_app.app_id.removeprefix(".")
-    app_id2 = android_app.app_id.removeprefix(".")
-    maxLength = max(len(app_id1), len(app_id2), 1)
-
-    shared_prefix = 1 - normalized_shared_prefix_length(app_id1, app_id2)
-    levenshtein_dist = 1 - normalized_levenshtein_distance(app_id1, app_id2)
-    max_score = max(shared_prefix, levenshtein_dist)
+    # --> the features are normalized by removing the dot to give the prefix metric a chance
+    app_id1 = feature(get_ios_features(ios_app).app_id)
+    app_id2 = feature(get_android_features(android_app).app_id)
+    max_score = _match_string(app_id1, app_id2, score_cutoff)
 
     return {
         #'app_id_shared_prefix': shared_prefix,
@@ -243,15 +410,13 @@ def match_app_id(
 
 
 def match_app_name(
-    ios_app: iOSPreprocessingResult, android_app: AndroidPreprocessingResult
+    ios_app: iOSPreprocessingResult,
+    android_app: AndroidPreprocessingResult,
+    score_cutoff: Optional[float] = None,
 ) -> dict[str, float]:
-    name1 = ios_app.metadata.get("name", "")
-    name2 = android_app.metadata.get("app_name", "")
-    maxLength = max(len(name1), len(name2), 1)
-
-    shared_prefix = 1 - normalized_shared_prefix_length(name1, name2)
-    levenshtein_dist = 1 - normalized_levenshtein_distance(name1, name2)
-    max_score = max(shared_prefix, levenshtein_dist)
+    name1 = feature(get_ios_features(ios_app).name)
+    name2 = feature(get_android_features(android_app).name)
+    max_score = _match_string(name1, name2, score_cutoff)
 
     return {
         #'app_name_shared_prefix': shared_prefix,
@@ -265,54 +430,21 @@ def match_app_name(
 def match_deep_links(
     ios_app: iOSPreprocessingResult, android_app: AndroidPreprocessingResult
 ) -> dict[str, float]:
-    # TODO: fix me
-    # return {}
-    custom_url_schemes_list = ios_app.plist.get("custom_url_schemes", [])
-    app_links_1 = set(
-        [
-            entitlement.removeprefix("applinks:")
-            .removeprefix("*.")
-            .removeprefix("www.")
-            for entitlement in ios_app.entitlements.get("universal_links", [])
-        ]
-    )
-    i = ""
-    i.removeprefix
-    custom_url_schemes_1 = set()
-    for list_item in custom_url_schemes_list:
-        if list_item is None:
-            continue
-        for item in list_item:
-            if item is None or type(item) is str:
-                continue
-            scheme = item.get("CFBundleURLSchemes", None)
-            if (
-                scheme is not None
-                and scheme != "http"
-                and scheme != "https"
-                and type(scheme) is str
-            ):
-                custom_url_schemes_1 |= set(scheme)
-
-    custom_url_schemes_2 = android_app.apk_info.get("intent_filters", {}).get(
-        "custom_schemes", []
-    )
-    app_links_2 = set(
-        [
-            app_link
-            .removeprefix("*.")
-            .removeprefix("www.")
-            for app_link in android_app.apk_info.get("intent_filters", {}).get("app_links", [])
-        ]
-    )
-
-    maxLength_cus = max(len(custom_url_schemes_1.union(custom_url_schemes_2)), 1)
-    maxLength_al = max(len(app_links_1.union(app_links_2)), 1)
-
-    custom_url_scheme_matches = deep_link_comparison(
+    # Scheme and app link sets are extracted by prepare_features
+    ios_features = get_ios_features(ios_app)
+    android_features = get_android_features(android_app)
+    custom_url_schemes_1 = feature(ios_features.custom_url_schemes)
+    app_links_1 = feature(ios_features.app_links)
+    custom_url_schemes_2 = feature(android_features.custom_url_schemes)
+    app_links_2 = feature(android_features.app_links)
+
+    maxLength_cus = max(len(custom_url_schemes_1 | custom_url_schemes_2), 1)
+    maxLength_al = max(len(app_links_1 | app_links_2), 1)
+
+    custom_url_scheme_matches = deep_link_set_comparison(
         custom_url_schemes_1, custom_url_schemes_2
     )
-    app_link_matches = deep_link_comparison(app_links_1, app_links_2)
+    app_link_matches = deep_link_set_comparison(app_links_1, app_links_2)
 
     cus_comparison = custom_url_scheme_matches / maxLength_cus
     app_link_comparison = app_link_matches / maxLength_al
@@ -337,9 +469,12 @@ def match_icon_hash(
     icon_hashes_ios = ios_app.icon
     icon_hashes_android = android_app.icon
 
-    def _compare_hash(which: str) -> float:
+    def _compare_hash(which: str) -> Optional[float]:
         if icon_hashes_ios is None or icon_hashes_android is None:
             return 0
+        if icon_hashes_ios.get(which) is None or icon_hashes_android.get(which) is None:
+            # Hash type missing for one of the apps, only the others are compared
+            return None
         return hash_compare(icon_hashes_ios[which], icon_hashes_android[which])
 
     # def _compare_multi_hash() -> float:
@@ -356,7 +491,10 @@ def match_icon_hash(
     ahash_score = _compare_hash("ahash")
     phash_score = _compare_hash("phash")
     whash_score = _compare_hash("whash")
-    max_score = max(ahash_score, phash_score, whash_score)
+    max_score = max(
+        (score for score in (ahash_score, phash_score, whash_score) if score is not None),
+        default=0,
+    )
 
     return {
         # "icon_hash_ahash_score": ahash_score,
@@ -376,21 +514,33 @@ def match_language(ios_app: iOSPreprocessingResult, android_app: AndroidPreproce
 
 
 def match_description(ios_index: int, android_index: int) -> dict[str, float]:
-    description_similarity = get_similarities_sm()
     return {
-        "description_cosine_similarity": description_similarity[
+        "description_cosine_similarity": get_description_similarity(
             ios_index, android_index
-        ]
+        )
     }
 
 
+def get_tf_idf_vectorizer() -> Optional[TfidfVectorizer]:
+    return _tf_idf_vectorizer
+
+
 def cleanup_tf_idf():
-    cleanup_width_sm()
-    cleanup_height_sm()
+    global _tf_idf_vectorizer
+    _tf_idf_vectorizer = None
     cleanup_similarities_sm()
 
 
-ALL_PREPARES = [prepare_ios_descriptions, prepare_tf_idf, prepare_image_hashes]
+def cleanup_image_hashes():
+    cleanup_packed_icon_hashes()
+
+
+ALL_PREPARES = [
+    prepare_ios_descriptions,
+    prepare_features,
+    prepare_tf_idf,
+    prepare_image_hashes,
+]
 ALL_MATCHERS = [
     match_privacy_url,
     match_developer,
@@ -404,4 +554,4 @@ ALL_WEIGHT_MODIFIERS = [
     match_language,
 ]
 ALL_INDEXED_MATCHERS = [match_description]
-ALL_CLEANUPS = [cleanup_tf_idf]
+ALL_CLEANUPS = [cleanup_tf_idf, cleanup_image_hashes]
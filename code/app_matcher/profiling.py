@@ -0,0 +1,133 @@
+"""
+Calls and time of each matcher, collected by each work unit (see _match_executor in
+threaded_matcher.py) and merged when the run finished.
+
+The time of a pair is split into the time spent in the matchers, in dispatching the
+calls to them (selecting the arguments each matcher takes from the pair, see
+matcher_registry.py) and in building the result (storing the scores, looking up
+scores of batch matchers, the average score and the MatchingResult). Batch matchers (see batch_matchers.py) are
+listed with one call per block of iOS apps.
+"""
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from app_matcher.matcher_registry import PlanStep
+
+
+@dataclass(kw_only=True)
+class MatcherProfile:
+    pairs: int = 0
+    # Seconds of scoring pairs, including the matchers and the dispatch
+    pair_seconds: float = 0
+    dispatch_seconds: float = 0
+    # Calls and seconds per matcher name
+    calls: dict[str, int] = field(default_factory=dict)
+    seconds: dict[str, float] = field(default_factory=dict)
+
+
+def record_call(profile: MatcherProfile, name: str, seconds: float) -> None:
+    profile.calls[name] = profile.calls.get(name, 0) + 1
+    profile.seconds[name] = profile.seconds.get(name, 0) + seconds
+
+
+def profiled_call(profile: MatcherProfile, step: PlanStep, pair: tuple, **kwargs) -> dict:
+    """
+    Call the matcher of "step" on "pair", recording the time of the dispatch and of
+    the call.
+    """
+    started_at = time.perf_counter()
+    arguments = step.arguments(pair)
+    called_at = time.perf_counter()
+    result = step.matcher(*arguments, **kwargs)
+    finished_at = time.perf_counter()
+    profile.dispatch_seconds += called_at - started_at
+    record_call(profile, step.matcher.__name__, finished_at - called_at)
+    return result
+
+
+def merge_profiles(profiles: list[Optional[MatcherProfile]]) -> MatcherProfile:
+    """
+    Sum of the given profiles, e.g. of all work units of a run. None entries (units
+    that were not profiled) are skipped.
+    """
+    merged = MatcherProfile()
+    for profile in profiles:
+        if profile is None:
+            continue
+        merged.pairs += profile.pairs
+        merged.pair_seconds += profile.pair_seconds
+        merged.dispatch_seconds += profile.dispatch_seconds
+        for name, calls in profile.calls.items():
+            merged.calls[name] = merged.calls.get(name, 0) + calls
+        for name, seconds in profile.seconds.items():
+            merged.seconds[name] = merged.seconds.get(name, 0) + seconds
+    return merged
+
+
+def _result_building_seconds(profile: MatcherProfile) -> float:
+    # Batch matchers run outside of the pairs
+    pairwise_seconds = sum(
+        seconds for name, seconds in profile.seconds.items() if not name.endswith(" (batch)")
+    )
+    return max(profile.pair_seconds - pairwise_seconds - profile.dispatch_seconds, 0)
+
+
+def profile_summary(profile: MatcherProfile) -> dict:
+    """
+    JSON serializable summary of the profile, matchers sorted by their total time.
+    """
+    return {
+        "pairs": profile.pairs,
+        "pair_seconds": profile.pair_seconds,
+        "dispatch_seconds": profile.dispatch_seconds,
+        "result_building_seconds": _result_building_seconds(profile),
+        "matchers": [
+            {
+                "name": name,
+                "calls": profile.calls[name],
+                "seconds": seconds,
+                "microseconds_per_call": seconds / max(profile.calls[name], 1) * 1e6,
+            }
+            for name, seconds in sorted(
+                profile.seconds.items(), key=lambda item: item[1], reverse=True
+            )
+        ],
+    }
+
+
+def print_profile(profile: MatcherProfile) -> None:
+    """
+    Print the calls and time of each matcher, of the dispatch and of the result
+    building as a table, most expensive first.
+    """
+    summary = profile_summary(profile)
+    total_seconds = max(
+        summary["dispatch_seconds"]
+        + summary["result_building_seconds"]
+        + sum(matcher["seconds"] for matcher in summary["matchers"]),
+        1e-9,
+    )
+    rows = [
+        (matcher["name"], matcher["calls"], matcher["seconds"])
+        for matcher in summary["matchers"]
+    ]
+    rows.append(("(dispatch)", None, summary["dispatch_seconds"]))
+    rows.append(("(result building)", summary["pairs"], summary["result_building_seconds"]))
+    name_width = max(len(name) for name, _, _ in rows)
+
+    print(f"[Profile] {summary['pairs']} pairs scored in {summary['pair_seconds']:.1f}s of worker time")
+    print(f"[Profile] {'matcher':<{name_width}} {'calls':>12} {'seconds':>10} {'share':>7} {'us/call':>10}")
+    for name, calls, seconds in rows:
+        per_call = f"{seconds / calls * 1e6:10.2f}" if calls else f"{'':>10}"
+        calls = f"{calls:>12}" if calls is not None else f"{'':>12}"
+        print(
+            f"[Profile] {name:<{name_width}} {calls} {seconds:10.2f} {seconds / total_seconds:7.1%} {per_call}"
+        )
+
+
+def save_profile(profile: MatcherProfile, path: str) -> None:
+    with open(path, "w") as fp:
+        json.dump(profile_summary(profile), fp, indent=2)
+    print(f"[Profile] Matcher profile written to {path}")
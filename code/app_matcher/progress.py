@@ -0,0 +1,228 @@
+"""
+Live progress of a matching run. Every few seconds, each worker sends the number of
+pairs its current work unit scored and wrote and the number of errors through a
+queue (see report_progress in _match_executor). A thread in the main process sums
+them up and periodically prints the throughput and the estimated remaining time,
+and writes them to a status file for monitoring: JSON, or a Prometheus textfile if
+the file name ends with ".prom" (e.g. for the textfile collector of node_exporter).
+"""
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from multiprocessing.context import BaseContext
+from typing import Iterator, Optional
+
+# Seconds between the reports of each worker
+WORKER_REPORT_INTERVAL = 2.0
+
+_progress_queue: Optional[multiprocessing.Queue] = None
+_last_report_at = 0.0
+
+
+@dataclass(kw_only=True)
+class RunProgress:
+    # "running", "finished" or "failed"
+    state: str = "running"
+    started_at: float
+    updated_at: float
+    # Time of the last report of any worker, to tell a slow run from a stuck one
+    last_report_at: Optional[float] = None
+    units_total: int
+    units_finished: int = 0
+    pairs_total: int
+    pairs_scored: int = 0
+    pairs_written: int = 0
+    errors: int = 0
+    # Average since the start of the run and since the previous update
+    pairs_per_second: float = 0
+    recent_pairs_per_second: float = 0
+    eta_seconds: Optional[float] = None
+
+
+def attach_progress_queue(progress_queue: Optional[multiprocessing.Queue]) -> None:
+    """
+    Called in the pool initializer of the workers.
+    """
+    global _progress_queue, _last_report_at
+    _progress_queue = progress_queue
+    _last_report_at = 0.0
+
+
+def report_progress(
+    unit_start: int,
+    pairs_scored: int,
+    pairs_written: int,
+    errors: int,
+    finished: bool = False,
+) -> None:
+    """
+    Send the counts of the work unit starting at "unit_start" so far, at most every
+    WORKER_REPORT_INTERVAL seconds unless the unit is "finished".
+    """
+    global _last_report_at
+    if _progress_queue is None:
+        return
+    now = time.time()
+    if not finished and now - _last_report_at < WORKER_REPORT_INTERVAL:
+        return
+    _last_report_at = now
+    _progress_queue.put((unit_start, pairs_scored, pairs_written, errors, finished, now))
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
+
+
+def _print_progress(progress: RunProgress) -> None:
+    share = progress.pairs_scored / max(progress.pairs_total, 1)
+    print(
+        f"[Progress] {progress.pairs_scored}/{progress.pairs_total} pairs ({share:.1%}),"
+        f" {progress.units_finished}/{progress.units_total} units,"
+        f" {progress.recent_pairs_per_second:.0f} pairs/s ({progress.pairs_per_second:.0f} average),"
+        f" {progress.pairs_written} written, {progress.errors} errors,"
+        f" ETA {_format_duration(progress.eta_seconds)}"
+    )
+
+
+def _prometheus_text(progress: RunProgress) -> str:
+    metrics = [
+        ("running", "Whether the matching run is running", int(progress.state == "running")),
+        ("started_at_seconds", "Start of the run as unix time", progress.started_at),
+        ("updated_at_seconds", "Last update of this file as unix time", progress.updated_at),
+        ("last_report_at_seconds", "Last report of a worker as unix time", progress.last_report_at),
+        ("units_total", "Work units of the run", progress.units_total),
+        ("units_finished", "Finished work units", progress.units_finished),
+        ("pairs_total", "Pairs to score", progress.pairs_total),
+        ("pairs_scored", "Scored pairs", progress.pairs_scored),
+        ("pairs_written", "Written matches", progress.pairs_written),
+        ("errors", "Pairs and writes that failed", progress.errors),
+        ("pairs_per_second", "Scored pairs per second since the previous update", progress.recent_pairs_per_second),
+        ("eta_seconds", "Estimated seconds until all pairs are scored", progress.eta_seconds),
+    ]
+    lines = []
+    for name, description, value in metrics:
+        if value is None:
+            continue
+        lines.append(f"# HELP xpa_matching_{name} {description}")
+        lines.append(f"# TYPE xpa_matching_{name} gauge")
+        lines.append(f"xpa_matching_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_status(progress: RunProgress, status_path: str) -> None:
+    # Replaced atomically, so a scraper never reads a partial file
+    temporary_path = f"{status_path}.tmp"
+    with open(temporary_path, "w") as fp:
+        if status_path.endswith(".prom"):
+            fp.write(_prometheus_text(progress))
+        else:
+            json.dump(asdict(progress), fp, indent=2)
+    os.replace(temporary_path, status_path)
+
+
+def _monitor(
+    progress_queue: multiprocessing.Queue,
+    stop: threading.Event,
+    progress: RunProgress,
+    interval: float,
+    status_path: Optional[str],
+) -> None:
+    # Latest counts of each work unit: (pairs_scored, pairs_written, errors, finished)
+    units: dict[int, tuple[int, int, int, bool]] = {}
+    previous_at = progress.started_at
+    previous_pairs = 0
+    next_update_at = progress.started_at + interval
+    while True:
+        stopping = stop.is_set()
+        try:
+            unit_start, pairs_scored, pairs_written, errors, finished, reported_at = (
+                progress_queue.get(timeout=max(min(next_update_at - time.time(), 1.0), 0.01))
+            )
+            units[unit_start] = (pairs_scored, pairs_written, errors, finished)
+            progress.last_report_at = reported_at
+            continue
+        except queue.Empty:
+            pass
+        now = time.time()
+        if now < next_update_at and not stopping:
+            continue
+
+        progress.updated_at = now
+        progress.pairs_scored = sum(unit[0] for unit in units.values())
+        progress.pairs_written = sum(unit[1] for unit in units.values())
+        progress.errors = sum(unit[2] for unit in units.values())
+        progress.units_finished = sum(1 for unit in units.values() if unit[3])
+        progress.pairs_per_second = progress.pairs_scored / max(now - progress.started_at, 1e-9)
+        progress.recent_pairs_per_second = (progress.pairs_scored - previous_pairs) / max(
+            now - previous_at, 1e-9
+        )
+        remaining = max(progress.pairs_total - progress.pairs_scored, 0)
+        progress.eta_seconds = (
+            remaining / progress.pairs_per_second if progress.pairs_per_second > 0 else None
+        )
+        if stopping:
+            if progress.state == "running":
+                progress.state = "finished"
+            progress.eta_seconds = 0
+        previous_at = now
+        previous_pairs = progress.pairs_scored
+        next_update_at = now + interval
+
+        _print_progress(progress)
+        if status_path is not None:
+            try:
+                _write_status(progress, status_path)
+            except OSError as err:
+                print(f"[Progress] Could not write the status file: {err}")
+        if stopping:
+            return
+
+
+@contextmanager
+def progress_monitor(
+    mp_context: Optional[BaseContext],
+    units_total: int,
+    pairs_total: int,
+    interval: float = 30.0,
+    status_path: Optional[str] = None,
+) -> Iterator[multiprocessing.Queue]:
+    """
+    Monitor the progress of a run of "units_total" work units with "pairs_total"
+    pairs, printed and written to "status_path" every "interval" seconds and when the
+    run ends. Yields the queue that has to be passed to attach_progress_queue in each
+    worker of the pool, which must use the multiprocessing context "mp_context".
+    """
+    progress_queue = (mp_context or multiprocessing.get_context()).Queue()
+    started_at = time.time()
+    progress = RunProgress(
+        started_at=started_at,
+        updated_at=started_at,
+        units_total=units_total,
+        pairs_total=pairs_total,
+    )
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=_monitor,
+        args=(progress_queue, stop, progress, interval, status_path),
+        name="progress-monitor",
+        daemon=True,
+    )
+    thread.start()
+    try:
+        yield progress_queue
+    except BaseException:
+        progress.state = "failed"
+        raise
+    finally:
+        stop.set()
+        thread.join()
+        progress_queue.close()
@@ -0,0 +1,106 @@
+"""
+Fields of the app documents that the preparations and matchers read. Loading only
+these fields (see app_projection) keeps certificates, frameworks, permissions and raw
+plist data of the apps from being transferred and decoded at all.
+
+Functions that are not listed here may read any field, so all fields are loaded if
+one of them is used.
+"""
+from typing import Callable, Literal, Optional
+
+from app_matcher.features import prepare_features
+from app_matcher.matchers import (
+    match_app_id,
+    match_app_name,
+    match_deep_links,
+    match_description,
+    match_developer,
+    match_developer_url,
+    match_icon_hash,
+    match_language,
+    match_privacy_url,
+    prepare_image_hashes,
+    prepare_ios_descriptions,
+    prepare_tf_idf,
+)
+from app_matcher.related_work_matchers import (
+    ali_exact_match,
+    ali_exact_match_fixed,
+    han_exact_match_similar_description,
+    hu_similarity_match,
+    prepare_hu_strings,
+)
+
+# Required by the dataclasses or used for bookkeeping (incremental runs, resume)
+BASE_FIELDS = [
+    "run_id",
+    "path",
+    "app_id",
+    "app_hash",
+    "tool",
+    "created_at",
+    "analysis_type",
+    "os",
+]
+
+_IOS_URLS = ["metadata.urls"]
+_IOS_DEEP_LINKS = ["plist.custom_url_schemes", "entitlements.universal_links"]
+_ANDROID_DEEP_LINKS = ["apk_info.intent_filters"]
+_IOS_NAMES = ["metadata.name", "metadata.developer_name"]
+_ANDROID_NAMES = ["metadata.app_name", "metadata.developer_name"]
+
+# (iOS fields, Android fields) read by each function
+FIELDS: dict[Callable, tuple[list[str], list[str]]] = {
+    prepare_ios_descriptions: (["metadata.description"], []),
+    prepare_features: (
+        _IOS_URLS + _IOS_NAMES + _IOS_DEEP_LINKS,
+        ["metadata.urls"] + _ANDROID_NAMES + _ANDROID_DEEP_LINKS,
+    ),
+    prepare_tf_idf: (["metadata.description"], ["metadata.description"]),
+    prepare_image_hashes: (["icon"], ["icon"]),
+    prepare_hu_strings: (_IOS_NAMES, _ANDROID_NAMES),
+    match_privacy_url: (_IOS_URLS, ["metadata.urls"]),
+    match_developer_url: (_IOS_URLS, ["metadata.urls"]),
+    match_developer: (["metadata.developer_name"], ["metadata.developer_name"]),
+    match_app_id: ([], []),
+    match_app_name: (["metadata.name"], ["metadata.app_name"]),
+    match_deep_links: (_IOS_DEEP_LINKS, _ANDROID_DEEP_LINKS),
+    match_icon_hash: (["icon"], ["icon"]),
+    match_language: (["metadata.description_language"], ["metadata.description_language"]),
+    match_description: ([], []),
+    ali_exact_match: (_IOS_NAMES, _ANDROID_NAMES),
+    ali_exact_match_fixed: (_IOS_NAMES, _ANDROID_NAMES),
+    han_exact_match_similar_description: (_IOS_NAMES, _ANDROID_NAMES),
+    hu_similarity_match: ([], []),
+}
+
+# Read by build_candidates (see blocking.py)
+BLOCKING_FIELDS = (
+    _IOS_URLS + ["metadata.developer_name", "icon"],
+    ["metadata.urls", "metadata.developer_name", "icon"],
+)
+# Read by the cost estimate of the work units (see scheduling.py)
+COST_ORDERING_FIELDS = (_IOS_DEEP_LINKS + ["metadata.description"], [])
+
+
+def app_projection(
+    os: Literal["iOS", "Android"],
+    functions: list[Callable],
+    blocking: bool = False,
+    cost_ordering: bool = False,
+) -> Optional[dict[str, int]]:
+    """
+    Projection of the fields the given preparations and matchers read from the
+    documents of "os", None if all fields are needed.
+    """
+    side = 0 if os == "iOS" else 1
+    fields = set(BASE_FIELDS)
+    for function in functions:
+        if function not in FIELDS:
+            return None
+        fields.update(FIELDS[function][side])
+    if blocking:
+        fields.update(BLOCKING_FIELDS[side])
+    if cost_ordering:
+        fields.update(COST_ORDERING_FIELDS[side])
+    return {field: 1 for field in sorted(fields)}
@@ -2,8 +2,12 @@ import difflib
 import os
 import re
 import glob
+from functools import lru_cache
+from typing import Optional
 
+from rapidfuzz.distance import Indel
 from unidecode import unidecode
+from app_matcher.comparators import SCORE_CUTOFF_TOLERANCE
 from app_matcher.matchers import (
     cleanup_tf_idf,
     prepare_ios_descriptions,
@@ -16,10 +20,16 @@ from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios
     iOSPreprocessingResult,
 )
 
-from .tf_idf.tf_idf_shared_memory import get_similarities_sm
+from .tf_idf.tf_idf_shared_memory import get_description_similarity
 
 WORD_LIST_DIR = "./app_matcher/stop_word_lists"  # relative to xpa
 
+# Weights of the title and developer name similarities of Hu et al., pairs with a
+# weighted similarity of at most HU_MIN_SIMILARITY score 0
+HU_TITLE_WEIGHT = 0.8
+HU_DEVELOPER_WEIGHT = 0.2
+HU_MIN_SIMILARITY = 0.6
+
 
 def prepare_hu_strings(
     ios_apps: list[iOSPreprocessingResult],
@@ -135,7 +145,7 @@ def han_exact_match_similar_description(
     ios_developer_name = ios_app.metadata.get("developer_name", "")
     android_developer_name = android_app.metadata.get("developer_name", "")
 
-    description_similarity = get_similarities_sm()[ios_index, android_index]
+    description_similarity = get_description_similarity(ios_index, android_index)
 
     match_title = ios_title.lower() == android_title.lower()
     match_develper_name = ios_developer_name.lower() == android_developer_name.lower()
@@ -146,12 +156,115 @@ def han_exact_match_similar_description(
         return {"han_exact_match_similar_description": 0.0}
 
 
+@lru_cache(maxsize=None)
+def _case_key(char: str) -> str:
+    # All characters that re.IGNORECASE matches with "char" (through their lower and
+    # upper cases) share the smallest of their case folds
+    equivalents = {char}
+    pending = [char]
+    while len(pending) > 0:
+        current = pending.pop()
+        for other in (current.lower()[0], current.upper(), current.casefold()):
+            if len(other) == 1 and other not in equivalents:
+                equivalents.add(other)
+                pending.append(other)
+    return min(equivalent.casefold() for equivalent in equivalents)
+
+
+def _ignore_case_key(text: str) -> str:
+    return "".join(map(_case_key, text))
+
+
+def _exact_match_keys(title: str, developer_name: str, is_ios: bool) -> list[tuple]:
+    """
+    Join keys of an app for the exact matchers: lowercase for ali_exact_match_fixed and
+    han_exact_match_similar_description, and keys under which all strings the regexes
+    of ali_exact_match match collide. Their "$" also matches before a trailing newline
+    of the iOS strings.
+    """
+    keys = [("lower", title.lower(), developer_name.lower())]
+    titles = [title]
+    developer_names = [developer_name]
+    if is_ios and title.endswith("\n"):
+        titles.append(title[:-1])
+    if is_ios and developer_name.endswith("\n"):
+        developer_names.append(developer_name[:-1])
+    for title in titles:
+        for developer_name in developer_names:
+            keys.append(("regex", _ignore_case_key(title), _ignore_case_key(developer_name)))
+    return keys
+
+
+def exact_match_candidates(
+    ios_apps: list[iOSPreprocessingResult],
+    android_apps: list[AndroidPreprocessingResult],
+) -> list[list[int]]:
+    """
+    For each iOS app, the indexes of the Android apps that ali_exact_match,
+    ali_exact_match_fixed or han_exact_match_similar_description can score with 1,
+    found by a hash join on their (title, developer name) keys. All other pairs score
+    0 with these matchers, so only the joined pairs have to be scored (e.g. as the
+    candidates of match_all). Apps without a title or developer name string are left
+    out.
+    """
+    android_indexes: dict[tuple, list[int]] = {}
+    for android_index, android_app in enumerate(android_apps):
+        title = android_app.metadata.get("app_name", "")
+        developer_name = android_app.metadata.get("developer_name", "")
+        if not isinstance(title, str) or not isinstance(developer_name, str):
+            continue
+        for key in _exact_match_keys(title, developer_name, is_ios=False):
+            android_indexes.setdefault(key, []).append(android_index)
+
+    candidates = []
+    for ios_app in ios_apps:
+        title = ios_app.metadata.get("name", "")
+        developer_name = ios_app.metadata.get("developer_name", "")
+        matches = set()
+        if isinstance(title, str) and isinstance(developer_name, str):
+            for key in _exact_match_keys(title, developer_name, is_ios=True):
+                matches.update(android_indexes.get(key, []))
+        candidates.append(sorted(matches))
+    return candidates
+
+
 # implementation of cross platform app matching based on
 
 
 # we had to make assumptions regarding the preprocessing, as the code is not available and the paper does not discuss which stop word list was used.
+def hu_upper_bound(
+    ios_title: str, android_title: str, ios_developer_name: str, android_developer_name: str
+) -> float:
+    """
+    Upper bound of the weighted similarity of hu_similarity_match. difflib's ratio is
+    2 * M / (len(a) + len(b)) with M matching characters, which can't exceed the
+    longest common subsequence of the Indel similarity 2 * LCS / (len(a) + len(b)).
+    """
+    return HU_TITLE_WEIGHT * Indel.normalized_similarity(
+        ios_title, android_title
+    ) + HU_DEVELOPER_WEIGHT * Indel.normalized_similarity(
+        ios_developer_name, android_developer_name
+    )
+
+
+def hu_score(
+    ios_title: str, android_title: str, ios_developer_name: str, android_developer_name: str
+) -> float:
+    similarity_score = (
+        HU_TITLE_WEIGHT * difflib.SequenceMatcher(a=ios_title, b=android_title).ratio()
+        + HU_DEVELOPER_WEIGHT
+        * difflib.SequenceMatcher(
+            a=ios_developer_name, b=android_developer_name
+        ).ratio()
+    )
+
+    return 0 if similarity_score <= HU_MIN_SIMILARITY else similarity_score
+
+
 def hu_similarity_match(
-    ios_app: iOSPreprocessingResult, android_app: AndroidPreprocessingResult
+    ios_app: iOSPreprocessingResult,
+    android_app: AndroidPreprocessingResult,
+    score_cutoff: Optional[float] = None,
 ) -> dict[str, float]:
     ios_title = ios_app.metadata.get("name_hu", "")
     android_title = android_app.metadata.get("app_name_hu", "")
@@ -161,20 +274,25 @@ def hu_similarity_match(
     if ios_title == android_title and ios_developer_name == android_developer_name:
         return {"hu_similarity_match": 1.0}
 
-    similarity_score = (
-        0.8 * difflib.SequenceMatcher(a=ios_title, b=android_title).ratio()
-        + 0.2
-        * difflib.SequenceMatcher(
-            a=ios_developer_name, b=android_developer_name
-        ).ratio()
+    # The exact similarity is only calculated if it can exceed the threshold
+    upper_bound = hu_upper_bound(
+        ios_title, android_title, ios_developer_name, android_developer_name
     )
+    if upper_bound < max(HU_MIN_SIMILARITY, score_cutoff or 0) - SCORE_CUTOFF_TOLERANCE:
+        return {"hu_similarity_match": 0}
 
-    return {"hu_similarity_match": 0 if similarity_score <= 0.6 else similarity_score}
+    return {
+        "hu_similarity_match": hu_score(
+            ios_title, android_title, ios_developer_name, android_developer_name
+        )
+    }
 
 
 ALI_ET_AL_MATCHERS = [ali_exact_match, ali_exact_match_fixed]
 HAN_ET_AL_MATCHERS = [han_exact_match_similar_description]
 HU_ET_AL_MATCHERS = [hu_similarity_match]
+# The matchers whose nonzero scores are all among the pairs of exact_match_candidates
+EXACT_MATCH_MATCHERS = ALI_ET_AL_MATCHERS + HAN_ET_AL_MATCHERS
 
 RELATED_WORK_PREPARES = [prepare_ios_descriptions, prepare_tf_idf, prepare_hu_strings]
 RELATED_WORK_MATCHERS = ALI_ET_AL_MATCHERS + HU_ET_AL_MATCHERS
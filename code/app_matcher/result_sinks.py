@@ -0,0 +1,201 @@
+"""
+Destinations for the matching results. Every work unit writes its results through its
+own sink, so the file based sinks write one file per work unit (partitioned by the
+index of its first iOS app) and no locking between the workers is needed. A file per
+unit instead of per worker keeps the files consistent with the progress records of
+--resume; use a larger --work-unit-size to get fewer, larger files.
+
+- "mongo": Inserts the results into the matches collection.
+- "jsonl": Writes gzip compressed JSON lines to <output_dir>/<matches>/part-<unit>.jsonl.gz
+- "parquet": Writes Parquet files to <output_dir>/<matches>/part-<unit>.parquet, which
+  can be read as one dataset with Arrow/pandas. Requires pyarrow.
+
+Files are written under a temporary name and only renamed once the work unit is
+complete, so a directory never contains partial files of an interrupted run.
+"""
+import glob
+import gzip
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from pymongo import WriteConcern
+
+from database.db_connector import get_collection
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Only needed for the parquet sink
+    pyarrow = None
+
+RESULT_SINKS = ["mongo", "jsonl", "parquet"]
+
+
+class ResultSink(ABC):
+    @abstractmethod
+    def write(self, results: list[dict]) -> None:
+        pass
+
+    def close(self) -> None:
+        """
+        Persist everything written so far. Called once after the last write.
+        """
+        pass
+
+    def abort(self) -> None:
+        """
+        Discard everything that was not persisted yet. Called instead of close if
+        the work unit failed.
+        """
+        pass
+
+
+def parse_write_concern(value: str) -> WriteConcern:
+    """
+    Parses "majority", a tag set name or a number of nodes.
+    """
+    return WriteConcern(w=int(value) if value.isdigit() else value)
+
+
+class MongoResultSink(ResultSink):
+    def __init__(self, matches_coll_name: str, write_concern: Optional[str] = None):
+        self.matches_coll = get_collection(matches_coll_name)
+        if write_concern is not None:
+            self.matches_coll = self.matches_coll.with_options(
+                write_concern=parse_write_concern(write_concern)
+            )
+
+    def write(self, results: list[dict]) -> None:
+        # bulk insert for better performance, also we set ordered to false so the documents can be inserted in arbitrary order
+        # see https://pymongo.readthedocs.io/en/stable/api/pymongo/collection.html#pymongo.collection.Collection.insert_many
+        self.matches_coll.insert_many(results, ordered=False)
+
+
+class _FileResultSink(ResultSink):
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+
+    def close(self) -> None:
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class JsonlResultSink(_FileResultSink):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.fp = gzip.open(self.tmp_path, "wt", encoding="utf-8")
+
+    def write(self, results: list[dict]) -> None:
+        for result in results:
+            self.fp.write(json.dumps(result, default=str))
+            self.fp.write("\n")
+
+    def close(self) -> None:
+        self.fp.close()
+        super().close()
+
+    def abort(self) -> None:
+        self.fp.close()
+        super().abort()
+
+
+class ParquetResultSink(_FileResultSink):
+    def __init__(self, path: str):
+        if pyarrow is None:
+            raise RuntimeError("The parquet result sink requires pyarrow")
+        super().__init__(path)
+        self.writer: Optional[pyarrow.parquet.ParquetWriter] = None
+
+    @staticmethod
+    def _schema(result: dict) -> "pyarrow.Schema":
+        pa = pyarrow
+        # Scores are stored as struct of doubles, so all files share the same schema
+        # even if a chunk only contains integer scores
+        return pa.schema(
+            [
+                ("ios_id", pa.string()),
+                ("android_id", pa.string()),
+                ("scores", pa.struct([(key, pa.float64()) for key in result["scores"]])),
+                ("weighted_score", pa.float64()),
+                ("average_score", pa.float64()),
+                ("linear_score", pa.float64()),
+            ]
+        )
+
+    def write(self, results: list[dict]) -> None:
+        if len(results) == 0:
+            return
+        if self.writer is None:
+            schema = self._schema(results[0])
+            self.writer = pyarrow.parquet.ParquetWriter(self.tmp_path, schema, compression="zstd")
+        table = pyarrow.Table.from_pylist(results, schema=self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self) -> None:
+        if self.writer is None:
+            # No results in this work unit
+            return
+        self.writer.close()
+        super().close()
+
+    def abort(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        super().abort()
+
+
+def _sink_dir(output_dir: str, matches_coll_name: str) -> str:
+    return os.path.join(output_dir, matches_coll_name)
+
+
+def prepare_output_dir(
+    kind: str, matches_coll_name: str, output_dir: Optional[str], resume: bool
+) -> None:
+    """
+    Check the output directory of a file based sink before a run. A resumed run
+    removes the temporary files of the interrupted one, a new run refuses to mix its
+    files with the ones of a previous run.
+    """
+    if kind == "mongo":
+        return
+    if output_dir is None:
+        raise ValueError(f"The {kind} result sink requires an output directory")
+    sink_dir = _sink_dir(output_dir, matches_coll_name)
+    if resume:
+        for tmp_path in glob.glob(os.path.join(sink_dir, "part-*.tmp")):
+            os.remove(tmp_path)
+    elif len(glob.glob(os.path.join(sink_dir, "part-*"))) > 0:
+        raise ValueError(
+            f"{sink_dir} already contains results, remove them or resume the run"
+        )
+
+
+def open_result_sink(
+    kind: str,
+    matches_coll_name: str,
+    output_dir: Optional[str],
+    unit_start: int,
+    write_concern: Optional[str] = None,
+) -> ResultSink:
+    """
+    Open the sink for the work unit starting at iOS app index "unit_start". The
+    "write_concern" only applies to the mongo sink.
+    """
+    if kind == "mongo":
+        return MongoResultSink(matches_coll_name, write_concern)
+    if kind not in RESULT_SINKS:
+        raise ValueError(f"Unknown result sink {kind}, expected one of {RESULT_SINKS}")
+    if output_dir is None:
+        raise ValueError(f"The {kind} result sink requires an output directory")
+    part = os.path.join(_sink_dir(output_dir, matches_coll_name), f"part-{unit_start:08d}")
+    if kind == "jsonl":
+        return JsonlResultSink(f"{part}.jsonl.gz")
+    return ParquetResultSink(f"{part}.parquet")
@@ -0,0 +1,158 @@
+"""
+Splits the iOS apps into many small work units that are handed out to the workers as
+they become free, and reports how busy each worker was during the run.
+"""
+from dataclasses import dataclass
+from math import ceil
+from typing import Optional
+
+from app_matcher.profiling import MatcherProfile
+from database.analysis_results.preprocessing_result.ios_preprocessing_result.ios_preprocessing_result import (
+    iOSPreprocessingResult,
+)
+
+# Number of work units per worker if no unit size is given
+UNITS_PER_WORKER = 16
+
+
+@dataclass(kw_only=True)
+class WorkUnit:
+    # Range of iOS app indexes [start, end)
+    start: int
+    end: int
+    estimated_cost: float = 0
+
+
+@dataclass(kw_only=True)
+class WorkUnitStats:
+    pid: int
+    started_at: float
+    finished_at: float
+    targets: int
+    pairs: int
+    # Pairs dropped by cascade scoring before all matchers ran, part of "pairs"
+    pruned: int = 0
+    # Whether some results of the unit could not be persisted
+    failed: bool = False
+    # Seconds scoring waited for the result writer and number of retried writes
+    write_blocked: float = 0
+    write_retries: int = 0
+    # Calls and time of each matcher if profiled, see profiling.py
+    profile: Optional[MatcherProfile] = None
+
+
+def target_cost_weight(ios_app: iOSPreprocessingResult) -> float:
+    """
+    Rough relative cost of matching an iOS app against one candidate. The pairwise
+    work grows with the number of URL schemes and universal links (deep link matcher)
+    and the length of the description.
+    """
+    # Compact apps (see corpus.py) store the weight of their source document
+    cost_weight = getattr(ios_app, "cost_weight", None)
+    if cost_weight is not None:
+        return cost_weight
+    url_schemes = sum(
+        len(list_item)
+        for list_item in (ios_app.plist or {}).get("custom_url_schemes", []) or []
+        if list_item is not None
+    )
+    app_links = len((ios_app.entitlements or {}).get("universal_links", []) or [])
+    description = (ios_app.metadata or {}).get("description") or ""
+    return 1 + (url_schemes + app_links) / 10 + len(description) / 10000
+
+
+def estimate_target_cost(ios_app: iOSPreprocessingResult, candidate_count: int) -> float:
+    """
+    Rough relative cost of matching an iOS app, which also grows with the number of
+    candidates.
+    """
+    return candidate_count * target_cost_weight(ios_app)
+
+
+def create_work_units(
+    ios_apps: list[iOSPreprocessingResult],
+    android_count: int,
+    threads: int,
+    unit_size: Optional[int] = None,
+    candidates: Optional[list[list[int]]] = None,
+    cost_ordering: bool = False,
+    skip: Optional[set[int]] = None,
+) -> list[WorkUnit]:
+    """
+    Split the iOS apps into consecutive work units of "unit_size" apps (by default
+    about UNITS_PER_WORKER units per worker). iOS app indexes in "skip" are left out.
+    With "cost_ordering", the units are sorted by their estimated cost, most
+    expensive first, so that no expensive unit is left for the end of the run.
+    """
+    skip = skip or set()
+    if unit_size is None:
+        remaining = len(ios_apps) - len(skip)
+        unit_size = max(ceil(remaining / (threads * UNITS_PER_WORKER)), 1)
+
+    units: list[WorkUnit] = []
+    start = 0
+    while start < len(ios_apps):
+        if start in skip:
+            start += 1
+            continue
+        end = start + 1
+        while end < len(ios_apps) and end - start < unit_size and end not in skip:
+            end += 1
+        units.append(WorkUnit(start=start, end=end))
+        start = end
+    if not cost_ordering:
+        return units
+
+    for unit in units:
+        unit.estimated_cost = sum(
+            estimate_target_cost(
+                ios_apps[ios_index],
+                android_count if candidates is None else len(candidates[ios_index]),
+            )
+            for ios_index in range(unit.start, unit.end)
+        )
+    return sorted(units, key=lambda unit: unit.estimated_cost, reverse=True)
+
+
+def print_worker_report(
+    unit_stats: list[WorkUnitStats],
+    run_started_at: float,
+    run_finished_at: float,
+    threads: int,
+) -> None:
+    """
+    Print the busy and idle time of each of the "threads" worker processes. Idle time
+    is the time of the run in which a worker did not process any work unit, workers
+    that never received a unit were idle for the whole run.
+    """
+    wall_time = max(run_finished_at - run_started_at, 1e-9)
+    workers: dict[int, list[WorkUnitStats]] = {}
+    for stats in unit_stats:
+        workers.setdefault(stats.pid, []).append(stats)
+
+    total_busy = 0.0
+    for pid, worker_stats in sorted(workers.items()):
+        busy = sum(stats.finished_at - stats.started_at for stats in worker_stats)
+        total_busy += busy
+        pairs = sum(stats.pairs for stats in worker_stats)
+        pruned = sum(stats.pruned for stats in worker_stats)
+        write_blocked = sum(stats.write_blocked for stats in worker_stats)
+        write_retries = sum(stats.write_retries for stats in worker_stats)
+        print(
+            f"[Scheduler] Worker {pid}: {len(worker_stats)} units, {pairs} pairs ({pruned} pruned),"
+            f" busy {busy:.1f}s, idle {wall_time - busy:.1f}s ({busy / wall_time:.1%} utilization),"
+            f" blocked on writes {write_blocked:.1f}s, {write_retries} write retries"
+        )
+    pool_size = max(threads, len(workers), 1)
+    unused = pool_size - len(workers)
+    if unused > 0:
+        print(
+            f"[Scheduler] {unused} workers received no work unit: idle {wall_time:.1f}s each"
+        )
+    total_idle = wall_time * pool_size - total_busy
+    print(
+        f"[Scheduler] {len(unit_stats)} units in {wall_time:.1f}s on {pool_size} workers:"
+        f" busy {total_busy:.1f}s, idle {total_idle:.1f}s"
+        f" ({total_busy / (wall_time * pool_size):.1%} utilization)"
+    )
+
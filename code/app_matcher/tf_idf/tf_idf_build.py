@@ -0,0 +1,221 @@
+"""
+Builds the TF-IDF vectors and the description similarities with several worker
+processes (see prepare_tf_idf).
+
+The vectorizer is fitted in two passes over chunks of the distinct descriptions: the
+workers count the document frequencies of the terms of their chunk, which are merged
+into the vocabulary, and then transform their chunk with the resulting vectorizer.
+Identical descriptions (e.g. boilerplate texts) are only analyzed once. The
+similarities are calculated in blocks of iOS apps, so only a block of the full
+product is held by each worker at once.
+"""
+from collections import Counter
+from concurrent import futures
+from typing import Iterator, Optional
+
+import numpy
+import scipy.sparse
+from scipy.sparse import spmatrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+# Number of distinct descriptions analyzed by a worker at once
+DESCRIPTION_CHUNK_SIZE = 5000
+# Number of iOS apps whose similarities are calculated at once
+SIMILARITY_BLOCK_SIZE = 256
+
+# State of the worker processes, set by the pool initializers
+_worker_analyzer = None
+_worker_vectorizer: Optional[TfidfVectorizer] = None
+_worker_vectors: Optional[tuple[spmatrix, spmatrix]] = None
+
+
+def _init_analyzer(stop_words: list[str]):
+    global _worker_analyzer
+    _worker_analyzer = TfidfVectorizer(stop_words=stop_words).build_analyzer()
+
+
+def _document_frequencies(chunk: list[tuple[str, int]]) -> Counter:
+    frequencies = Counter()
+    for description, occurrences in chunk:
+        for term in set(_worker_analyzer(description)):
+            frequencies[term] += occurrences
+    return frequencies
+
+
+def _init_vectorizer(vectorizer: TfidfVectorizer):
+    global _worker_vectorizer
+    _worker_vectorizer = vectorizer
+
+
+def _transform(descriptions: list[str]) -> spmatrix:
+    return _worker_vectorizer.transform(descriptions)
+
+
+def _chunks(items: list, size: int) -> list[list]:
+    return [items[start : start + size] for start in range(0, len(items), size)]
+
+
+def fitted_vectorizer(
+    terms: list[str], idf: numpy.ndarray, stop_words: list[str]
+) -> TfidfVectorizer:
+    """
+    TfidfVectorizer(stop_words=stop_words) fitted with the vocabulary "terms" (in the
+    order of their indexes) and their "idf" weights.
+    """
+    vectorizer = TfidfVectorizer(
+        stop_words=stop_words, vocabulary={term: index for index, term in enumerate(terms)}
+    )
+    vectorizer.fit([""])
+    vectorizer.idf_ = numpy.asarray(idf, dtype=numpy.float64)
+    return vectorizer
+
+
+def fit_transform(
+    descriptions: list[str], stop_words: list[str], workers: int
+) -> tuple[TfidfVectorizer, spmatrix]:
+    """
+    Same vectorizer and vectors as TfidfVectorizer(stop_words=stop_words)
+    .fit_transform(descriptions), calculated by "workers" processes.
+    """
+    occurrences = Counter(descriptions)
+    distinct_descriptions = list(occurrences)
+    print(
+        f"[TF-IDF] Analyzing {len(distinct_descriptions)} distinct of {len(descriptions)} descriptions with {workers} processes"
+    )
+
+    with futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_analyzer, initargs=(stop_words,)
+    ) as pool:
+        frequencies = Counter()
+        for chunk_frequencies in pool.map(
+            _document_frequencies,
+            _chunks(
+                [(description, occurrences[description]) for description in distinct_descriptions],
+                DESCRIPTION_CHUNK_SIZE,
+            ),
+        ):
+            frequencies.update(chunk_frequencies)
+    if len(frequencies) == 0:
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+
+    # As fitted by TfidfVectorizer: sorted vocabulary, smoothed idf
+    terms = sorted(frequencies)
+    document_frequencies = numpy.array([frequencies[term] for term in terms], dtype=numpy.float64)
+    vectorizer = fitted_vectorizer(
+        terms,
+        numpy.log((len(descriptions) + 1) / (document_frequencies + 1)) + 1.0,
+        stop_words,
+    )
+    del frequencies
+
+    with futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_vectorizer, initargs=(vectorizer,)
+    ) as pool:
+        distinct_vectors = scipy.sparse.vstack(
+            list(pool.map(_transform, _chunks(distinct_descriptions, DESCRIPTION_CHUNK_SIZE))),
+            format="csr",
+        )
+    description_indexes = {description: index for index, description in enumerate(distinct_descriptions)}
+    return vectorizer, distinct_vectors[[description_indexes[description] for description in descriptions], :]
+
+
+def _init_vectors(ios_vectors: spmatrix, android_vectors: spmatrix):
+    global _worker_vectors
+    _worker_vectors = (ios_vectors, android_vectors)
+
+
+def _dense_block(block_start: int, dtype) -> numpy.ndarray:
+    ios_vectors, android_vectors = _worker_vectors
+    return cosine_similarity(
+        ios_vectors[block_start : block_start + SIMILARITY_BLOCK_SIZE], android_vectors
+    ).astype(dtype, copy=False)
+
+
+def _top_block(
+    block_start: int, top_k: Optional[int], min_similarity: Optional[float]
+) -> tuple[list[int], list[numpy.ndarray], list[numpy.ndarray]]:
+    ios_vectors, android_vectors = _worker_vectors
+    block = cosine_similarity(
+        ios_vectors[block_start : block_start + SIMILARITY_BLOCK_SIZE],
+        android_vectors,
+        dense_output=False,
+    ).tocsr()
+    row_lengths, indices, data = [], [], []
+    for row in range(block.shape[0]):
+        row_indices = block.indices[block.indptr[row] : block.indptr[row + 1]]
+        row_data = block.data[block.indptr[row] : block.indptr[row + 1]]
+        if min_similarity is not None:
+            keep = row_data >= min_similarity
+            row_indices, row_data = row_indices[keep], row_data[keep]
+        if top_k is not None and len(row_data) > top_k:
+            best = numpy.lexsort((row_indices, -row_data))[:top_k]
+            row_indices, row_data = row_indices[best], row_data[best]
+        order = numpy.argsort(row_indices)
+        row_lengths.append(len(order))
+        indices.append(row_indices[order])
+        data.append(row_data[order])
+    return row_lengths, indices, data
+
+
+def _blocks(
+    ios_vectors: spmatrix, android_vectors: spmatrix, workers: int, block_function, *args
+) -> Iterator:
+    """
+    Results of "block_function" for each block of iOS apps, in order. Calculated in
+    this process if "workers" is 1.
+    """
+    block_starts = range(0, ios_vectors.shape[0], SIMILARITY_BLOCK_SIZE)
+    if workers <= 1:
+        _init_vectors(ios_vectors, android_vectors)
+        try:
+            for block_start in block_starts:
+                yield block_start, block_function(block_start, *args)
+        finally:
+            _init_vectors(None, None)
+        return
+    with futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_vectors, initargs=(ios_vectors, android_vectors)
+    ) as pool:
+        yield from zip(
+            block_starts,
+            pool.map(block_function, block_starts, *[[arg] * len(block_starts) for arg in args]),
+        )
+
+
+def dense_similarities(
+    ios_vectors: spmatrix, android_vectors: spmatrix, out: numpy.ndarray, workers: int = 1
+) -> None:
+    """
+    Write the cosine similarities of all iOS (rows) and Android (columns) apps into "out".
+    """
+    for block_start, block in _blocks(ios_vectors, android_vectors, workers, _dense_block, out.dtype):
+        out[block_start : block_start + block.shape[0]] = block
+
+
+def top_similarities(
+    ios_vectors: spmatrix,
+    android_vectors: spmatrix,
+    top_k: Optional[int],
+    min_similarity: Optional[float],
+    workers: int = 1,
+) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    CSR matrix (indptr, indices, data) with the "top_k" most similar Android apps of
+    each iOS app that have a similarity of at least "min_similarity". Ties are broken
+    by the lower Android index.
+    """
+    row_lengths = [0]
+    indices = []
+    data = []
+    for _, (block_row_lengths, block_indices, block_data) in _blocks(
+        ios_vectors, android_vectors, workers, _top_block, top_k, min_similarity
+    ):
+        row_lengths.extend(block_row_lengths)
+        indices.extend(block_indices)
+        data.extend(block_data)
+    return (
+        numpy.cumsum(row_lengths, dtype=numpy.int64),
+        numpy.concatenate(indices or [numpy.empty(0)]).astype(numpy.int32),
+        numpy.concatenate(data or [numpy.empty(0)]).astype(numpy.double),
+    )
@@ -0,0 +1,154 @@
+"""
+On-disk cache of the TF-IDF preparation. The fitted vectorizer and the document
+vectors are stored in <cache_dir>/<corpus key>, the key being a hash of the app
+hashes, descriptions and stop words. The similarities of each storage mode (dense or
+top-k, dtype) are stored as .npy files in a sub-directory of it, which the matching
+processes memory map instead of copying them to shared memory.
+
+Entries are written to a temporary directory and renamed once complete, so
+concurrent runs never see a partial entry. Entries are never removed automatically.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from typing import Optional
+
+import numpy
+import scipy.sparse
+import sklearn
+from scipy.sparse import spmatrix
+
+_COMPLETE_MARKER = "complete"
+_VECTORIZER_FILE = "vectorizer.pickle"
+_IOS_VECTORS_FILE = "ios_vectors.npz"
+_ANDROID_VECTORS_FILE = "android_vectors.npz"
+_INFO_FILE = "info.json"
+
+
+def corpus_key(
+    ios_app_hashes: list[str],
+    ios_descriptions: list[str],
+    android_app_hashes: list[str],
+    android_descriptions: list[str],
+    stop_words: set[str],
+) -> str:
+    digest = hashlib.sha256()
+    # Results of different scikit-learn versions may differ
+    digest.update(f"sklearn {sklearn.__version__}\0".encode("utf-8"))
+    for word in sorted(stop_words):
+        digest.update(f"{word}\0".encode("utf-8"))
+    for app_hashes, descriptions in (
+        (ios_app_hashes, ios_descriptions),
+        (android_app_hashes, android_descriptions),
+    ):
+        digest.update(f"{len(app_hashes)}\0".encode("utf-8"))
+        for app_hash, description in zip(app_hashes, descriptions):
+            digest.update(f"{app_hash}\0{description}\0".encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()
+
+
+def similarities_key(options: dict) -> str:
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def _is_complete(path: str) -> bool:
+    return os.path.exists(os.path.join(path, _COMPLETE_MARKER))
+
+
+def _commit(tmp_path: str, path: str) -> None:
+    with open(os.path.join(tmp_path, _COMPLETE_MARKER), "w"):
+        pass
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Stored by a concurrent run in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not _is_complete(path):
+            raise
+
+
+def corpus_dir(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key)
+
+
+def load_vectors(
+    cache_dir: str, key: str
+) -> Optional[tuple[object, spmatrix, spmatrix]]:
+    """
+    Vectorizer and iOS and Android document vectors of the corpus, None if not cached.
+    """
+    path = corpus_dir(cache_dir, key)
+    if not _is_complete(path):
+        return None
+    with open(os.path.join(path, _VECTORIZER_FILE), "rb") as fp:
+        vectorizer = pickle.load(fp)
+    return (
+        vectorizer,
+        scipy.sparse.load_npz(os.path.join(path, _IOS_VECTORS_FILE)),
+        scipy.sparse.load_npz(os.path.join(path, _ANDROID_VECTORS_FILE)),
+    )
+
+
+def save_vectors(
+    cache_dir: str,
+    key: str,
+    vectorizer: object,
+    ios_vectors: spmatrix,
+    android_vectors: spmatrix,
+) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=f".{key}-", dir=cache_dir)
+    try:
+        with open(os.path.join(tmp_path, _VECTORIZER_FILE), "wb") as fp:
+            pickle.dump(vectorizer, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        scipy.sparse.save_npz(os.path.join(tmp_path, _IOS_VECTORS_FILE), ios_vectors.tocsr())
+        scipy.sparse.save_npz(
+            os.path.join(tmp_path, _ANDROID_VECTORS_FILE), android_vectors.tocsr()
+        )
+        _commit(tmp_path, corpus_dir(cache_dir, key))
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def similarities_dir(cache_dir: str, key: str, options: dict) -> str:
+    return os.path.join(corpus_dir(cache_dir, key), f"similarities-{similarities_key(options)}")
+
+
+def load_similarities_info(cache_dir: str, key: str, options: dict) -> Optional[dict]:
+    """
+    Shape, number of stored similarities and dtype of the cached similarities, None if
+    not cached. The .npy files are in similarities_dir.
+    """
+    path = similarities_dir(cache_dir, key, options)
+    if not _is_complete(path):
+        return None
+    with open(os.path.join(path, _INFO_FILE), "r") as fp:
+        return json.load(fp)
+
+
+def save_similarities(
+    cache_dir: str,
+    key: str,
+    options: dict,
+    arrays: dict[str, numpy.ndarray],
+    info: dict,
+) -> str:
+    """
+    Store the similarity arrays as <name>.npy files, returns their directory.
+    """
+    path = similarities_dir(cache_dir, key, options)
+    tmp_path = tempfile.mkdtemp(prefix=".similarities-", dir=corpus_dir(cache_dir, key))
+    try:
+        for name, array in arrays.items():
+            numpy.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        with open(os.path.join(tmp_path, _INFO_FILE), "w") as fp:
+            json.dump(info | {"options": options}, fp)
+        _commit(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return path
@@ -1,79 +1,236 @@
-from multiprocessing import current_process
+import atexit
+import os
+import signal
+import sys
+import threading
+from multiprocessing import current_process, parent_process
 from multiprocessing.shared_memory import SharedMemory
 from typing import Optional
 
 import numpy
 
-TF_IDF_SM_NAME_WIDTH = 'TF-IDF width'
-_width_sm: Optional[SharedMemory] = None
-_width_array: Optional[numpy.ndarray] = None
-TF_IDF_SM_NAME_HEIGHT = 'TF-IDF height'
-_height_sm: Optional[SharedMemory] = None
-_height_array: Optional[numpy.ndarray] = None
-TF_IDF_SM_SIMILARITIES = 'TF-IDF android->ios'
-_similarities_sm: Optional[SharedMemory] = None
-_similarities_array: Optional[numpy.ndarray] = None
+# Segments are named <prefix><pid of the main process>-<name>, so several runs can
+# share a host and the segments of crashed runs can be found (see remove_stale_segments)
+SEGMENT_PREFIX = 'xpa-'
+SHM_DIR = '/dev/shm'
+TF_IDF_SM_HEADER = 'header'
+# Directory of the similarity files, see use_similarity_files
+TF_IDF_SM_LOCATION = 'location'
+TF_IDF_SM_SIMILARITIES = 'similarities'
+TF_IDF_SM_INDPTR = 'indptr'
+TF_IDF_SM_INDICES = 'indices'
+TF_IDF_SM_DATA = 'data'
+
+# Storage types of the similarities, float32 halves the memory
+DTYPES = {'float64': numpy.float64, 'float32': numpy.float32}
+_DTYPE_NAMES = list(DTYPES)
+
+# Sparse mode: only the top-k and/or sufficiently similar Android apps of each iOS app
+# are stored as CSR matrix (see prepare_tf_idf), all other pairs have this similarity
+MISSING_SIMILARITY = 0.0
 
 _is_root_process = current_process().name == 'MainProcess'
+_root_pid: Optional[int] = None
+_segments: dict[str, tuple[SharedMemory, numpy.ndarray]] = {}
+# Memory mapped similarity files
+_files: dict[str, numpy.ndarray] = {}
+_cleanup_registered = False
+
 
-def get_width_sm():
-  global _width_sm
-  global _width_array
-  if _width_array is not None:
-    return _width_array
-  _width_sm = SharedMemory(TF_IDF_SM_NAME_WIDTH, create=_is_root_process, size=numpy.int64().itemsize)
-  _width_array = numpy.ndarray((1,), buffer=_width_sm.buf, dtype=numpy.int64)
-  _width_array.nbytes
-  return _width_array
-
-def cleanup_width_sm():
-  global _width_sm
-  global _width_array
-  if _width_sm is None:
+def _segment_name(name: str) -> str:
+  global _root_pid
+  if _root_pid is None:
+    # Workers are started by the main process. Not known yet while a spawned worker
+    # imports its modules, forked workers inherit the value.
+    _root_pid = os.getpid() if _is_root_process else parent_process().pid
+  return f'{SEGMENT_PREFIX}{_root_pid}-{name}'
+
+
+def _register_cleanup():
+  """
+  Remove the segments when the main process exits, also on exceptions and SIGTERM.
+  """
+  global _cleanup_registered
+  if _cleanup_registered:
     return
-  _width_sm.close()
-  if _is_root_process:
-    _width_sm.unlink()
-  _width_sm = None
-  _width_array = None
-
-def get_height_sm():
-  global _height_sm
-  global _height_array
-  if _height_array is not None:
-    return _height_array
-  _height_sm = SharedMemory(TF_IDF_SM_NAME_HEIGHT, create=_is_root_process, size=numpy.int64().itemsize)
-  _height_array = numpy.ndarray((1,), buffer=_height_sm.buf, dtype=numpy.int64)
-  return _height_array
-
-def cleanup_height_sm():
-  global _height_sm
-  global _height_array
-  if _height_sm is None:
+  atexit.register(cleanup_similarities_sm)
+  if threading.current_thread() is threading.main_thread():
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+      if signal.getsignal(signum) == signal.SIG_DFL:
+        # Exit through SystemExit, so that finally blocks and atexit handlers run
+        signal.signal(signum, lambda signum, frame: sys.exit(128 + signum))
+  _cleanup_registered = True
+
+
+def _get_segment(name: str, shape: tuple[int, ...], dtype, create: bool = False) -> numpy.ndarray:
+  if name in _segments and not create:
+    return _segments[name][1]
+  if create:
+    _register_cleanup()
+    _cleanup_segment(name)
+  # Segments must not be empty
+  size = max(int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize, 1)
+  sm = SharedMemory(_segment_name(name), create=create, size=size)
+  array = numpy.ndarray(shape, dtype=dtype, buffer=sm.buf)
+  _segments[name] = (sm, array)
+  return array
+
+
+def _cleanup_segment(name: str):
+  if name not in _segments:
     return
-  _height_sm.close()
+  sm, _ = _segments.pop(name)
+  sm.close()
   if _is_root_process:
-    _height_sm.unlink()
-  _height_sm = None
-  _height_array = None
-
-def get_similarities_sm():
-  global _similarities_sm
-  global _similarities_array
-  if _similarities_array is not None:
-    return _similarities_array
-  width: int = get_width_sm()[0]
-  height: int = get_height_sm()[0]
-  _similarities_sm = SharedMemory(TF_IDF_SM_SIMILARITIES, create=_is_root_process, size=width * height * numpy.double().itemsize)
-  _similarities_array = numpy.ndarray((width, height), dtype=numpy.double, buffer=_similarities_sm.buf)
-  return _similarities_array
+    sm.unlink()
+
+
+def _get_header() -> numpy.ndarray:
+  # width (iOS apps), height (Android apps), number of stored similarities (-1 if
+  # dense), index of the dtype and length of the location of the similarity files
+  # (0 if they are stored in shared memory)
+  return _get_segment(TF_IDF_SM_HEADER, (5,), numpy.int64)
+
+
+def _create_header(width: int, height: int, nnz: int, dtype: str, location: str = ''):
+  if dtype not in DTYPES:
+    raise ValueError(f'Unknown similarity dtype {dtype}, expected one of {_DTYPE_NAMES}')
+  encoded_location = location.encode('utf-8')
+  header = _get_segment(TF_IDF_SM_HEADER, (5,), numpy.int64, create=True)
+  header[:] = (width, height, nnz, _DTYPE_NAMES.index(dtype), len(encoded_location))
+  if len(encoded_location) > 0:
+    location_sm = _get_segment(TF_IDF_SM_LOCATION, (len(encoded_location),), numpy.uint8, create=True)
+    location_sm[:] = numpy.frombuffer(encoded_location, dtype=numpy.uint8)
+
+
+def _get_array(name: str, shape: tuple[int, ...], dtype, create: bool = False) -> numpy.ndarray:
+  location_length = _get_header()[4]
+  if location_length == 0:
+    return _get_segment(name, shape, dtype, create)
+  if name not in _files:
+    location = bytes(_get_segment(TF_IDF_SM_LOCATION, (location_length,), numpy.uint8)).decode('utf-8')
+    # Only the pages of the accessed rows are read, and shared between the processes
+    _files[name] = numpy.load(os.path.join(location, f'{name}.npy'), mmap_mode='r')
+  return _files[name]
+
+
+def _dtype():
+  return DTYPES[_DTYPE_NAMES[_get_header()[3]]]
+
+
+def create_similarities_sm(width: int, height: int, dtype: str = 'float64') -> numpy.ndarray:
+  """
+  Create the dense width x height similarity matrix. Only called by the main process.
+  """
+  cleanup_similarities_sm()
+  _create_header(width, height, -1, dtype)
+  return _get_segment(TF_IDF_SM_SIMILARITIES, (width, height), DTYPES[dtype], create=True)
+
+
+def get_similarities_sm() -> numpy.ndarray:
+  width, height = _get_header()[:2]
+  return _get_array(TF_IDF_SM_SIMILARITIES, (width, height), _dtype())
+
+
+def create_sparse_similarities_sm(
+  width: int, height: int, nnz: int, dtype: str = 'float64'
+) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+  """
+  Create the indptr, indices and data arrays of the CSR matrix with "nnz" stored
+  similarities. Only called by the main process.
+  """
+  cleanup_similarities_sm()
+  _create_header(width, height, nnz, dtype)
+  return _sparse_segments(create=True)
+
+
+def get_sparse_similarities_sm() -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+  return _sparse_segments()
+
+
+def _sparse_segments(create: bool = False) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+  width, _, nnz = _get_header()[:3]
+  return (
+    _get_array(TF_IDF_SM_INDPTR, (width + 1,), numpy.int64, create),
+    _get_array(TF_IDF_SM_INDICES, (nnz,), numpy.int32, create),
+    _get_array(TF_IDF_SM_DATA, (nnz,), _dtype(), create),
+  )
+
+
+def similarity_file_names(sparse: bool) -> list[str]:
+  """
+  Names of the .npy files use_similarity_files expects.
+  """
+  if sparse:
+    return [TF_IDF_SM_INDPTR, TF_IDF_SM_INDICES, TF_IDF_SM_DATA]
+  return [TF_IDF_SM_SIMILARITIES]
+
+
+def use_similarity_files(location: str, width: int, height: int, nnz: int, dtype: str = 'float64'):
+  """
+  Use the similarities stored as .npy files in the "location" directory (see
+  similarity_file_names) instead of shared memory. The files are memory mapped by
+  each process. Only called by the main process.
+  """
+  cleanup_similarities_sm()
+  _create_header(width, height, nnz, dtype, os.path.abspath(location))
+
+
+def is_sparse_similarities() -> bool:
+  return _get_header()[2] >= 0
+
+
+def get_description_similarity(ios_index: int, android_index: int) -> float:
+  """
+  Similarity of the descriptions of both apps, in dense and sparse mode.
+  """
+  if not is_sparse_similarities():
+    return float(get_similarities_sm()[ios_index, android_index])
+  indptr, indices, data = get_sparse_similarities_sm()
+  start, end = indptr[ios_index], indptr[ios_index + 1]
+  # The column indexes of each row are sorted
+  position = start + numpy.searchsorted(indices[start:end], android_index)
+  if position < end and indices[position] == android_index:
+    return float(data[position])
+  return MISSING_SIMILARITY
+
 
 def cleanup_similarities_sm():
-  global  _similarities_sm
-  if _similarities_sm is None:
-    return
-  _similarities_sm.close()
-  if _is_root_process:
-    _similarities_sm.unlink()
-  _similarities_sm = None
+  _files.clear()
+  for name in list(_segments):
+    _cleanup_segment(name)
+
+
+def remove_stale_segments() -> int:
+  """
+  Remove the segments of runs whose main process no longer exists, e.g. after a
+  crash. Returns the number of removed segments. Only supported where the segments
+  are visible in /dev/shm (Linux).
+  """
+  if not os.path.isdir(SHM_DIR):
+    return 0
+  removed = 0
+  for file_name in os.listdir(SHM_DIR):
+    if not file_name.startswith(SEGMENT_PREFIX):
+      continue
+    pid = file_name[len(SEGMENT_PREFIX):].split('-', 1)[0]
+    if not pid.isdigit() or _is_running(int(pid)):
+      continue
+    try:
+      os.remove(os.path.join(SHM_DIR, file_name))
+      removed += 1
+    except OSError:
+      # Removed by another run in the meantime or owned by another user
+      pass
+  return removed
+
 
+def _is_running(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    # Process of another user
+    return True
+  return True
@@ -1,17 +1,87 @@
+import heapq
+import math
 import os
+import time
 import traceback
 from argparse import ArgumentParser
 from concurrent import futures
-from math import ceil
-from typing import Callable, TypeVar
+from typing import Callable, Optional, TypeVar
 
+import numpy
+from pymongo import UpdateOne
 from pymongo.collection import Collection
+from app_matcher.async_writer import AsyncResultWriter, WriterOptions
+from app_matcher.batch_matchers import BATCH_MATCHERS
+from app_matcher.blocking import (
+    build_candidates,
+    evaluate_candidates,
+    load_reference_pairs,
+)
+from app_matcher.cascade import cascade_order, required_score_sum
+from app_matcher.checkpoint import (
+    clear_progress,
+    discard_partial_results,
+    load_completed_ios_ids,
+    mark_completed,
+    progress_collection_name,
+)
+from app_matcher.corpus import compact_apps
+from app_matcher.icon_hash_matrix import get_packed_icon_hashes, set_packed_icon_hashes
+from app_matcher.incremental import (
+    app_state_collection_name,
+    clear_app_state,
+    delete_stale_results,
+    detect_changes,
+    incremental_candidates,
+    load_run_options,
+    load_tf_idf_vectorizer,
+    save_app_state,
+)
+from app_matcher.loading import load_apps
+from app_matcher.matcher_registry import CallPlan, PlanStep, compile_call_plan
 from app_matcher.matchers import (
     ALL_CLEANUPS,
     ALL_INDEXED_MATCHERS,
     ALL_MATCHERS,
     ALL_PREPARES,
     ALL_WEIGHT_MODIFIERS,
+    get_tf_idf_vectorizer,
+)
+from app_matcher.profiling import (
+    MatcherProfile,
+    merge_profiles,
+    print_profile,
+    profiled_call,
+    record_call,
+    save_profile,
+)
+from app_matcher.progress import (
+    attach_progress_queue,
+    progress_monitor,
+    report_progress,
+)
+from app_matcher.projection import app_projection
+from app_matcher.related_work_matchers import (
+    EXACT_MATCH_MATCHERS,
+    exact_match_candidates,
+)
+from app_matcher.result_sinks import (
+    RESULT_SINKS,
+    open_result_sink,
+    prepare_output_dir,
+)
+from app_matcher.scheduling import (
+    WorkUnitStats,
+    create_work_units,
+    print_worker_report,
+)
+from app_matcher.tf_idf.tf_idf_shared_memory import DTYPES, remove_stale_segments
+from app_matcher.worker_corpus import (
+    CORPUS_MODES,
+    attach_corpus,
+    default_corpus_mode,
+    get_android_apps,
+    published_corpus,
 )
 from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
     AndroidPreprocessingResult,
@@ -37,26 +107,30 @@ def _match_ios_to_android(
     target: iOSPreprocessingResult,
     candidate_index: int,
     candidate: AndroidPreprocessingResult,
-    matchers=ALL_MATCHERS,
-    index_matchers=ALL_INDEXED_MATCHERS,
+    plan: CallPlan,
+    batch_scores: Optional[dict[Callable, dict[str, numpy.ndarray]]] = None,
+    batch_row: Optional[int] = None,
+    batch_column: Optional[int] = None,
+    profile: Optional[MatcherProfile] = None,
 ) -> MatchingResult:
-    scores = {}
+    # Each matcher writes its scores into its slots of the plan, see matcher_registry.py
+    pair = (target, candidate, target_index, candidate_index)
+    scores = [0.0] * len(plan.keys)
     # weight_modifiers = {}
-    for matcher in matchers:
-        scores = scores | _safe_call(
-            matcher, {"ios_app": target, "android_app": candidate}
-        )
-
-    for matcher in index_matchers:
-        scores = scores | _safe_call(
-            matcher,
-            {
-                "ios_app": target,
-                "android_app": candidate,
-                "ios_index": target_index,
-                "android_index": candidate_index,
-            },
-        )
+    for step in plan.steps:
+        if batch_scores is not None and step.matcher in batch_scores:
+            # Already computed for the whole block, see _compute_batch_scores
+            matrices = batch_scores[step.matcher]
+            for slot, key in step.slots:
+                scores[slot] = float(matrices[key][batch_row, batch_column])
+            continue
+        if profile is None:
+            result = step.matcher(*step.arguments(pair))
+        else:
+            # Records the matcher calls in "profile", see profiling.py
+            result = profiled_call(profile, step, pair)
+        for slot, key in step.slots:
+            scores[slot] = result[key]
 
     # for modifier in ALL_WEIGHT_MODIFIERS:
     #     weight_modifiers = weight_modifiers | modifier(target, candidate)
@@ -72,7 +146,7 @@ def _match_ios_to_android(
     #     "description_weight": 0 if (not weight_modifiers.get('description_language_matches') and (scores.get("description_cosine_similarity") < 0.8)) else (1 if scores.get("description_cosine_similarity") < 0.8 else 3)
     # }
 
-    total_score = sum(scores.values())
+    total_score = sum(scores)
     average_score = total_score / len(scores)
 
     # def _linear(x: float, k: float = 2.5, d: float = -0.75):
@@ -117,70 +191,385 @@ def _match_ios_to_android(
     return MatchingResult(
         ios_id=target.app_id,
         android_id=candidate.app_id,
-        scores=scores,
+        scores=dict(zip(plan.keys, scores)),
         weighted_score=None,
         average_score=average_score,
         linear_score=None,
     )
 
 
-def _match_executor(
+def _match_ios_to_android_cascade(
+    target_index: int,
+    target: iOSPreprocessingResult,
+    candidate_index: int,
+    candidate: AndroidPreprocessingResult,
+    min_average_score: float,
+    cascade_steps: list[PlanStep],
+    plan: CallPlan,
+    batch_scores: Optional[dict[Callable, dict[str, numpy.ndarray]]] = None,
+    batch_row: Optional[int] = None,
+    batch_column: Optional[int] = None,
+    profile: Optional[MatcherProfile] = None,
+) -> Optional[MatchingResult]:
+    """
+    Same result as _match_ios_to_android, but the steps of the plan run in the order
+    of "cascade_steps" (see cascade.py) and None is returned as soon as the pair can
+    no longer reach an average score of "min_average_score".
+    """
+    pair = (target, candidate, target_index, candidate_index)
+    scores = [0.0] * len(plan.keys)
+    required_sum = required_score_sum(min_average_score, len(scores))
+    # Highest sum the scores of the matchers that did not run yet can reach
+    remaining_sum = len(scores)
+    score_sum = 0.0
+
+    for step in cascade_steps:
+        remaining_sum -= len(step.slots)
+        if batch_scores is not None and step.matcher in batch_scores:
+            matrices = batch_scores[step.matcher]
+            for slot, key in step.slots:
+                scores[slot] = float(matrices[key][batch_row, batch_column])
+        else:
+            kwargs = {}
+            if step.score_cutoff and len(step.slots) == 1:
+                score_cutoff = required_sum - score_sum - remaining_sum
+                if score_cutoff > 0:
+                    kwargs["score_cutoff"] = score_cutoff
+            if profile is None:
+                result = step.matcher(*step.arguments(pair), **kwargs)
+            else:
+                result = profiled_call(profile, step, pair, **kwargs)
+            for slot, key in step.slots:
+                scores[slot] = result[key]
+        for slot, _ in step.slots:
+            score_sum += scores[slot]
+        if score_sum + remaining_sum < required_sum:
+            return None
+
+    total_score = sum(scores)
+    return MatchingResult(
+        ios_id=target.app_id,
+        android_id=candidate.app_id,
+        scores=dict(zip(plan.keys, scores)),
+        weighted_score=None,
+        average_score=total_score / len(scores),
+        linear_score=None,
+    )
+
+
+def _compute_batch_scores(
     target_start_index: int,
     targets: list[iOSPreprocessingResult],
     candidates: list[AndroidPreprocessingResult],
+    candidate_indexes: Optional[list[int]],
+    matchers,
+    workers: int,
+    profile: Optional[MatcherProfile] = None,
+) -> dict[Callable, dict[str, numpy.ndarray]]:
+    """
+    Run the batch versions of all given matchers that have one for a block of
+    targets. If "candidate_indexes" is given, the columns of the resulting matrices
+    correspond to these candidates instead of all candidates. Matchers whose batch
+    version fails are left out, so the pairwise version is used instead.
+    """
+    if candidate_indexes is None:
+        candidate_indexes = list(range(len(candidates)))
+    args = {
+        "ios_apps": targets,
+        "android_apps": [
+            candidates[candidate_index] for candidate_index in candidate_indexes
+        ],
+        "ios_indexes": list(
+            range(target_start_index, target_start_index + len(targets))
+        ),
+        "android_indexes": candidate_indexes,
+        "workers": workers,
+    }
+    batch_scores = {}
+    for matcher in matchers:
+        if matcher not in BATCH_MATCHERS:
+            continue
+        try:
+            started_at = time.perf_counter()
+            batch_scores[matcher] = _safe_call(BATCH_MATCHERS[matcher], args)
+            if profile is not None:
+                record_call(
+                    profile, f"{matcher.__name__} (batch)", time.perf_counter() - started_at
+                )
+        except Exception as err:
+            print(err)
+            print(traceback.format_exc())
+    return batch_scores
+
+
+def _init_worker(
+    corpus_mode: str,
+    corpus_payload: object,
+    packed_icon_hashes: Optional[dict],
+    progress_queue=None,
+) -> None:
+    """
+    Pool initializer, run once in each worker process.
+    """
+    attach_corpus(corpus_mode, corpus_payload)
+    set_packed_icon_hashes(packed_icon_hashes)
+    attach_progress_queue(progress_queue)
+
+
+def _match_executor(
+    target_start_index: int,
+    targets: list[iOSPreprocessingResult],
+    candidates: Optional[list[AndroidPreprocessingResult]],
     matcher_coll_name: str,
     matchers=ALL_MATCHERS,
     index_matchers=ALL_INDEXED_MATCHERS,
-):
-    print(
-        f"Starting process for {len(targets)} iOS apps and {len(candidates)} Android apps"
-    )
+    target_candidates: Optional[list[list[int]]] = None,
+    vectorized: bool = False,
+    vectorized_block_size: int = 64,
+    vectorized_workers: int = 1,
+    top_k: Optional[int] = None,
+    min_score: Optional[float] = None,
+    best_matches_coll_name: Optional[str] = None,
+    progress_coll_name: Optional[str] = None,
+    resume: bool = False,
+    result_sink: str = "mongo",
+    output_dir: Optional[str] = None,
+    writer_options: WriterOptions = WriterOptions(),
+    cascade: bool = False,
+    profile_matchers: bool = False,
+) -> WorkUnitStats:
     """
     Task run inside a thread. It will calculate the matching scores for all candidates
-    for the given target and persist their results.
+    for the given target and persist their results. If "target_candidates" is given,
+    each target is only matched against the candidate indexes listed for it.
+
+    In vectorized mode, the targets are processed in blocks of "vectorized_block_size"
+    and matchers with a batch version (see batch_matchers.py) are run once per block.
+
+    If "top_k" and/or "min_score" are set, only the "top_k" best candidates of each
+    target and/or the candidates with an average score of at least "min_score" are
+    persisted. If "best_matches_coll_name" is set, the best match of each target is
+    upserted to that collection, in the same format as aggregate_best_matches.py.
+    With "cascade", pairs that can no longer reach the score they need to be persisted
+    are dropped before all matchers ran (see cascade.py). With "profile_matchers", the
+    calls and time of each matcher are part of the statistics (see profiling.py).
+
+    If "progress_coll_name" is set, the targets are recorded as completed once all
+    of their results are persisted. With "resume", results that an interrupted run
+    stored for these targets are removed first.
+
+    If "candidates" is None, the Android corpus attached to the worker is used
+    (see worker_corpus.py).
+
+    The results are written to the "result_sink" (see result_sinks.py) by a
+    background thread (see async_writer.py), so scoring continues during writes.
+    The scored and written pairs are reported to the main process (see progress.py).
+
+    Returns the statistics of the processed work unit.
     """
-    to_be_inserted = []
-    matcher_coll = get_collection(matcher_coll_name)
-    for target_index, target in enumerate(targets, start=target_start_index):
-        for candidate_index, candidate in enumerate(candidates):
-            try:
-                matches = _match_ios_to_android(
-                    target_index=target_index,
-                    target=target,
-                    candidate_index=candidate_index,
-                    candidate=candidate,
-                    matchers=matchers,
-                    index_matchers=index_matchers,
+    started_at = time.time()
+    if candidates is None:
+        candidates = get_android_apps()
+    pairs_scored = 0
+    pairs_pruned = 0
+    errors = 0
+    plan = compile_call_plan(matchers, index_matchers)
+    profile = MatcherProfile() if profile_matchers else None
+    write_failed = False
+    sink = open_result_sink(
+        result_sink,
+        matcher_coll_name,
+        output_dir,
+        target_start_index,
+        writer_options.write_concern,
+    )
+    if resume and result_sink == "mongo":
+        discard_partial_results(matcher_coll_name, [target.app_id for target in targets])
+    writer = AsyncResultWriter(sink, writer_options)
+    best_matches: list[UpdateOne] = []
+    best_matches_coll = (
+        get_collection(best_matches_coll_name)
+        if best_matches_coll_name is not None
+        else None
+    )
+    block_size = vectorized_block_size if vectorized else max(len(targets), 1)
+    for block_start in range(0, len(targets), block_size):
+        block = targets[block_start : block_start + block_size]
+        if target_candidates is None:
+            block_candidates = [range(len(candidates))] * len(block)
+        else:
+            block_candidates = target_candidates[block_start : block_start + block_size]
+
+        batch_scores = None
+        batch_columns = None
+        if vectorized:
+            block_candidate_indexes = None
+            if target_candidates is not None:
+                block_candidate_indexes = sorted(
+                    set().union(*block_candidates)
                 )
-                entity = matches.__dict__
-                del entity["_id"]
-                to_be_inserted.append(entity)
+                batch_columns = {
+                    candidate_index: column
+                    for column, candidate_index in enumerate(block_candidate_indexes)
+                }
+            batch_scores = _compute_batch_scores(
+                target_start_index + block_start,
+                block,
+                candidates,
+                block_candidate_indexes,
+                matchers,
+                vectorized_workers,
+                profile,
+            )
+        cascade_steps = None
+        if cascade:
+            cascade_steps = cascade_order(plan.steps, batch_scores or {})
+
+        for block_offset, target in enumerate(block):
+            target_index = target_start_index + block_start + block_offset
+            # Min-heap of (average_score, -candidate_index, entity) for top-k mode
+            top_matches: list[tuple[float, int, dict]] = []
+            best_match: Optional[dict] = None
+            for candidate_index in block_candidates[block_offset]:
+                candidate = candidates[candidate_index]
+                try:
+                    pair_args = {
+                        "target_index": target_index,
+                        "target": target,
+                        "candidate_index": candidate_index,
+                        "candidate": candidate,
+                        "plan": plan,
+                        "batch_scores": batch_scores,
+                        "batch_row": block_offset,
+                        "batch_column": (
+                            candidate_index
+                            if batch_columns is None
+                            else batch_columns[candidate_index]
+                        ),
+                        "profile": profile,
+                    }
+                    pair_started_at = time.perf_counter()
+                    if cascade_steps is None:
+                        matches = _match_ios_to_android(**pair_args)
+                    else:
+                        # Score the pair needs to be persisted
+                        min_average_score = -math.inf if min_score is None else min_score
+                        if top_k is not None and len(top_matches) >= top_k:
+                            min_average_score = max(min_average_score, top_matches[0][0])
+                        matches = _match_ios_to_android_cascade(
+                            min_average_score=min_average_score,
+                            cascade_steps=cascade_steps,
+                            **pair_args,
+                        )
+                    if profile is not None:
+                        profile.pairs += 1
+                        profile.pair_seconds += time.perf_counter() - pair_started_at
+                    pairs_scored += 1
+                    if matches is None:
+                        pairs_pruned += 1
+                        continue
+                    if min_score is not None and matches.average_score < min_score:
+                        continue
+                    entity = matches.__dict__
+                    del entity["_id"]
+
+                    if top_k is not None:
+                        heap_item = (matches.average_score, -candidate_index, entity)
+                        if len(top_matches) < top_k:
+                            heapq.heappush(top_matches, heap_item)
+                        else:
+                            heapq.heappushpop(top_matches, heap_item)
+                        continue
+
+                    if best_match is None or entity["average_score"] > best_match["average_score"]:
+                        best_match = entity.copy()
+                    writer.add(entity)
+
+                except Exception as err:
+                    # TODO: pack error so that it can be properly logged/stored
+                    print(err)
+                    print(traceback.format_exc())
+                    errors += 1
 
-                if len(to_be_inserted) >= 10000:
-                    # bulk insert for better performance, also we set ordered to false so the documents can be inserted in arbitrary order
-                    # see https://pymongo.readthedocs.io/en/stable/api/pymongo/collection.html#pymongo.collection.Collection.insert_many
-                    matcher_coll.insert_many(to_be_inserted, ordered=False)
-                    # print(f'[Worker] Inserted {len(to_be_inserted)} matches')
-                    to_be_inserted = []
+            try:
+                if top_k is not None and len(top_matches) > 0:
+                    survivors = [entity for _, _, entity in sorted(top_matches, reverse=True)]
+                    best_match = survivors[0].copy()
+                    writer.extend(survivors)
 
+                if best_matches_coll is not None and best_match is not None:
+                    best_matches.append(
+                        UpdateOne(
+                            {"_id": best_match["ios_id"]},
+                            {"$set": {"best_match": best_match}},
+                            upsert=True,
+                        )
+                    )
+                    if len(best_matches) >= 1000:
+                        best_matches_coll.bulk_write(best_matches, ordered=False)
+                        best_matches = []
             except Exception as err:
                 # TODO: pack error so that it can be properly logged/stored
                 print(err)
                 print(traceback.format_exc())
-                pass
+                write_failed = True
+                errors += 1
+            report_progress(target_start_index, pairs_scored, writer.stats.written, errors)
+
+    # insert remaining candidates and wait for the writer
+    writer_stats = writer.close()
+    write_failed = write_failed or writer_stats.failed
+    try:
+        # Files of incomplete units are not committed, see result_sinks.py
+        if write_failed:
+            sink.abort()
+        else:
+            sink.close()
+    except Exception as err:
+        print(err)
+        print(traceback.format_exc())
+        write_failed = True
 
-    # insert remaining candidates
-    if len(to_be_inserted) > 0:
+    # insert remaining best matches
+    if len(best_matches) > 0:
         try:
-            matcher_coll.insert_many(to_be_inserted, ordered=False)
-            to_be_inserted = []
+            best_matches_coll.bulk_write(best_matches, ordered=False)
+            best_matches = []
         except Exception as err:
             # TODO: pack error so that it can be properly logged/stored
             print(err)
             print(traceback.format_exc())
-            pass
+            write_failed = True
+
+    # Only record the unit as done if all of its results were persisted, so it is
+    # repeated when the run is resumed
+    if progress_coll_name is not None and not write_failed:
+        try:
+            mark_completed(progress_coll_name, [target.app_id for target in targets])
+        except Exception as err:
+            print(err)
+            print(traceback.format_exc())
+
+    report_progress(
+        target_start_index,
+        pairs_scored,
+        writer_stats.written,
+        errors + int(write_failed),
+        finished=True,
+    )
 
-    print(f"Process finished")
+    return WorkUnitStats(
+        pid=os.getpid(),
+        started_at=started_at,
+        finished_at=time.time(),
+        targets=len(targets),
+        pairs=pairs_scored,
+        pruned=pairs_pruned,
+        failed=write_failed,
+        write_blocked=writer_stats.blocked,
+        write_retries=writer_stats.retries,
+        profile=profile,
+    )
 
 
 def match_all(
@@ -190,53 +579,138 @@ def match_all(
     threads: int = os.cpu_count() - 2,  # Max number of matcher threads
     matchers=ALL_MATCHERS,
     index_matchers=ALL_INDEXED_MATCHERS,
-):
+    candidates: Optional[list[list[int]]] = None,
+    vectorized: bool = False,
+    vectorized_block_size: int = 64,
+    vectorized_workers: int = 1,
+    top_k: Optional[int] = None,
+    min_score: Optional[float] = None,
+    best_matches_coll_name: Optional[str] = None,
+    work_unit_size: Optional[int] = None,
+    cost_ordering: bool = False,
+    corpus_mode: str = default_corpus_mode(),
+    corpus_snapshot_dir: Optional[str] = None,
+    progress_coll_name: Optional[str] = None,
+    completed_ios_ids: Optional[set[str]] = None,
+    result_sink: str = "mongo",
+    output_dir: Optional[str] = None,
+    writer_options: WriterOptions = WriterOptions(),
+    cascade: bool = False,
+    profile_matchers: bool = False,
+    progress_interval: float = 30.0,
+    status_path: Optional[str] = None,
+) -> list[WorkUnitStats]:
     """
     Iterate over given apps and spawn a task for each of them to match all possible candidates.
-    The number of threads is limited by the "threads" parameter.
-    """
+    The number of threads is limited by the "threads" parameter. If "candidates" is
+    given (one list of Android indexes per iOS app), only those pairs are matched.
 
-    chunk_size = ceil(len(ios_apps) / threads)
-    work_chunks = list(
-        map(
-            lambda x: ios_apps[x * chunk_size : x * chunk_size + chunk_size],
-            list(range(threads)),
-        )
+    The iOS apps are split into many small work units (see scheduling.py), which
+    are handed out to the workers as they become free. The Android apps are
+    published to each worker once, according to "corpus_mode" (see worker_corpus.py).
+
+    Completed work units are recorded in "progress_coll_name". iOS apps in
+    "completed_ios_ids" are skipped, as they were completed by a previous run.
+
+    The results are written to "result_sink", file based sinks write to "output_dir"
+    (see result_sinks.py), using the "writer_options" (see async_writer.py).
+
+    With "cascade", pairs that cannot reach the "min_score" or the current "top_k"
+    are dropped early (see cascade.py). With "profile_matchers", the calls and time of
+    each matcher are collected by the workers and printed (see profiling.py).
+
+    The progress of the run is printed every "progress_interval" seconds and written
+    to "status_path" (see progress.py).
+
+    Returns the statistics of all work units that finished without raising.
+    """
+    # Raises for matchers that are not registered before any worker starts
+    compile_call_plan(matchers, index_matchers)
+    if cascade and top_k is None and min_score is None:
+        print("[Cascade] Cascade scoring requires top_k or min_score, scoring all pairs fully")
+        cascade = False
+    skip = None
+    if completed_ios_ids is not None:
+        skip = {
+            ios_index
+            for ios_index, ios_app in enumerate(ios_apps)
+            if ios_app.app_id in completed_ios_ids
+        }
+        print(f"Skipping {len(skip)} iOS apps completed by a previous run")
+    work_units = create_work_units(
+        ios_apps,
+        len(android_apps),
+        threads,
+        unit_size=work_unit_size,
+        candidates=candidates,
+        cost_ordering=cost_ordering,
+        skip=skip,
     )
-    runningTasks = set[futures.Future[None]]()
-    with futures.ProcessPoolExecutor(max_workers=threads) as pool:
-        for chunk_index, chunk in enumerate(work_chunks):
+    print(
+        f"Split {sum(unit.end - unit.start for unit in work_units)} iOS apps into {len(work_units)} work units"
+    )
+    pairs_total = sum(
+        (unit.end - unit.start) * len(android_apps)
+        if candidates is None
+        else sum(len(candidates[ios_index]) for ios_index in range(unit.start, unit.end))
+        for unit in work_units
+    )
+
+    runningTasks = set[futures.Future[WorkUnitStats]]()
+    unit_stats: list[WorkUnitStats] = []
+    run_started_at = time.time()
+    with published_corpus(
+        android_apps, corpus_mode, corpus_snapshot_dir
+    ) as (mp_context, corpus_payload), progress_monitor(
+        mp_context, len(work_units), pairs_total, progress_interval, status_path
+    ) as progress_queue, futures.ProcessPoolExecutor(
+        max_workers=threads,
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(corpus_mode, corpus_payload, get_packed_icon_hashes(), progress_queue),
+    ) as pool:
+        for unit in work_units:
             runningTasks.add(
                 pool.submit(
                     _match_executor,
-                    chunk_index * chunk_size,
-                    chunk,
-                    android_apps,
+                    unit.start,
+                    ios_apps[unit.start : unit.end],
+                    None,
                     matches_coll_name,
                     matchers=matchers,
                     index_matchers=index_matchers,
+                    target_candidates=(
+                        None if candidates is None else candidates[unit.start : unit.end]
+                    ),
+                    vectorized=vectorized,
+                    vectorized_block_size=vectorized_block_size,
+                    vectorized_workers=vectorized_workers,
+                    top_k=top_k,
+                    min_score=min_score,
+                    best_matches_coll_name=best_matches_coll_name,
+                    progress_coll_name=progress_coll_name,
+                    resume=completed_ios_ids is not None,
+                    result_sink=result_sink,
+                    output_dir=output_dir,
+                    writer_options=writer_options,
+                    cascade=cascade,
+                    profile_matchers=profile_matchers,
                 )
             )
 
-    # Flush remaining results
-    for future in runningTasks:
-        try:
-            future.result()
-        except Exception as e:
-            # TODO: Properly handle error
-            print(traceback.format_exc())
-            print(e)
-
-
-_T = TypeVar("_T")
-
+        for future in futures.as_completed(runningTasks):
+            try:
+                unit_stats.append(future.result())
+            except Exception as e:
+                # TODO: Properly handle error
+                print(traceback.format_exc())
+                print(e)
+    run_finished_at = time.time()
 
-def _fetch_all(coll: Collection[_T], constructor: Callable[[], _T]) -> list[_T]:
-    cursor = coll.find()
-    targets: list[_T] = []
-    for doc in cursor:
-        targets.append(constructor(**doc))
-    return targets
+    print_worker_report(unit_stats, run_started_at, run_finished_at, threads)
+    if profile_matchers:
+        print_profile(merge_profiles([stats.profile for stats in unit_stats]))
+    return unit_stats
 
 
 def match_all_documents(
@@ -248,36 +722,245 @@ def match_all_documents(
     matchers=ALL_MATCHERS,
     index_matchers=ALL_INDEXED_MATCHERS,
     cleanups=ALL_CLEANUPS,
+    blocking: bool = False,
+    blocking_max_key_frequency: Optional[int] = 1000,
+    reference_pairs_path: Optional[str] = None,
+    vectorized: bool = False,
+    vectorized_block_size: int = 64,
+    vectorized_workers: int = 1,
+    top_k: Optional[int] = None,
+    min_score: Optional[float] = None,
+    best_matches_coll_name: Optional[str] = None,
+    work_unit_size: Optional[int] = None,
+    cost_ordering: bool = False,
+    corpus_mode: str = default_corpus_mode(),
+    corpus_snapshot_dir: Optional[str] = None,
+    resume: bool = False,
+    incremental: bool = False,
+    result_sink: str = "mongo",
+    output_dir: Optional[str] = None,
+    writer_options: WriterOptions = WriterOptions(),
+    load_batch_size: int = 2000,
+    load_partitions: int = 4,
+    description_top_k: Optional[int] = None,
+    description_min_similarity: Optional[float] = None,
+    description_dtype: str = "float64",
+    tf_idf_cache_dir: Optional[str] = None,
+    cascade: bool = False,
+    matcher_profile_path: Optional[str] = None,
+    progress_interval: float = 30.0,
+    status_path: Optional[str] = None,
+    exact_match_join: bool = False,
 ):
+    """
+    "exact_match_join" only scores the pairs of exact_match_candidates, for runs of
+    the exact match baselines of related_work_matchers.py (EXACT_MATCH_MATCHERS). It
+    has no command line flag, as the command line always runs our own matchers.
+    """
+    if exact_match_join and blocking:
+        raise ValueError("exact_match_join can not be combined with blocking")
+    if exact_match_join and not set(matchers) | set(index_matchers) <= set(EXACT_MATCH_MATCHERS):
+        # The other matchers can score pairs outside of the join with more than 0
+        raise ValueError(
+            f"exact_match_join only supports the matchers {[matcher.__name__ for matcher in EXACT_MATCH_MATCHERS]}"
+        )
+    if incremental and (top_k is not None or best_matches_coll_name is not None):
+        # The stored top-k/best matches of unchanged iOS apps would have to be merged
+        # with the scores of the changed Android apps
+        raise ValueError("Incremental matching does not support top_k and best_matches_coll_name")
+    if incremental and resume:
+        # An interrupted incremental run is repeated by running it again, the app
+        # state is only updated after a successful run
+        raise ValueError("Incremental matching does not support resume")
+    if incremental and result_sink != "mongo":
+        # Stale results can only be deleted from the matches collection
+        raise ValueError("Incremental matching requires the mongo result sink")
+    prepare_output_dir(result_sink, matches_coll_name, output_dir, resume)
+    removed_segments = remove_stale_segments()
+    if removed_segments > 0:
+        print(f"Removed {removed_segments} shared memory segments of crashed runs")
+
+    # Incremental runs must use the same options as the run that stored the app state,
+    # as they rely on the stored results of the unchanged pairs
+    run_options = {
+        "blocking": blocking,
+        "blocking_max_key_frequency": blocking_max_key_frequency if blocking else None,
+        "min_score": min_score,
+        "description_top_k": description_top_k,
+        "description_min_similarity": description_min_similarity,
+        "description_dtype": description_dtype,
+    }
+    if exact_match_join:
+        # Only set if used, so the app state of earlier runs stays valid
+        run_options["exact_match_join"] = True
+    app_state_coll_name = app_state_collection_name(matches_coll_name)
+    if incremental:
+        stored_options = load_run_options(app_state_coll_name)
+        if stored_options is None:
+            print("No app state stored by a previous run, matching all apps")
+        elif stored_options != run_options:
+            raise ValueError(
+                f"Incremental matching requires the options of the previous run {stored_options}, got {run_options}"
+            )
+    elif not resume:
+        # Only valid again once this run has stored all of its pairs
+        clear_app_state(app_state_coll_name)
+
+    # Only load the fields used by the preparations and matchers, see projection.py
+    used_functions = [*preparations, *matchers, *index_matchers]
+    ios_projection = app_projection("iOS", used_functions, blocking, cost_ordering)
+    android_projection = app_projection("Android", used_functions, blocking, cost_ordering)
+
     ios_coll: Collection[iOSPreprocessingResult] = get_collection(ios_coll_name)
-    print("Loading all iOS apps...")
-    ios_apps = _fetch_all(ios_coll, iOSPreprocessingResult)
-    print(f"Loaded {len(ios_apps)} iOS apps")
     android_coll: Collection[AndroidPreprocessingResult] = get_collection(
         android_coll_name
     )
-    print("Loading all Android apps...")
-    android_apps = _fetch_all(android_coll, AndroidPreprocessingResult)
+    print("Loading all iOS and Android apps...")
+    ios_apps, android_apps = load_apps(
+        ios_coll,
+        iOSPreprocessingResult,
+        ios_projection,
+        android_coll,
+        AndroidPreprocessingResult,
+        android_projection,
+        batch_size=load_batch_size,
+        partitions=load_partitions,
+    )
+    print(f"Loaded {len(ios_apps)} iOS apps")
     print(f"Loaded {len(android_apps)} Android apps")
     print("Loaded all apps into memory")
 
-    print("Preparing matchers...")
-    for prepare in preparations:
-        prepare(ios_apps=ios_apps, android_apps=android_apps)
+    changes = None
+    prepare_args = {
+        "ios_apps": ios_apps,
+        "android_apps": android_apps,
+        "description_top_k": description_top_k,
+        "description_min_similarity": description_min_similarity,
+        "description_dtype": description_dtype,
+        "tf_idf_cache_dir": tf_idf_cache_dir,
+        "threads": threads,
+    }
+    if incremental:
+        changes = detect_changes(app_state_coll_name, ios_apps, android_apps)
+        print(
+            f"Found {len(changes.ios_indexes)} new or changed iOS apps and {len(changes.android_indexes)} new or changed Android apps"
+        )
+        print(
+            f"Removing results of {len(changes.stale_ios_ids)} changed or removed iOS apps and {len(changes.stale_android_ids)} changed or removed Android apps"
+        )
+        delete_stale_results(matches_coll_name, ios_apps, android_apps, changes)
+        prepare_args["changed_ios_indexes"] = changes.ios_indexes
+        prepare_args["changed_android_indexes"] = changes.android_indexes
+        tf_idf_vectorizer = load_tf_idf_vectorizer(app_state_coll_name)
+        if tf_idf_vectorizer is not None:
+            prepare_args["tf_idf_vectorizer"] = tf_idf_vectorizer
 
-    print("Running all matchers")
-    match_all(
-        ios_apps=ios_apps,
-        android_apps=android_apps,
-        matches_coll_name=matches_coll_name,
-        threads=threads,
-        matchers=matchers,
-        index_matchers=index_matchers,
-    )
+    try:
+        print("Preparing matchers...")
+        for prepare in preparations:
+            _safe_call(prepare, prepare_args)
+
+        candidates = None
+        if blocking:
+            print("Building candidate pairs...")
+            candidates = build_candidates(
+                ios_apps, android_apps, max_key_frequency=blocking_max_key_frequency
+            )
+            reference_pairs = (
+                load_reference_pairs(reference_pairs_path)
+                if reference_pairs_path is not None
+                else None
+            )
+            evaluate_candidates(ios_apps, android_apps, candidates, reference_pairs).print()
+        elif exact_match_join:
+            # The exact match baselines of related_work_matchers.py score all other
+            # pairs with 0
+            print("Joining apps on their titles and developer names...")
+            candidates = exact_match_candidates(ios_apps, android_apps)
+            print(f"Matching {sum(len(row) for row in candidates)} joined pairs")
+
+        if changes is not None:
+            candidates = incremental_candidates(
+                len(ios_apps), len(android_apps), changes, candidates
+            )
+            print(
+                f"Matching {sum(len(row) for row in candidates)} new or changed pairs incrementally"
+            )
+
+        # The matchers only need a few fields of the prepared apps, see corpus.py
+        print("Compacting apps for matching...")
+        ios_apps = compact_apps(ios_apps)
+        android_apps = compact_apps(android_apps)
+        # Release the loaded documents before the workers start
+        prepare_args = None
+
+        progress_coll_name = progress_collection_name(matches_coll_name)
+        completed_ios_ids = None
+        if resume:
+            completed_ios_ids = load_completed_ios_ids(progress_coll_name)
+        else:
+            clear_progress(progress_coll_name)
+
+        print("Running all matchers")
+        unit_stats = match_all(
+            ios_apps=ios_apps,
+            android_apps=android_apps,
+            matches_coll_name=matches_coll_name,
+            threads=threads,
+            matchers=matchers,
+            index_matchers=index_matchers,
+            candidates=candidates,
+            vectorized=vectorized,
+            vectorized_block_size=vectorized_block_size,
+            vectorized_workers=vectorized_workers,
+            top_k=top_k,
+            min_score=min_score,
+            best_matches_coll_name=best_matches_coll_name,
+            work_unit_size=work_unit_size,
+            cost_ordering=cost_ordering,
+            corpus_mode=corpus_mode,
+            corpus_snapshot_dir=corpus_snapshot_dir,
+            progress_coll_name=progress_coll_name,
+            completed_ios_ids=completed_ios_ids,
+            result_sink=result_sink,
+            output_dir=output_dir,
+            writer_options=writer_options,
+            cascade=cascade,
+            profile_matchers=matcher_profile_path is not None,
+            progress_interval=progress_interval,
+            status_path=status_path,
+        )
+        if matcher_profile_path is not None:
+            save_profile(
+                merge_profiles([stats.profile for stats in unit_stats]),
+                matcher_profile_path,
+            )
 
-    print("Cleaning up resources")
-    for cleanup in cleanups:
-        cleanup()
+        # Stats are missing for units that raised, see match_all
+        stats_count = sum(stats.targets for stats in unit_stats)
+        skipped_count = sum(
+            1 for ios_app in ios_apps if ios_app.app_id in (completed_ios_ids or set())
+        )
+        if top_k is not None or result_sink != "mongo":
+            print("Not all pairs are stored in the matches collection, no app state for incremental runs is stored")
+        elif stats_count + skipped_count == len(ios_apps) and not any(
+            stats.failed for stats in unit_stats
+        ):
+            print("Storing app state for the next incremental run")
+            save_app_state(
+                app_state_coll_name,
+                ios_apps,
+                android_apps,
+                run_options,
+                get_tf_idf_vectorizer(),
+            )
+        else:
+            print("Some work units failed, the app state for incremental runs is not updated")
+    finally:
+        # Also on errors, so no shared memory is left behind
+        print("Cleaning up resources")
+        for cleanup in cleanups:
+            cleanup()
 
 
 if __name__ == "__main__":
@@ -304,14 +987,189 @@ if __name__ == "__main__":
     )
     args_parser.add_argument(
         "--threads",
-        help=f"Set number of threads to use. Defaults to number of cores - 2 (={default_threads} on your machine)",
+        help=f"Set number of threads to use, also for the TF-IDF preparation. Defaults to number of cores - 2 (={default_threads} on your machine)",
         type=int,
         default=default_threads,
     )
+    args_parser.add_argument(
+        "--blocking",
+        help="Only match pairs of apps that share at least one blocking key (app id token, URL hostname, developer name token or icon hash prefix) instead of all pairs.",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--blocking-max-key-frequency",
+        help="Ignore blocking keys shared by more than this number of Android apps. Defaults to 1000.",
+        type=int,
+        default=1000,
+    )
+    args_parser.add_argument(
+        "--reference-pairs",
+        help="CSV (optionally zipped) or JSON file with reference pairs, used to report the recall of the blocking stage.",
+        default=None,
+    )
+    args_parser.add_argument(
+        "--vectorized",
+        help="Compute the string similarity matchers (app name, developer, app id) and the icon hash matcher for blocks of iOS apps at once instead of pair by pair.",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--vectorized-block-size",
+        help="Number of iOS apps per block in vectorized mode. Defaults to 64.",
+        type=int,
+        default=64,
+    )
+    args_parser.add_argument(
+        "--vectorized-workers",
+        help="Number of threads each process uses for the batch string comparisons. Defaults to 1, as the processes already use all cores.",
+        type=int,
+        default=1,
+    )
+    args_parser.add_argument(
+        "--top-k",
+        help="Only store the K best scoring Android apps for each iOS app instead of all pairs.",
+        type=int,
+        default=None,
+    )
+    args_parser.add_argument(
+        "--min-score",
+        help="Only store pairs with an average score of at least this value.",
+        type=float,
+        default=None,
+    )
+    args_parser.add_argument(
+        "--best-matches-collection",
+        help="Collection to store the best match of each iOS app to, in the same format as aggregate_best_matches.py.",
+        default=None,
+    )
+    args_parser.add_argument(
+        "--work-unit-size",
+        help="Number of iOS apps per work unit. Work units are handed out to the threads as they become free. Defaults to about 16 work units per thread.",
+        type=int,
+        default=None,
+    )
+    args_parser.add_argument(
+        "--cost-ordering",
+        help="Process the work units with the highest estimated cost first.",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--corpus-mode",
+        help=f"How the Android apps are published to the threads: inherited through fork, loaded from a snapshot file or passed to the thread initializer. Defaults to {default_corpus_mode()} on your machine.",
+        choices=CORPUS_MODES,
+        default=default_corpus_mode(),
+    )
+    args_parser.add_argument(
+        "--corpus-snapshot-dir",
+        help="Directory for the snapshot file of the snapshot corpus mode. Defaults to the system's temp directory.",
+        default=None,
+    )
+    args_parser.add_argument(
+        "--resume",
+        help="Resume an interrupted run with the same --matches-collection. iOS apps completed by the previous run are skipped and partial results of the others are replaced.",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--incremental",
+        help="Only match iOS and Android apps that were added or changed (by app hash) since the last successful run with the same --matches-collection, and remove the results of changed or removed apps.",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--sink",
+        help="Where to write the matches to: the --matches-collection (mongo), or gzip compressed JSON lines (jsonl) or Parquet files (parquet) in --output-dir/<matches-collection>, one file per work unit. Defaults to mongo.",
+        choices=RESULT_SINKS,
+        default="mongo",
+    )
+    args_parser.add_argument(
+        "--output-dir",
+        help="Directory for the jsonl and parquet sinks.",
+        default=None,
+    )
+    args_parser.add_argument(
+        "--write-batch-size",
+        help="Number of matches written at once. Defaults to 10000.",
+        type=int,
+        default=10000,
+    )
+    args_parser.add_argument(
+        "--write-queue-size",
+        help="Number of batches that may wait for the background writer of each thread before scoring waits. Defaults to 2.",
+        type=int,
+        default=2,
+    )
+    args_parser.add_argument(
+        "--write-concern",
+        help="Write concern for the matches collection, \"majority\" or a number of nodes. Defaults to the write concern of the MongoDB connection.",
+        default=None,
+    )
+    args_parser.add_argument(
+        "--write-retries",
+        help="Number of retries of writes that failed with a transient error (network errors, primary elections). Defaults to 5.",
+        type=int,
+        default=5,
+    )
+    args_parser.add_argument(
+        "--load-batch-size",
+        help="Number of apps fetched from MongoDB at once while loading. Defaults to 2000.",
+        type=int,
+        default=2000,
+    )
+    args_parser.add_argument(
+        "--load-partitions",
+        help="Number of parallel cursors per collection while loading, each reading a range of _id values. With 1, each collection is read by a single cursor in its natural order. Defaults to 4.",
+        type=int,
+        default=4,
+    )
+    args_parser.add_argument(
+        "--description-top-k",
+        help="Only keep the K most similar Android descriptions of each iOS app in memory, all other pairs get a description similarity of 0. Keeps a sparse matrix instead of the dense matrix of all similarities.",
+        type=int,
+        default=None,
+    )
+    args_parser.add_argument(
+        "--description-min-similarity",
+        help="Only keep description similarities of at least this value in memory, all other pairs get a description similarity of 0. Can be combined with --description-top-k.",
+        type=float,
+        default=None,
+    )
+    args_parser.add_argument(
+        "--description-dtype",
+        help="Type the description similarities are stored as. float32 halves their memory. Defaults to float64.",
+        choices=list(DTYPES),
+        default="float64",
+    )
+    args_parser.add_argument(
+        "--tf-idf-cache-dir",
+        help="Directory to cache the TF-IDF model and the description similarities in. Runs on the same apps and descriptions reuse them instead of recomputing them.",
+        default=None,
+    )
+    args_parser.add_argument(
+        "--cascade",
+        help="Run the matchers from the cheapest to the most expensive and drop pairs as soon as they can no longer reach --min-score or the current --top-k. The stored results are the same.",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--profile-matchers",
+        help="Measure the calls and time of each matcher, print them as a table at the end of the run and write them as JSON to this file.",
+        default=None,
+    )
+    args_parser.add_argument(
+        "--progress-interval",
+        help="Seconds between the progress reports of the run (scored and written pairs, pairs per second, ETA). Defaults to 30.",
+        type=float,
+        default=30.0,
+    )
+    args_parser.add_argument(
+        "--status-file",
+        help="File the progress of the run is written to at each report, as JSON or as a Prometheus textfile if the name ends with .prom.",
+        default=None,
+    )
     args = args_parser.parse_args()
 
-    print("Creating matcher indexes")
-    MatchingResult.create_indexes(args.matches_collection)
+    if args.sink == "mongo":
+        print("Creating matcher indexes")
+        MatchingResult.create_indexes(args.matches_collection)
+    elif args.output_dir is None:
+        args_parser.error(f"--sink {args.sink} requires --output-dir")
 
     print("Start matching all apps")
     match_all_documents(
@@ -319,5 +1177,38 @@ if __name__ == "__main__":
         android_coll_name=args.android_collection,
         matches_coll_name=args.matches_collection,
         threads=args.threads,
+        blocking=args.blocking,
+        blocking_max_key_frequency=args.blocking_max_key_frequency,
+        reference_pairs_path=args.reference_pairs,
+        vectorized=args.vectorized,
+        vectorized_block_size=args.vectorized_block_size,
+        vectorized_workers=args.vectorized_workers,
+        top_k=args.top_k,
+        min_score=args.min_score,
+        best_matches_coll_name=args.best_matches_collection,
+        work_unit_size=args.work_unit_size,
+        cost_ordering=args.cost_ordering,
+        corpus_mode=args.corpus_mode,
+        corpus_snapshot_dir=args.corpus_snapshot_dir,
+        resume=args.resume,
+        incremental=args.incremental,
+        result_sink=args.sink,
+        output_dir=args.output_dir,
+        writer_options=WriterOptions(
+            batch_size=args.write_batch_size,
+            queue_size=args.write_queue_size,
+            write_concern=args.write_concern,
+            max_retries=args.write_retries,
+        ),
+        load_batch_size=args.load_batch_size,
+        load_partitions=args.load_partitions,
+        description_top_k=args.description_top_k,
+        description_min_similarity=args.description_min_similarity,
+        description_dtype=args.description_dtype,
+        tf_idf_cache_dir=args.tf_idf_cache_dir,
+        cascade=args.cascade,
+        matcher_profile_path=args.profile_matchers,
+        progress_interval=args.progress_interval,
+        status_path=args.status_file,
     )
     print("All done")
@@ -0,0 +1,84 @@
+"""
+Publishes the Android corpus to the worker processes once, instead of pickling it
+into every task. Supported modes:
+
+- "fork": The corpus is stored in module state before the pool is created and the
+  workers inherit it through fork (copy-on-write). Only available on POSIX systems.
+- "snapshot": The corpus is pickled once to a file, which every worker loads on start.
+- "initargs": The corpus is handed to each worker as argument of the pool initializer.
+"""
+import multiprocessing
+import os
+import pickle
+import tempfile
+from contextlib import contextmanager
+from multiprocessing.context import BaseContext
+from typing import Iterator, Optional
+
+from database.analysis_results.preprocessing_result.android_preprocessing_result.android_preprocessing_result import (
+    AndroidPreprocessingResult,
+)
+
+CORPUS_MODES = ["fork", "snapshot", "initargs"]
+
+_android_apps: Optional[list[AndroidPreprocessingResult]] = None
+
+
+def default_corpus_mode() -> str:
+    return "fork" if "fork" in multiprocessing.get_all_start_methods() else "snapshot"
+
+
+@contextmanager
+def published_corpus(
+    android_apps: list[AndroidPreprocessingResult],
+    mode: str,
+    snapshot_dir: Optional[str] = None,
+) -> Iterator[tuple[Optional[BaseContext], object]]:
+    """
+    Publish the corpus for a process pool. Yields the multiprocessing context the
+    pool must use and the payload that has to be passed to attach_corpus in each
+    worker. The snapshot file is removed again when the context is left.
+    """
+    global _android_apps
+    if mode == "fork":
+        _android_apps = android_apps
+        try:
+            yield multiprocessing.get_context("fork"), None
+        finally:
+            _android_apps = None
+    elif mode == "snapshot":
+        fd, path = tempfile.mkstemp(prefix="android-corpus-", suffix=".pickle", dir=snapshot_dir)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(android_apps, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            yield None, path
+        finally:
+            os.remove(path)
+    elif mode == "initargs":
+        yield None, android_apps
+    else:
+        raise ValueError(f"Unknown corpus mode {mode}, expected one of {CORPUS_MODES}")
+
+
+def attach_corpus(mode: str, payload: object) -> None:
+    """
+    Attach a worker to the corpus published by published_corpus. Called in the
+    pool initializer.
+    """
+    global _android_apps
+    if mode == "fork":
+        # Inherited from the parent process
+        return
+    if mode == "snapshot":
+        with open(payload, "rb") as fp:
+            _android_apps = pickle.load(fp)
+    elif mode == "initargs":
+        _android_apps = payload
+    else:
+        raise ValueError(f"Unknown corpus mode {mode}, expected one of {CORPUS_MODES}")
+
+
+def get_android_apps() -> list[AndroidPreprocessingResult]:
+    if _android_apps is None:
+        raise RuntimeError("No Android corpus attached to this process")
+    return _android_apps